@@ -0,0 +1,102 @@
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+from eth_loader.aux import json_digest
+from eth_loader.stream_loader import BetterStreamLoader
+
+"""
+Benchmark of the insert path of new episode states.
+
+Builds a synthetic database with 200k episode records (50k urls with 4 states each) and inserts new states for
+existing urls, once the old way (INSERT, then SELECT the key back by URL, json and found) and once with
+cursor.lastrowid. Both runs are rolled back, so they see the identical database.
+
+usage: python scratch/bench_episode_insert.py [db_path] [episodes] [inserts]
+"""
+
+db_path = sys.argv[1] if len(sys.argv) > 1 else "bench_episodes.db"
+n_episodes = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+n_inserts = int(sys.argv[3]) if len(sys.argv) > 3 else 5_000
+states = 4
+
+random.seed(0)
+dt = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+
+def make_json(i: int, state: int) -> str:
+    presentations = [{"width": w, "height": h, "url": f"https://cdn/{i}/{state}/{h}.mp4"}
+                     for w, h in ((1920, 1080), (1280, 720), (640, 360))]
+    return json.dumps({"title": f"Episode {i}", "state": state, "description": "lorem ipsum " * 200,
+                       "selectedEpisode": {"id": str(i), "media": {"presentations": presentations}}},
+                      sort_keys=True)
+
+
+def build():
+    bsl = BetterStreamLoader(db=db_path, start_dt=dt)
+    rows = []
+    for i in range(n_episodes // states):
+        url = f"https://www.video.ethz.ch/lectures/{i}.series-metadata.json"
+        for state in range(states):
+            found = (dt - datetime.timedelta(days=states - state)).strftime("%Y-%m-%d %H:%M:%S")
+            record_type = 0 if state == 0 else 2 if state == states - 1 else 1
+            js = make_json(i, state)
+            rows.append((url, js, found, found, record_type, json_digest(js)))
+
+        if len(rows) > 10_000:
+            bsl.sq_cur.executemany("INSERT INTO episodes (URL, json, found, last_seen, record_type, json_hash) "
+                                   "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            rows = []
+
+    bsl.sq_cur.executemany("INSERT INTO episodes (URL, json, found, last_seen, record_type, json_hash) "
+                           "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    bsl.cleanup()
+
+
+def insert_reselect(bsl: BetterStreamLoader, url: str, json_str: str, now: str) -> int:
+    conv_json_arg = json_str.replace("'", "''")
+    json_hash = json_digest(json_str)
+    bsl.debug_execute(f"INSERT INTO episodes (URL, json, found, last_seen, json_hash) VALUES "
+                      f"('{url}', '{conv_json_arg}', '{now}', '{now}', '{json_hash}')")
+    bsl.debug_execute(f"SELECT key FROM episodes "
+                      f"WHERE URL = '{url}' "
+                      f"AND json = '{conv_json_arg}'"
+                      f"AND found = '{now}'"
+                      f"AND (record_type IS NULL OR record_type = 0)")
+    res = bsl.sq_cur.fetchall()
+    assert len(res) == 1
+    return res[0][0]
+
+
+def insert_lastrowid(bsl: BetterStreamLoader, url: str, json_str: str, now: str) -> int:
+    bsl.debug_execute("INSERT INTO episodes (URL, json, found, last_seen, json_hash) VALUES (?, ?, ?, ?, ?)",
+                      (url, json_str, now, now, json_digest(json_str)))
+    return bsl.sq_cur.lastrowid
+
+
+def measure(fn) -> float:
+    bsl = BetterStreamLoader(db=db_path, start_dt=dt)
+    now = dt.strftime("%Y-%m-%d %H:%M:%S")
+    targets = random.Random(1).sample(range(n_episodes // states), n_inserts)
+
+    start = time.perf_counter()
+    for i in targets:
+        fn(bsl, f"https://www.video.ethz.ch/lectures/{i}.series-metadata.json", make_json(i, states), now)
+    elapsed = time.perf_counter() - start
+
+    bsl.sq_con.rollback()
+    bsl.sq_con.close()
+    return elapsed
+
+
+if __name__ == "__main__":
+    if not os.path.exists(db_path):
+        print(f"Building {db_path} with {n_episodes} episodes")
+        build()
+
+    for name, fn in (("INSERT + SELECT", insert_reselect), ("INSERT + lastrowid", insert_lastrowid)):
+        t = measure(fn)
+        print(f"{name:20}: {n_inserts} inserts in {t:.2f}s, {n_inserts / t:.0f} inserts/s")
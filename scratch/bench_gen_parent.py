@@ -0,0 +1,98 @@
+import datetime
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from eth_loader.site_indexer import ETHSiteIndexer, parent_site
+
+"""
+Benchmark of the parent linking of the site indexer.
+
+Fills a fresh database with the sites of 'sample text/seq_sites.txt' (a site is a branch if another site of the list
+has it as parent, otherwise a video) and links the parents once the old way (SELECT of the next orphan and
+get_url_id after every single UPDATE) and once with gen_parent. Both runs start from the identical database and
+must produce the same parents.
+
+copies > 1 repeats the site list under distinct prefixes to look at larger indexes.
+
+usage: python scratch/bench_gen_parent.py [site list] [copies]
+"""
+
+sites_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "..", "sample text",
+                                                                  "seq_sites.txt")
+copies = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+dt = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+
+def gen_parent_loop(eid: ETHSiteIndexer):
+    """
+    Parent linking before the rewrite.
+    """
+    parent_ids = {}
+
+    eid.debug_execute("SELECT key, URL FROM sites WHERE parent IS NULL")
+    one = eid.sq_cur.fetchone()
+
+    while one is not None:
+        key, url = one
+        parent_url = parent_site(url)
+        parent_id = parent_ids.get(parent_url)
+
+        if parent_id is None:
+            parent_id = eid.get_url_id(parent_url)
+            parent_ids[parent_url] = parent_id
+
+        eid.debug_execute(f"UPDATE sites SET parent = {parent_id} WHERE key IS {key}")
+        eid.debug_execute("SELECT key, URL FROM sites WHERE parent IS NULL")
+        one = eid.sq_cur.fetchone()
+    eid.sq_con.commit()
+
+
+def fill(db_path: str):
+    with open(sites_file) as f:
+        urls = list(dict.fromkeys(u.strip() for u in f if u.strip() != ""))
+
+    if copies > 1:
+        urls = [u.replace("https://www.video.ethz.ch/", f"https://www.video.ethz.ch/c{i}/")
+                for i in range(copies) for u in urls]
+
+    parents = {parent_site(u) for u in urls}
+    now = dt.strftime("%Y-%m-%d %H:%M:%S")
+
+    eid = ETHSiteIndexer(db_file=db_path, start_dt=dt)
+    eid.sq_cur.executemany("INSERT INTO sites (URL, IS_VIDEO, found, last_seen) VALUES (?, ?, ?, ?)",
+                           [(u, 0 if u in parents else 1, now, now) for u in urls])
+    eid.cleanup()
+    return len(urls)
+
+
+def measure(db_path: str, fn) -> tuple:
+    eid = ETHSiteIndexer(db_file=db_path, start_dt=dt)
+    start = time.perf_counter()
+    fn(eid)
+    elapsed = time.perf_counter() - start
+
+    eid.debug_execute("SELECT key, parent FROM sites ORDER BY key")
+    parents = eid.sq_cur.fetchall()
+    eid.cleanup()
+    return elapsed, parents
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+    tmp = tempfile.mkdtemp(prefix="bench_gen_parent_")
+    results = {}
+
+    for name, fn in (("loop", gen_parent_loop), ("gen_parent", ETHSiteIndexer.gen_parent)):
+        db = os.path.join(tmp, f"{name}.db")
+        n = fill(db)
+        t, parents = measure(db, fn)
+        results[name] = parents
+        print(f"{name:12}: linked {n} sites in {t:.3f}s")
+        os.remove(db)
+
+    os.rmdir(tmp)
+    assert results["loop"] == results["gen_parent"], "Parents differ"
+    print("Parents identical")
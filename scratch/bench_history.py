@@ -0,0 +1,129 @@
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from eth_loader.aux import json_digest
+from eth_loader.base_sql import BaseSQliteDB
+from eth_loader.diff_builder import regular_diff
+from eth_loader.history import History
+from eth_loader.keyframes import Keyframes
+from eth_loader.metadata_loader import MetadataLoader
+from eth_loader.stream_loader import BetterStreamLoader
+
+"""
+Benchmark of the episodes of a series at a date: one reconstruction per episode url against the bulk query of History.
+
+A series with `episodes` episodes is generated, every episode changes on a random third of `days` days (initial
+record, diffs, final record). The episodes of the series are queried at every day: reconstructed one by one, with
+History.episodes_as_of without cache, sweeping the days in order with a cache (every day starts from the states of the
+day before) and with a warm cache. All results are compared.
+
+usage: python scratch/bench_history.py [episodes] [days] [keyframe every, 0 for none]
+"""
+
+episodes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+days = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+every = int(sys.argv[3]) if len(sys.argv) > 3 else 32
+
+day0 = datetime.datetime(2020, 1, 1, 12)
+series_url = "https://www.video.ethz.ch/lectures/bench.series-metadata.json"
+
+
+def day(i: int) -> datetime.datetime:
+    return day0 + datetime.timedelta(days=i)
+
+
+def make_db(path: str) -> list:
+    """
+    Write the series and its episodes, returns the urls of the episodes.
+    """
+    MetadataLoader(path, start_dt=day0).cleanup()
+    BetterStreamLoader(db=path, start_dt=day0).cleanup()
+    rnd = random.Random(0)
+    con = sqlite3.connect(path)
+    found = day(0).strftime("%Y-%m-%d %H:%M:%S")
+    series = json.dumps({"id": series_url, "episodes": episodes})
+    metadata_key = con.execute("INSERT INTO metadata (URL, parent, json, found, last_seen, json_hash, record_type) "
+                               "VALUES (?, 0, ?, ?, ?, ?, 0)",
+                               (series_url, series, found, found, json_digest(series))).lastrowid
+
+    urls = []
+    rows = []
+    for e in range(episodes):
+        url = f"https://www.video.ethz.ch/lectures/bench/ep{e}.series-metadata.json"
+        state = {"id": url, "description": "lorem ipsum " * 40, "selectedEpisode": {"views": 0, "title": f"ep {e}"}}
+        current = json.dumps(state)
+        rows.append((url, current, found, found, json_digest(current), 0))
+
+        last = found
+        for i in range(1, days + 1):
+            if rnd.random() > 1 / 3:
+                continue
+            state["selectedEpisode"]["views"] = i
+            new = json.dumps(state)
+            last = day(i).strftime("%Y-%m-%d %H:%M:%S")
+            rows.append((url, regular_diff(current, new), last, last, json_digest(new), 1))
+            current = new
+
+        rows.append((url, current, None, last, json_digest(current), 2))
+        urls.append(url)
+
+    con.executemany("INSERT INTO episodes (URL, json, found, last_seen, json_hash, record_type) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    con.execute("INSERT INTO metadata_episode_assoz (metadata_key, episode_key) "
+                "SELECT ?, key FROM episodes WHERE record_type = 0", (metadata_key,))
+    con.commit()
+    con.close()
+    return urls
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+    tmp = tempfile.mkdtemp(prefix="bench_history_")
+    try:
+        path = os.path.join(tmp, "history.db")
+        urls = make_db(path)
+
+        db = BaseSQliteDB(path)
+        if every > 0:
+            Keyframes(db, b64=False, every=every).write("episodes")
+        kf = Keyframes(db, b64=False, every=1)
+
+        start = time.perf_counter()
+        single = [{url: kf.reconstruct(url, day(i)) for url in urls} for i in range(days + 1)]
+        t_single = time.perf_counter() - start
+
+        cold = History(path, b64=False, cache_size=0)
+        start = time.perf_counter()
+        bulk = [cold.episodes_as_of(series_url, day(i)) for i in range(days + 1)]
+        t_bulk = time.perf_counter() - start
+        assert bulk == single, "Bulk states differ"
+
+        warm = History(path, b64=False, cache_size=episodes * (days + 1))
+        start = time.perf_counter()
+        sweep = [warm.episodes_as_of(series_url, day(i)) for i in range(days + 1)]
+        t_sweep = time.perf_counter() - start
+        assert sweep == single, "Swept states differ"
+
+        start = time.perf_counter()
+        cached = [warm.episodes_as_of(series_url, day(i)) for i in range(days + 1)]
+        t_cached = time.perf_counter() - start
+        assert cached == single, "Cached states differ"
+
+        print(f"{episodes} episodes, {days + 1} dates, keyframes every {every if every > 0 else '-'}")
+        print(f"one by one: {t_single / (days + 1) * 1000:8.2f}ms per date")
+        print(f"bulk:       {t_bulk / (days + 1) * 1000:8.2f}ms per date")
+        print(f"sweep:      {t_sweep / (days + 1) * 1000:8.2f}ms per date")
+        print(f"cached:     {t_cached / (days + 1) * 1000:8.2f}ms per date ({warm.stats_str()})")
+        cold.cleanup()
+        warm.cleanup()
+        db.cleanup()
+    finally:
+        shutil.rmtree(tmp)
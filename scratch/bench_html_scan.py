@@ -0,0 +1,56 @@
+import glob
+import os
+import sys
+import time
+
+from lxml import etree
+
+from eth_loader.site_indexer import is_video, scan_page
+
+"""
+Benchmark of the html scanning of the site indexer.
+
+Compares the old scanning (full tree with etree.HTML, is_video and the xpath of the newsListBox links) with scan_page
+on the pages of 'sample text/'. Both must find the same video flag and links on every page.
+
+usage: python scratch/bench_html_scan.py [seconds per page and method]
+"""
+
+seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+sample_dir = os.path.join(os.path.dirname(__file__), "..", "sample text")
+
+
+def scan_tree(html: str) -> tuple:
+    """
+    Scanning before scan_page.
+    """
+    tree = etree.HTML(html)
+    x = tree.xpath("//div[@class='newsListBox']/a")
+
+    if is_video(tree):
+        return True, []
+
+    return False, [a.attrib["href"] for a in x if "href" in a.keys()]
+
+
+def pages_per_sec(fn, html: str) -> float:
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        fn(html)
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    for path in sorted(glob.glob(os.path.join(sample_dir, "*.html"))):
+        with open(path) as f:
+            content = f.read()
+
+        old, new = scan_tree(content), scan_page(content)
+        assert old == new, f"Results differ for {path}"
+
+        before = pages_per_sec(scan_tree, content)
+        after = pages_per_sec(scan_page, content)
+        print(f"{os.path.basename(path):20}: video {str(new[0]):5} links {len(new[1]):3} | "
+              f"tree {before:8.0f} pages/s scan_page {after:8.0f} pages/s ({after / before:.1f}x)")
@@ -0,0 +1,109 @@
+import datetime
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from eth_loader.aux import json_digest
+from eth_loader.diff_builder import IncrementBuilder
+from eth_loader.stream_loader import BetterStreamLoader
+
+"""
+Benchmark of the increment builder (diffs of the episodes table) with an increasing number of workers.
+
+A database with `n` episode urls is generated, every url has a new record (record_type NULL) to diff: half of them
+against their initial record (record_type 0), the other half against a final record (record_type 2) of an earlier
+increment. The builder is run on a copy of the database per number of workers, the resulting tables must be identical.
+
+usage: python scratch/bench_increment.py [episodes] [max workers] [prefetch]
+"""
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+prefetch = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+
+day1 = "2024-01-01 12:00:00"
+day2 = "2024-01-02 12:00:00"
+day3 = "2024-01-03 12:00:00"
+
+
+def episode(i: int, rev: int) -> str:
+    """
+    Json of an episode similar in size to the ones of video.ethz.ch, rev changes a few fields.
+    """
+    ep = {"id": f"ep{i}", "title": f"Episode {i} rev {rev}", "description": "lorem ipsum " * 40,
+          "selectedEpisode": {"id": f"ep{i}", "createdAt": f"2024-01-0{rev + 1}",
+                              "media": {"presentations": [
+                                  {"width": w, "height": h, "url": f"https://cdn/{i}/{h}-{rev}.mp4"}
+                                  for w, h in ((640, 360), (1280, 720), (1920, 1080))]}},
+          "episodes": [{"id": f"ep{i}-{j}", "title": f"Episode {j}"} for j in range(20 + rev)]}
+    return json.dumps(ep, sort_keys=True)
+
+
+def make_db(path: str):
+    BetterStreamLoader(db=path, start_dt=datetime.datetime(2024, 1, 3, 12)).cleanup()
+    con = sqlite3.connect(path)
+    rows = []
+    for i in range(n):
+        url = f"https://www.video.ethz.ch/lectures/s{i % 100}/ep{i}.series-metadata.json"
+        first = episode(i, 0)
+        rows.append((url, first, day1, day1, json_digest(first), 0))
+        if i % 2 == 1:
+            # diffed in an earlier increment: final record holds the json of day 2
+            second = episode(i, 1)
+            rows.append((url, "{}", day2, day2, json_digest(second), 1))
+            rows.append((url, second, None, day2, json_digest(second), 2))
+        new = episode(i, 2)
+        rows.append((url, new, day3, day3, json_digest(new), None))
+
+    con.executemany("INSERT INTO episodes (URL, json, found, last_seen, json_hash, record_type) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    con.commit()
+    con.close()
+
+
+def content(path: str) -> list:
+    """
+    Rows of the episodes table without keys (the final records are inserted in the order the workers finish).
+    """
+    con = sqlite3.connect(path)
+    rows = con.execute("SELECT URL, json, found, last_seen, json_hash, record_type FROM episodes").fetchall()
+    con.close()
+    return sorted(rows, key=repr)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+    tmp = tempfile.mkdtemp(prefix="bench_increment_")
+    template = os.path.join(tmp, "template.db")
+    make_db(template)
+
+    print(f"{n} episodes to diff, prefetch {prefetch}")
+    results = {}
+    workers = 1
+    try:
+        while workers <= max_workers:
+            path = os.path.join(tmp, f"w{workers}.db")
+            shutil.copy(template, path)
+
+            icb = IncrementBuilder(db_path=path, b64=False, start_dt=datetime.datetime(2024, 1, 3, 12),
+                                   workers=workers, profile="read-mostly", prefetch=prefetch)
+            start = time.perf_counter()
+            icb.build_increment_episodes()
+            icb.sq_con.commit()
+            elapsed = time.perf_counter() - start
+            icb.cleanup()
+
+            results[workers] = content(path)
+            print(f"{workers:3} workers: {elapsed:7.2f}s, {n / elapsed:8.0f} diffs/s")
+            workers *= 2
+    finally:
+        shutil.rmtree(tmp)
+
+    first = next(iter(results.values()))
+    assert all(r == first for r in results.values()), "Databases differ"
+    print("Databases identical")
@@ -0,0 +1,190 @@
+import datetime
+import functools
+import http.server
+import json
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from eth_loader.diff_builder import IncrementBuilder
+from eth_loader.metadata_loader import MetadataLoader
+from eth_loader.pipeline import download_pipelined
+from eth_loader.site_indexer import ETHSiteIndexer
+from eth_loader.stream_loader import BetterStreamLoader
+
+"""
+Benchmark of the pipelined download (metadata and episodes at the same time) against the sequential stages of
+scripts/main.py full_run.
+
+A synthetic video site is served by a local http server (separate process) answering every request after a fixed
+delay (latency of video.ethz.ch). Each mode gets a fresh database and two days, the second with a third of the series changed. The
+tables of both modes must be identical afterwards (keys excluded).
+
+usage: python scratch/bench_pipeline.py [series] [episodes per series] [workers] [delay ms]
+"""
+
+n_series = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+n_episodes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+workers = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+delay = (int(sys.argv[4]) if len(sys.argv) > 4 else 20) / 1000
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        time.sleep(delay)
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(www: str, port):
+    server = http.server.ThreadingHTTPServer(("localhost", 0), functools.partial(Handler, directory=www))
+    port.value = server.server_address[1]
+    server.serve_forever()
+
+
+def make_site(root: str, rev: int):
+    """
+    Write the json of all series and episodes. Every third series changes with rev.
+    """
+    for i in range(n_series):
+        os.makedirs(os.path.join(root, "lectures", f"s{i}"), exist_ok=True)
+        eps = [{"id": f"ep{i}-{j}", "title": f"Episode {j}"} for j in range(n_episodes + (rev if i % 3 == 0 else 0))]
+        meta = {"title": f"Series {i}", "episodes": eps, "rev": rev if i % 3 == 0 else 0}
+        with open(os.path.join(root, "lectures", f"s{i}.series-metadata.json"), "w") as f:
+            json.dump(meta, f)
+
+        for j, e in enumerate(eps):
+            ep = dict(meta)
+            ep["selectedEpisode"] = {"id": e["id"], "media": {"presentations": [
+                {"width": 1280, "height": 720, "url": f"https://cdn/{i}/{j}/720-{rev if i % 3 == 0 else 0}.mp4"}]}}
+            with open(os.path.join(root, "lectures", f"s{i}", f"{e['id']}.series-metadata.json"), "w") as f:
+                json.dump(ep, f)
+
+
+def increment(db: str, dt: datetime.datetime, kind: str):
+    icb = IncrementBuilder(db_path=db, b64=False, start_dt=dt, profile="read-mostly")
+    getattr(icb, kind)()
+    icb.cleanup()
+
+
+def index(db: str, base_url: str, dt: datetime.datetime):
+    eid = ETHSiteIndexer(db_file=db, start_dt=dt, profile="bulk-load")
+    now = dt.strftime("%Y-%m-%d %H:%M:%S")
+    for i in range(n_series):
+        url = f"{base_url}/lectures/s{i}.html"
+        if eid.not_in_db(url, 1):
+            eid.debug_execute("INSERT INTO sites (URL, IS_VIDEO, found, last_seen) VALUES (?, 1, ?, ?)",
+                              (url, now, now))
+        else:
+            eid.update_found(url, 1)
+    eid.gen_parent()
+    eid.cleanup()
+
+    MetadataLoader(db, start_dt=dt, profile="bulk-load").cleanup()
+    BetterStreamLoader(db=db, start_dt=dt, profile="bulk-load").cleanup()
+
+
+def sequential(db: str, dt: datetime.datetime) -> float:
+    """
+    Stages of full_run, returns the seconds spent downloading.
+    """
+    increment(db, dt, "build_increment_metadata")
+    start = time.perf_counter()
+    eid = MetadataLoader(db, start_dt=dt, profile="bulk-load")
+    eid.download(dt, workers)
+    eid.deprecate(dt=dt)
+    eid.cleanup()
+    elapsed = time.perf_counter() - start
+    increment(db, dt, "build_increment_metadata")
+
+    increment(db, dt, "build_increment_episodes")
+    start = time.perf_counter()
+    bsl = BetterStreamLoader(db=db, start_dt=dt, profile="bulk-load")
+    bsl.initiator(workers=workers)
+    bsl.cleanup()
+    elapsed += time.perf_counter() - start
+    increment(db, dt, "build_increment_episodes")
+    return elapsed
+
+
+def pipelined(db: str, dt: datetime.datetime) -> float:
+    """
+    Stages of full_run with pipelined = True, returns the seconds spent downloading.
+    """
+    increment(db, dt, "build_increment_metadata")
+    increment(db, dt, "build_increment_episodes")
+
+    start = time.perf_counter()
+    bsl = BetterStreamLoader(db=db, start_dt=dt, profile="bulk-load")
+    eid = MetadataLoader(db, start_dt=dt, profile="bulk-load")
+    download_pipelined(eid, bsl, dt, workers=workers)
+    bsl.cleanup()
+    eid.deprecate(dt=dt)
+    eid.cleanup()
+    elapsed = time.perf_counter() - start
+
+    increment(db, dt, "build_increment_metadata")
+    increment(db, dt, "build_increment_episodes")
+    return elapsed
+
+
+def content(db: str) -> list:
+    """
+    Rows of the tables without keys, links by url and record type.
+    """
+    bsl = BetterStreamLoader(db=db, start_dt=datetime.datetime.now())
+    out = []
+    for tbl in ("metadata", "episodes"):
+        bsl.debug_execute(f"SELECT URL, json, record_type, found, last_seen, deprecated FROM {tbl}")
+        out.extend((tbl,) + r for r in bsl.sq_cur.fetchall())
+    bsl.debug_execute("SELECT m.URL, m.record_type, m.found, e.URL, e.record_type, e.found "
+                      "FROM metadata_episode_assoz a JOIN metadata m ON m.key = a.metadata_key "
+                      "JOIN episodes e ON e.key = a.episode_key")
+    out.extend(bsl.sq_cur.fetchall())
+    bsl.cleanup()
+    return sorted(out, key=repr)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+    tmp = tempfile.mkdtemp(prefix="bench_pipeline_")
+    www = os.path.join(tmp, "www")
+
+    os.makedirs(www)
+    port = mp.Value("i", 0)
+    server = mp.Process(target=serve, args=(www, port), daemon=True)
+    server.start()
+    while port.value == 0:
+        time.sleep(0.01)
+    base = f"http://localhost:{port.value}"
+
+    print(f"{n_series} series with {n_episodes} episodes each, {workers} workers, {delay * 1000:.0f}ms per request")
+    results = {}
+    try:
+        for name, fn in (("sequential", sequential), ("pipelined", pipelined)):
+            db_path = os.path.join(tmp, f"{name}.db")
+            total, download = 0, 0
+            for day, rev in ((1, 0), (2, 1)):
+                make_site(www, rev)
+                dt = datetime.datetime(2024, 1, day, 12)
+                index(db_path, base, dt)
+                start = time.perf_counter()
+                download += fn(db_path, dt)
+                total += time.perf_counter() - start
+            results[name] = content(db_path)
+            print(f"{name:12}: download {download:7.2f}s, with increments {total:7.2f}s")
+    finally:
+        server.terminate()
+        shutil.rmtree(tmp)
+
+    assert results["sequential"] == results["pipelined"], "Databases differ"
+    print("Databases identical")
@@ -0,0 +1,168 @@
+import datetime
+import functools
+import http.server
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from eth_loader.diff_builder import IncrementBuilder
+from eth_loader.metadata_loader import MetadataLoader
+from eth_loader.sanity_check import SanityCheck
+from eth_loader.site_indexer import ETHSiteIndexer
+from eth_loader.stream_loader import BetterStreamLoader
+
+"""
+Benchmark of the sqlite performance profiles on the stages of scripts/main.py full_run.
+
+A synthetic video site (series-metadata.json of every series and its episodes) is served by a local http server. The
+crawl of video.ethz.ch is replaced by inserting the series sites into the sites table, every other stage runs like in
+full_run. Each profile gets a fresh database and two runs: the initial download and a second day where a third of
+the series changed (new metadata and episode states, diffs built by the increment builder).
+
+"staged" uses the profile per stage like scripts/main.py. "default" is a plain connection without pragmas.
+
+usage: python scratch/bench_profiles.py [series] [episodes per series] [workers]
+"""
+
+n_series = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+n_episodes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+workers = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+# stage -> profile as in scripts/main.py
+staged = {"index": "bulk-load", "increment": "read-mostly", "download": "bulk-load", "deprecate": "bulk-load",
+          "sanity": "safe"}
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, without this every keep-alive request waits for the delayed ack
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+
+def make_site(root: str, rev: int):
+    """
+    Write the json of all series and episodes. Every third series changes with rev.
+    """
+    for i in range(n_series):
+        os.makedirs(os.path.join(root, "lectures", f"s{i}"), exist_ok=True)
+        eps = [{"id": f"ep{i}-{j}", "title": f"Episode {j}"} for j in range(n_episodes)]
+        meta = {"title": f"Series {i}", "description": "lorem ipsum " * 50, "episodes": eps,
+                "rev": rev if i % 3 == 0 else 0}
+        with open(os.path.join(root, "lectures", f"s{i}.series-metadata.json"), "w") as f:
+            json.dump(meta, f)
+
+        for j, e in enumerate(eps):
+            ep = dict(meta)
+            ep["selectedEpisode"] = {"id": e["id"], "media": {"presentations": [
+                {"width": w, "height": h, "url": f"https://cdn/{i}/{j}/{h}-{rev if i % 3 == 0 else 0}.mp4"}
+                for w, h in ((1920, 1080), (1280, 720), (640, 360))]}}
+            with open(os.path.join(root, "lectures", f"s{i}", f"{e['id']}.series-metadata.json"), "w") as f:
+                json.dump(ep, f)
+
+
+def full_run(db: str, base_url: str, dt: datetime.datetime, profile) -> dict:
+    """
+    Stages of full_run, returns the seconds spent per stage.
+    """
+    p = staged if profile == "staged" else {k: profile for k in staged}
+    times = {}
+
+    def timed(name: str, fn):
+        start = time.perf_counter()
+        fn()
+        times[name] = times.get(name, 0) + time.perf_counter() - start
+
+    def index():
+        eid = ETHSiteIndexer(db_file=db, start_dt=dt, profile=p["index"])
+        for i in range(n_series):
+            url = f"{base_url}/lectures/s{i}.html"
+            if eid.not_in_db(url, 1):
+                eid.debug_execute("INSERT INTO sites (URL, IS_VIDEO, found, last_seen) VALUES (?, 1, ?, ?)",
+                                  (url, dt.strftime("%Y-%m-%d %H:%M:%S"), dt.strftime("%Y-%m-%d %H:%M:%S")))
+            else:
+                eid.update_found(url, 1)
+        eid.gen_parent()
+        eid.cleanup()
+
+        # full_run expects the tables of the loaders to exist already
+        MetadataLoader(db, start_dt=dt, profile=p["index"]).cleanup()
+        BetterStreamLoader(db=db, start_dt=dt, profile=p["index"]).cleanup()
+
+    def increment(kind: str):
+        icb = IncrementBuilder(db_path=db, b64=False, start_dt=dt, profile=p["increment"])
+        getattr(icb, kind)()
+        icb.cleanup()
+
+    def metadata():
+        eid = MetadataLoader(db, start_dt=dt, profile=p["download"])
+        eid.download(dt, workers)
+        eid.deprecate(dt=dt)
+        eid.cleanup()
+
+    def deprecate_metadata():
+        eid = MetadataLoader(db, start_dt=dt, profile=p["deprecate"])
+        eid.deprecate(dt=dt)
+        eid.cleanup()
+
+    def streams():
+        bsl = BetterStreamLoader(db=db, start_dt=dt, profile=p["download"])
+        bsl.initiator(workers=workers)
+        bsl.cleanup()
+
+    def deprecate_episodes():
+        bsl = BetterStreamLoader(db=db, start_dt=dt, profile=p["deprecate"])
+        bsl.deprecate(dt)
+        bsl.cleanup()
+
+    def sanity():
+        sc = SanityCheck(db, profile=p["sanity"])
+        sc.check_all()
+        sc.cleanup()
+
+    timed("index", index)
+    timed("increment", functools.partial(increment, "build_increment_metadata"))
+    timed("metadata", metadata)
+    timed("increment", functools.partial(increment, "build_increment_metadata"))
+    timed("deprecate", deprecate_metadata)
+    timed("increment", functools.partial(increment, "build_increment_episodes"))
+    timed("streams", streams)
+    timed("increment", functools.partial(increment, "build_increment_episodes"))
+    timed("deprecate", deprecate_episodes)
+    timed("sanity", sanity)
+    return times
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    tmp = tempfile.mkdtemp(prefix="bench_profiles_")
+    www = os.path.join(tmp, "www")
+
+    server = http.server.ThreadingHTTPServer(("localhost", 0), functools.partial(Handler, directory=www))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://localhost:{server.server_address[1]}"
+
+    print(f"{n_series} series with {n_episodes} episodes each, {workers} workers, served from {base}")
+    try:
+        for prof in ("default", "safe", "bulk-load", "read-mostly", "staged"):
+            db_path = os.path.join(tmp, f"{prof}.db")
+            total = {}
+            for day, rev in ((1, 0), (2, 1)):
+                make_site(www, rev)
+                res = full_run(db_path, base, datetime.datetime(2024, 1, day, 12), None if prof == "default" else prof)
+                for k, v in res.items():
+                    total[k] = total.get(k, 0) + v
+
+            stages = " ".join(f"{k} {v:6.2f}s" for k, v in total.items())
+            print(f"{prof:12}: total {sum(total.values()):7.2f}s | {stages} | "
+                  f"{os.path.getsize(db_path) / 1024 ** 2:.0f} MiB")
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp)
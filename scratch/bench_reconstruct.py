@@ -0,0 +1,130 @@
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from eth_loader.aux import json_digest
+from eth_loader.base_sql import BaseSQliteDB
+from eth_loader.diff_builder import regular_diff
+from eth_loader.keyframes import Keyframes
+from eth_loader.stream_loader import BetterStreamLoader
+
+"""
+Benchmark of the reconstruction of old states of episodes with and without keyframes, by length of the history.
+
+For every history length a few episode urls with one change per day are generated (initial record, one diff per day,
+final record). The states are reconstructed at random dates from the initial record, then the keyframes are written
+and the same dates are reconstructed from the nearest keyframe. Every reconstructed state is compared to the state
+generated for that day.
+
+usage: python scratch/bench_reconstruct.py [keyframe every] [history lengths, comma separated]
+"""
+
+every = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+lengths = [int(x) for x in sys.argv[2].split(",")] if len(sys.argv) > 2 else [10, 50, 200, 500]
+urls_per_length = 5
+lookups = 50
+
+day0 = datetime.datetime(2020, 1, 1, 12)
+
+
+def day(i: int) -> datetime.datetime:
+    return day0 + datetime.timedelta(days=i)
+
+
+def evolve(state: dict, i: int, rnd: random.Random) -> dict:
+    """
+    Next state of an episode: a nested field changes every day, now and then an episode is added to the list.
+    """
+    state = json.loads(json.dumps(state))
+    state["selectedEpisode"]["media"]["presentations"][rnd.randrange(3)]["url"] = f"https://cdn/{i}.mp4"
+    state["selectedEpisode"]["views"] = i
+    if rnd.random() < 0.2:
+        state["episodes"].append({"id": f"ep-{i}", "title": f"Episode {i}"})
+    return state
+
+
+def make_db(path: str) -> dict:
+    """
+    Write the histories, returns url -> list of the states per day.
+    """
+    BetterStreamLoader(db=path, start_dt=day0).cleanup()
+    rnd = random.Random(0)
+    histories = {}
+    rows = []
+    for length in lengths:
+        for u in range(urls_per_length):
+            url = f"https://www.video.ethz.ch/lectures/h{length}/ep{u}.series-metadata.json"
+            states = [{"id": url, "description": "lorem ipsum " * 40,
+                       "selectedEpisode": {"views": 0, "media": {"presentations": [
+                           {"height": h, "url": f"https://cdn/{h}.mp4"} for h in (360, 720, 1080)]}},
+                       "episodes": [{"id": f"ep-{j}", "title": f"Episode {j}"} for j in range(20)]}]
+            found = day(0).strftime("%Y-%m-%d %H:%M:%S")
+            initial = json.dumps(states[0])
+            rows.append((url, initial, found, found, json_digest(initial), 0))
+
+            for i in range(1, length + 1):
+                states.append(evolve(states[-1], i, rnd))
+                found = day(i).strftime("%Y-%m-%d %H:%M:%S")
+                new = json.dumps(states[-1])
+                diff = regular_diff(json.dumps(states[-2]), new)
+                rows.append((url, diff, found, found, json_digest(new), 1))
+
+            final = json.dumps(states[-1])
+            rows.append((url, final, None, found, json_digest(final), 2))
+            histories[url] = states
+
+    con = sqlite3.connect(path)
+    con.executemany("INSERT INTO episodes (URL, json, found, last_seen, json_hash, record_type) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    con.commit()
+    con.close()
+    return histories
+
+
+def measure(kf: Keyframes, histories: dict, length: int, dates: list) -> float:
+    """
+    Average milliseconds per reconstruction of the urls of a history length, checks the states.
+    """
+    urls = [url for url in histories if f"/h{length}/" in url]
+    start = time.perf_counter()
+    for url, i in dates:
+        state = kf.reconstruct(urls[url], day(i))
+        assert state == histories[urls[url]][i], f"Wrong state of {urls[url]} at day {i}"
+    return (time.perf_counter() - start) / len(dates) * 1000
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+    tmp = tempfile.mkdtemp(prefix="bench_reconstruct_")
+    try:
+        path = os.path.join(tmp, "history.db")
+        histories = make_db(path)
+
+        db = BaseSQliteDB(path)
+        kf = Keyframes(db, b64=False, every=every)
+
+        rnd = random.Random(1)
+        dates = {length: [(rnd.randrange(urls_per_length), rnd.randrange(length + 1)) for _ in range(lookups)]
+                 for length in lengths}
+        without = {length: measure(kf, histories, length, dates[length]) for length in lengths}
+
+        start = time.perf_counter()
+        written = kf.write("episodes")
+        elapsed = time.perf_counter() - start
+        print(f"Wrote {written} keyframes (every {every} diffs) in {elapsed:.2f}s")
+
+        with_kf = {length: measure(kf, histories, length, dates[length]) for length in lengths}
+
+        print(f"{'history':>8} {'replay':>10} {'keyframes':>10}")
+        for length in lengths:
+            print(f"{length:8} {without[length]:8.2f}ms {with_kf[length]:8.2f}ms")
+        db.cleanup()
+    finally:
+        shutil.rmtree(tmp)
@@ -2,9 +2,13 @@ import datetime
 import os.path
 import sys
 import shutil
+from typing import List, Tuple, Union
 
+from eth_loader.concurrency import AdaptiveConcurrency
 from eth_loader.diff_builder import IncrementBuilder
 from eth_loader.metadata_loader import MetadataLoader
+from eth_loader.pipeline import download_pipelined
+from eth_loader.rate_limit import RateLimiter
 from eth_loader.sanity_check import SanityCheck
 from eth_loader.site_indexer import ETHSiteIndexer
 from eth_loader.stream_loader import BetterStreamLoader
@@ -12,11 +16,45 @@ from logs import setup_logging
 from scripts.secrets import user_name, password, spec_login
 
 
-workers = 10
+workers = 30  # upper bound of the requests in flight per stage
+adaptive = True  # start at initial_concurrency, grow while the server is healthy, back off on 429 / 5xx / latency
+initial_concurrency = 10
+host_rate = (20, 20)  # token bucket (requests per second, burst) per host, None for no limit
+prefix_rates = {"/lectures": (15, 15)}  # ... and per path prefix on top of it
+engine = "thread"  # "async" to run all downloads of a stage on a single asyncio event loop
+incremental_crawl = True  # don't download the video sites below unchanged branch sites again
+full_recrawl_days = 7  # ... unless their branch site was last crawled completely more than this many days ago
+pipelined = True  # download the episodes of a series as soon as its metadata is written
+keyframe_every = 32  # full json of an url after this many diffs, speeds up reconstructing old states. None to disable
+keyframe_size = None  # ... or once the diffs since the last keyframe exceed this many characters
+
+# sqlite performance profiles of the stages (see eth_loader.base_sql.PROFILES)
+write_profile = "bulk-load"
+read_profile = "read-mostly"
+final_profile = "safe"  # last stage, leaves the db as a single file (rollback journal) for the backups
+
+
+def concurrency(logger_name: str) -> Union[AdaptiveConcurrency, None]:
+    """
+    Adaptive concurrency controller of a stage, None if disabled.
+    """
+    if not adaptive:
+        return None
+    return AdaptiveConcurrency(initial=min(initial_concurrency, workers), maximum=workers, logger_name=logger_name)
+
+
+def rate_limiter(logger_name: str) -> Union[RateLimiter, None]:
+    """
+    Rate limit of a stage, None if disabled.
+    """
+    if host_rate is None and len(prefix_rates) == 0:
+        return None
+    return RateLimiter(default=host_rate, prefixes=prefix_rates, logger_name=logger_name)
 
 def build_metadata_increment(db: str, b64: bool, start_dt: datetime.datetime):
     start = datetime.datetime.now()
-    icb = IncrementBuilder(db_path=db, b64=b64, start_dt=start_dt)
+    icb = IncrementBuilder(db_path=db, b64=b64, start_dt=start_dt, profile=read_profile,
+                           keyframe_every=keyframe_every, keyframe_size=keyframe_size)
     icb.build_increment_metadata()
     icb.cleanup()
     end = datetime.datetime.now()
@@ -25,34 +63,54 @@ def build_metadata_increment(db: str, b64: bool, start_dt: datetime.datetime):
 
 def build_episode_increment(db: str, b64: bool, start_dt: datetime.datetime):
     start = datetime.datetime.now()
-    icb = IncrementBuilder(db_path=db, b64=b64, start_dt=start_dt)
+    icb = IncrementBuilder(db_path=db, b64=b64, start_dt=start_dt, profile=read_profile,
+                           keyframe_every=keyframe_every, keyframe_size=keyframe_size)
     icb.build_increment_episodes()
     icb.cleanup()
     end = datetime.datetime.now()
     print(f"required {(end - start).total_seconds():.02f}s")
 
 
-def perform_index_of_sites(db: str, dt: datetime.datetime):
-    global workers
+def perform_index_of_sites(dbs: List[Tuple[str, bool]], dt: datetime.datetime):
+    """
+    Crawl once, the sites are written to all databases.
+    """
+    global workers, engine, incremental_crawl, full_recrawl_days
     print("Started")
     index_start = datetime.datetime.now()
-    eid = ETHSiteIndexer(db_file=db, start_dt=dt)
-    eid.index_video_eth(threads=workers)
-    eid.gen_parent()
-    eid.cleanup()
+    eid = ETHSiteIndexer(db_file=dbs[0][0], start_dt=dt, profile=write_profile,
+                         concurrency=concurrency("site_indexer"), rate_limit=rate_limiter("site_indexer"))
+    sinks = [ETHSiteIndexer(db_file=db, start_dt=dt, profile=write_profile) for db, _ in dbs[1:]]
+    for sink in sinks:
+        eid.add_sink(sink)
+
+    eid.index_video_eth(threads=workers, engine=engine, incremental=incremental_crawl,
+                        full_recrawl=full_recrawl_days)
+    for indexer in [eid] + sinks:
+        indexer.gen_parent()
+        indexer.cleanup()
     end = datetime.datetime.now()
     print(f"required {(end - index_start).total_seconds():.02f}s")
 
 
-def download_all_metadata(db, index_start: datetime.datetime, b64: bool = False):
-    global workers
+def download_all_metadata(dbs: List[Tuple[str, bool]], index_start: datetime.datetime):
+    """
+    Download the metadata once, it's written to all databases.
+    """
+    global workers, engine
     start = datetime.datetime.now()
     print("Started")
     print(index_start)
-    eid = MetadataLoader(db, use_base64=b64, start_dt=index_start)
-    eid.download(index_start, workers)
-    eid.deprecate(dt=index_start)
-    eid.cleanup()
+    loaders = [MetadataLoader(db, use_base64=b64, start_dt=index_start, profile=write_profile) for db, b64 in dbs]
+    loaders[0].concurrency = concurrency("metadata_loader")
+    loaders[0].rate_limit = rate_limiter("metadata_loader")
+    for sink in loaders[1:]:
+        loaders[0].add_sink(sink)
+
+    loaders[0].download(index_start, workers, engine=engine)
+    for eid in loaders:
+        eid.deprecate(dt=index_start)
+        eid.cleanup()
     end = datetime.datetime.now()
     print(f"required {(end - start).total_seconds():.02f}s")
 
@@ -61,7 +119,7 @@ def perform_deprecate_metadata(db: str, dt: datetime.datetime, b64: bool = False
     global workers
     start = datetime.datetime.now()
     print("Started")
-    eid = MetadataLoader(db, use_base64=b64, start_dt=dt)
+    eid = MetadataLoader(db, use_base64=b64, start_dt=dt, profile=write_profile)
     eid.deprecate(dt=dt)
     eid.cleanup()
     end = datetime.datetime.now()
@@ -77,31 +135,82 @@ def perform_deprecate_episodes(db: str, dt: datetime.datetime, b64: bool = False
                              password=password,
                              spec_login=spec_login,
                              use_base64=b64,
-                             start_dt=dt)
+                             start_dt=dt,
+                             profile=write_profile)
     bsl.deprecate(dt)
     bsl.cleanup()
     end = datetime.datetime.now()
     print(f"required {(end - start).total_seconds():.02f}s")
 
 
-def download_all_stream_data(db: str, index_start: datetime.datetime, b64: bool = False):
-    global workers
+def stream_loaders(dbs: List[Tuple[str, bool]], index_start: datetime.datetime,
+                   rate_limit: RateLimiter = None) -> List[BetterStreamLoader]:
+    """
+    Stream loader of every database, the first one downloads (logged in), the others are its sinks.
+    """
+    loaders = [BetterStreamLoader(db=dbs[0][0],
+                                  user_name=user_name,
+                                  password=password,
+                                  spec_login=spec_login,
+                                  use_base64=dbs[0][1],
+                                  start_dt=index_start,
+                                  profile=write_profile,
+                                  rate_limit=rate_limit)]
+
+    # sinks only write, they don't need to log in
+    loaders.extend(BetterStreamLoader(db=db, use_base64=b64, start_dt=index_start, profile=write_profile)
+                   for db, b64 in dbs[1:])
+    return loaders
+
+
+def download_all_stream_data(dbs: List[Tuple[str, bool]], index_start: datetime.datetime):
+    """
+    Download the episodes once, they're written to all databases.
+    """
+    global workers, engine
     start = datetime.datetime.now()
     print("Started")
-    bsl = BetterStreamLoader(db=db,
-                             user_name=user_name,
-                             password=password,
-                             spec_login=spec_login,
-                             use_base64=b64,
-                             start_dt=index_start)
-    bsl.initiator(workers=workers)
-    bsl.cleanup()
+    loaders = stream_loaders(dbs, index_start, rate_limit=rate_limiter("stream_loader"))
+    loaders[0].concurrency = concurrency("stream_loader")
+    for sink in loaders[1:]:
+        loaders[0].add_sink(sink)
+
+    loaders[0].initiator(workers=workers, engine=engine)
+    for bsl in loaders:
+        bsl.cleanup()
+    end = datetime.datetime.now()
+    print(f"required {(end - start).total_seconds():.02f}s")
+
+
+def download_all_pipelined(dbs: List[Tuple[str, bool]], index_start: datetime.datetime):
+    """
+    Metadata and episodes in one stage, the episodes of a series are downloaded as soon as its metadata is written.
+    Every url is downloaded once, the results are written to all databases.
+    """
+    global workers, engine
+    start = datetime.datetime.now()
+    print("Started")
+    rate_limit = rate_limiter("stream_loader")
+    streams = stream_loaders(dbs, index_start, rate_limit=rate_limit)
+    metadata = [MetadataLoader(db, use_base64=b64, start_dt=index_start, profile=write_profile) for db, b64 in dbs]
+
+    # both loaders request the same server, one limit for all requests in flight and one rate limit
+    metadata[0].concurrency = streams[0].concurrency = concurrency("stream_loader")
+    metadata[0].rate_limit = rate_limit
+    download_pipelined(metadata[0], streams[0], index_start, workers=workers, engine=engine,
+                       sinks=list(zip(metadata[1:], streams[1:])))
+    for bsl in streams:
+        bsl.cleanup()
+
+    for eid in metadata:
+        eid.deprecate(dt=index_start)
+        eid.cleanup()
     end = datetime.datetime.now()
     print(f"required {(end - start).total_seconds():.02f}s")
 
 
 def sanity_check(db: str) -> bool:
-    sc = SanityCheck(db)
+    sc = SanityCheck(db, profile=final_profile)
     start = datetime.datetime.now()
     res = sc.check_all()
     end = datetime.datetime.now()
@@ -109,23 +218,41 @@ def sanity_check(db: str) -> bool:
     return res
 
 
-def full_run(db_path: str, index_start: datetime.datetime, b64: bool):
-    perform_index_of_sites(db_path, index_start)
+def full_run(dbs: List[Tuple[str, bool]], index_start: datetime.datetime):
+    """
+    Index and download once, write all databases.
 
-    build_metadata_increment(db_path, b64=b64, start_dt=index_start)
-    download_all_metadata(db_path, index_start, b64=b64)
-    build_metadata_increment(db_path, b64=b64, start_dt=index_start)
-    perform_deprecate_metadata(db_path, index_start, b64=b64)
+    :param dbs: (path, use base64) of every database, the first one holds the crawl state and validators used
+    :param index_start: datetime of the run
+    """
+    def each(fn, **kwargs):
+        for db_path, b64 in dbs:
+            fn(db_path, b64=b64, **kwargs)
 
-    build_episode_increment(db_path, b64=b64, start_dt=index_start)
-    download_all_stream_data(db_path, index_start, b64=b64)
-    build_episode_increment(db_path, b64=b64, start_dt=index_start)
-    perform_deprecate_episodes(db_path, index_start, b64=b64)
+    perform_index_of_sites(dbs, index_start)
 
-    if sanity_check(db_path):
-        print(f"At least one Sanity Check Failed", file=sys.stderr)
+    each(build_metadata_increment, start_dt=index_start)
+    if pipelined:
+        # the episode links of changed series are the records the metadata increment turns into differentials
+        each(build_episode_increment, start_dt=index_start)
+        download_all_pipelined(dbs, index_start)
+        each(build_metadata_increment, start_dt=index_start)
+        each(perform_deprecate_metadata, dt=index_start)
     else:
-        print(f"All Sanity Checks passed", file=sys.stderr)
+        download_all_metadata(dbs, index_start)
+        each(build_metadata_increment, start_dt=index_start)
+        each(perform_deprecate_metadata, dt=index_start)
+
+        each(build_episode_increment, start_dt=index_start)
+        download_all_stream_data(dbs, index_start)
+    each(build_episode_increment, start_dt=index_start)
+    each(perform_deprecate_episodes, dt=index_start)
+
+    for db_path, _ in dbs:
+        if sanity_check(db_path):
+            print(f"At least one Sanity Check Failed for {db_path}", file=sys.stderr)
+        else:
+            print(f"All Sanity Checks passed for {db_path}", file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -140,33 +267,28 @@ if __name__ == "__main__":
         print("PRODUCTION")
 
     global_start = datetime.datetime.now()
+    # an interrupted run is resumed with its start, the urls already done are skipped (job ledger)
     # global_start = datetime.datetime(2024, 9, 23, 0, 0, 0)
 
     is_b64 = False
     both = True
     make_backup: bool = True
 
+    databases = []
     if is_b64 or both:
-        backup_path = "/home/alisot2000/Documents/01_ReposNCode/eth-video-indexer/scripts/seq_sites_b64.db.bak"
-        path = "/home/alisot2000/Documents/01_ReposNCode/eth-video-indexer/scripts/seq_sites_b64.db"
-
-        if make_backup:
-            print("Making Backup of Database...")
-            shutil.copy2(path, backup_path)
-            print("Backup Done")
-
-        full_run(path, global_start, b64=True)
+        databases.append(("/home/alisot2000/Documents/01_ReposNCode/eth-video-indexer/scripts/seq_sites_b64.db", True))
 
     if not is_b64 or both:
-        backup_path = "/home/alisot2000/Documents/01_ReposNCode/eth-video-indexer/scripts/seq_sites.db.bak"
-        path = "/home/alisot2000/Documents/01_ReposNCode/eth-video-indexer/scripts/seq_sites.db"
+        databases.append(("/home/alisot2000/Documents/01_ReposNCode/eth-video-indexer/scripts/seq_sites.db", False))
 
-        if make_backup:
+    if make_backup:
+        for path, _ in databases:
             print("Making Backup of Database...")
-            shutil.copy2(path, backup_path)
+            shutil.copy2(path, path + ".bak")
             print("Backup Done")
 
-        full_run(path, global_start, b64=False)
+    # single run, every url is downloaded once and written to all databases
+    full_run(databases, global_start)
 
     global_end = datetime.datetime.now()
     print(f"Overall Time for complete indexing: {(global_end - global_start).total_seconds():.02f}")
@@ -2,4 +2,16 @@ from eth_loader.base_sql import BaseSQliteDB
 import eth_loader.aux as aux
 from eth_loader.metadata_loader import MetadataLoader, retrieve_metadata, metadata_download_handler
 from eth_loader.site_indexer import ETHSiteIndexer
-from eth_loader.stream_loader import get_stream, stream_download_handler, SpecLogin, EpisodeEntry
\ No newline at end of file
+from eth_loader.stream_loader import get_stream, stream_download_handler, SpecLogin, EpisodeEntry
+from eth_loader.http_session import SessionPool
+from eth_loader.worker_pool import WorkerPool
+from eth_loader.batch_writer import BatchWriter
+from eth_loader.frontier import Frontier
+from eth_loader.pipeline import download_pipelined
+from eth_loader.job_ledger import JobLedger
+from eth_loader.retry import RetryPolicy, error_class
+from eth_loader.concurrency import AdaptiveConcurrency
+from eth_loader.rate_limit import RateLimiter
+from eth_loader.cookie_cache import CookieCache
+from eth_loader.keyframes import Keyframes
+from eth_loader.history import History
@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import queue
+import threading
+from typing import Awaitable, Callable, Iterable, Iterator, Union
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from eth_loader.worker_pool import FEED_DONE, IDLE
+
+"""
+# Asyncio download engine
+
+Alternative to the worker threads of the loaders. A single thread runs an event loop which keeps up to `concurrency`
+requests in flight. Every finished job puts its result into the result queue, the dequeue side (the single db writer)
+consumes them with `results()` just like the results of a WorkerPool.
+
+A fetch coroutine has the signature `fetch(session, job, submit) -> dict | None`:
+- session: aiohttp.ClientSession shared by all jobs
+- job: the job dict (same dict the worker threads would get from the command queue)
+- submit: callable to schedule further jobs (used by the site indexer for recursion)
+
+With lazy=True the jobs are taken from a (blocking) iterable while the engine is running, e.g. the episodes found
+by the metadata loader in the pipelined mode. The engine ends once the iterable is exhausted and all jobs are done.
+"""
+
+FetchCoroutine = Callable[["aiohttp.ClientSession", dict, Callable[[dict], None]], Awaitable[Union[dict, None]]]
+
+
+class AsyncEngine:
+    """
+    Runs download jobs on one asyncio event loop in a background thread with a semaphore based concurrency cap.
+    """
+    def __init__(self, fetch: FetchCoroutine, result_queue: queue.Queue = None, concurrency: int = 1000,
+                 logger_name: str = "thread_handler"):
+        """
+        :param fetch: coroutine performing a single job, returns the result for the result queue or None.
+        :param result_queue: queue the results are put in. Handled in main thread. Defaults to a queue bounded to
+            the concurrency, a full queue holds back the event loop until the db writer caught up.
+        :param concurrency: maximum number of requests in flight.
+        :param logger_name: name of the logger of the owning loader
+        """
+        if aiohttp is None:
+            raise ImportError("The async engine requires aiohttp, install it or use engine='thread'")
+
+        if concurrency < 1:
+            raise ValueError("Concurrency must be greater than 0")
+
+        self.fetch = fetch
+        self.result_queue = result_queue if result_queue is not None else queue.Queue(maxsize=concurrency)
+        self.concurrency = concurrency
+        self.logger = logging.getLogger(logger_name)
+
+        self.thread: Union[threading.Thread, None] = None
+
+        self.__queue: Union[asyncio.Queue, None] = None
+        self.__open = 0
+        self.__requests = 0
+        self.__connects = 0
+
+    def start(self, jobs: Iterable[dict], lazy: bool = False):
+        """
+        Start the event loop thread and schedule the given jobs.
+
+        :param jobs: initial jobs
+        :param lazy: take the jobs from the iterable while running instead of materializing it first. The iterable
+            may block, it is advanced in a worker thread of the event loop.
+        """
+        if self.thread is not None:
+            raise ValueError("Engine already started. Only one run per engine.")
+
+        if not lazy:
+            jobs = list(jobs)
+
+        self.thread = threading.Thread(target=self.__loop, args=(jobs, lazy))
+        self.thread.start()
+        if lazy:
+            self.logger.info(f"Async engine started with lazy jobs, concurrency {self.concurrency}")
+        else:
+            self.logger.info(f"Async engine started with {len(jobs)} jobs, concurrency {self.concurrency}")
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of scheduled jobs that aren't done yet.
+        """
+        return self.__open
+
+    def is_alive(self) -> bool:
+        """
+        Check if the event loop is still running.
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def join(self, timeout: float = None):
+        """
+        Wait for the event loop thread to exit.
+        """
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def stop(self):
+        """
+        Wait for the event loop to exit. The loop ends on its own once all jobs are done, present for symmetry with
+        WorkerPool.
+        """
+        self.join()
+
+    def results(self, idle_timeout: float = None):
+        """
+        Generator over the results until the event loop is done. Must be consumed by a single thread.
+
+        :param idle_timeout: seconds without result after which IDLE is handed out, None to wait silently
+        """
+        while True:
+            try:
+                res = self.result_queue.get(timeout=60 if idle_timeout is None else idle_timeout)
+            except queue.Empty:
+                if not self.is_alive():
+                    self.logger.error("Async engine exited without end marker")
+                    break
+                if idle_timeout is not None:
+                    yield IDLE
+                continue
+
+            if isinstance(res, str) and res == FEED_DONE:
+                break
+            yield res
+
+        self.join()
+
+    def submit(self, job: dict):
+        """
+        Schedule an additional job. Must be called from within the event loop (i.e. from a fetch coroutine).
+
+        :param job: job dict
+        """
+        self.__open += 1
+        self.__queue.put_nowait(job)
+
+    def stats_str(self) -> str:
+        """
+        Human readable summary of the request counters for the logs.
+        """
+        return (f"HTTP pool: {self.__requests} requests, {max(self.__requests - self.__connects, 0)} "
+                f"reused connections, {self.__connects} new connections")
+
+    def close(self):
+        """
+        Present for symmetry with SessionPool, the aiohttp session is closed once the event loop is done.
+        """
+        pass
+
+    async def __on_request(self, *args):
+        self.__requests += 1
+
+    async def __on_connect(self, *args):
+        self.__connects += 1
+
+    def __loop(self, jobs: Iterable[dict], lazy: bool):
+        """
+        Thread target, runs the event loop and marks the end of the results.
+        """
+        try:
+            asyncio.run(self.__main(jobs, lazy))
+        except Exception as e:
+            self.logger.exception("Async engine failed", exc_info=e)
+        finally:
+            self.result_queue.put(FEED_DONE)
+
+    async def __main(self, jobs: Iterable[dict], lazy: bool):
+        """
+        Event loop main function. Dispatches jobs while respecting the concurrency cap and returns once all jobs
+        (including those submitted during the run) are done.
+        """
+        self.__queue = asyncio.Queue()
+        producer = None
+
+        if lazy:
+            # the producer counts as an open job until the iterable is exhausted
+            self.__open += 1
+            producer = asyncio.create_task(self.__produce(iter(jobs)))
+        else:
+            for job in jobs:
+                self.submit(job)
+
+        if self.__open == 0:
+            return
+
+        sem = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self.__on_request)
+        trace.on_connection_create_end.append(self.__on_connect)
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency)
+
+        # INFO: Cookies are passed per request (login cookies differ between jobs), don't persist any cookies
+        #   from the responses in the shared session (same as the thread engine).
+        async with aiohttp.ClientSession(connector=connector, trace_configs=[trace],
+                                         cookie_jar=aiohttp.DummyCookieJar()) as session:
+            while True:
+                job = await self.__queue.get()
+
+                # None is enqueued once the last open job is done
+                if job is None:
+                    break
+
+                await sem.acquire()
+                task = asyncio.create_task(self.__run(session, sem, job))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        if producer is not None:
+            await producer
+
+        self.logger.info("Async engine exiting")
+
+    async def __produce(self, jobs: Iterator[dict]):
+        """
+        Submit the jobs of a lazy iterable. next is called in a worker thread, so a blocking iterable doesn't stall
+        the requests in flight.
+        """
+        try:
+            while True:
+                job = await asyncio.to_thread(next, jobs, None)
+                if job is None:
+                    break
+                self.submit(job)
+        except Exception as e:
+            self.logger.exception("Failed to produce jobs", exc_info=e)
+        finally:
+            self.__open -= 1
+            if self.__open == 0:
+                self.__queue.put_nowait(None)
+
+    async def __run(self, session: "aiohttp.ClientSession", sem: asyncio.Semaphore, job: dict):
+        """
+        Execute a single job and put its result in the result queue.
+        """
+        try:
+            result = await self.fetch(session, job, self.submit)
+            if result is not None:
+                try:
+                    self.result_queue.put_nowait(result)
+                except queue.Full:
+                    # backpressure, wait for the db writer without blocking the event loop
+                    await asyncio.to_thread(self.result_queue.put, result)
+        except Exception as e:
+            self.logger.exception(f"Async job failed {job.get('url')}", exc_info=e)
+        finally:
+            sem.release()
+            self.__open -= 1
+            if self.__open == 0:
+                self.__queue.put_nowait(None)
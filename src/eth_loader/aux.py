@@ -1,4 +1,5 @@
 import base64 as b64
+import hashlib
 
 def to_b64(s: str):
     """
@@ -24,4 +25,22 @@ def escape_sql(s: str):
     :param s: string to escape
     :return:
     """
-    return s.replace("'", "''")
\ No newline at end of file
+    return s.replace("'", "''")
+
+
+def json_digest(s: str):
+    """
+    Stable digest of a json string for the json_hash column (unlike hash(), identical across processes and runs)
+    :param s: string to hash
+    :return: 32 character hex digest
+    """
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def is_json_digest(s: str):
+    """
+    Check if a stored json_hash is a digest of json_digest and not a legacy value of hash()
+    :param s: stored json_hash
+    :return:
+    """
+    return s is not None and len(s) == 32 and all(c in "0123456789abcdef" for c in s)
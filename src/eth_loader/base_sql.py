@@ -1,6 +1,50 @@
+import logging
 import os
 from sqlite3 import Connection, Cursor
-from typing import Union
+from typing import Dict, List, Union
+
+"""
+# Performance profiles
+
+Named sets of pragmas applied when a connection is opened. Every stage of a run picks the profile matching its
+access pattern:
+
+- bulk-load: stages inserting / updating many rows (indexer, loaders, deprecation). WAL journal, synchronous=NORMAL
+    (a crash loses at most the last transactions, never corrupts the db), large page cache, temp tables in memory.
+- read-mostly: stages scanning the tables with few writes (increment builder). WAL journal, large memory map.
+- safe: rollback journal and synchronous=FULL. Used for the last stage, so the database is a single file again
+    (no -wal / -shm) when it is copied as a backup or pushed to the server.
+
+The page size only takes effect on a new (empty) database, existing databases keep their page size. The journal mode
+is stored in the database file, the other pragmas are per connection.
+"""
+
+PROFILES = {
+    "bulk-load": {
+        "page_size": 8192,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -256 * 1024,  # negative: KiB -> 256 MiB
+        "mmap_size": 1024 ** 3,
+        "temp_store": "MEMORY",
+    },
+    "read-mostly": {
+        "page_size": 8192,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -128 * 1024,
+        "mmap_size": 4 * 1024 ** 3,
+        "temp_store": "MEMORY",
+    },
+    "safe": {
+        "page_size": 4096,
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+    },
+}
 
 
 class BaseSQliteDB:
@@ -9,49 +53,149 @@ class BaseSQliteDB:
     sq_con: Union[Connection, None]
     sq_cur: Union[Cursor, None]
 
-    def __init__(self, db_path: str):
+    # statement -> list of parameters, executed with executemany by flush_deferred
+    deferred: Dict[str, List[Union[tuple, dict]]]
+
+    def __init__(self, db_path: str, profile: str = None):
         """
         Base class for sqlite3 database access.
 
         :param db_path: path to db
+        :param profile: name of the performance profile (see PROFILES), None to keep the sqlite defaults
         """
         self.db_path = None
         self.sq_con = None
         self.sq_cur = None
+        self.deferred = {}
+        self.profile = None
 
-        self.connect(db_path)
+        self.connect(db_path, profile)
 
 
-    def connect(self, db_path: str):
+    def connect(self, db_path: str, profile: str = None, check_same_thread: bool = True):
         """
         Connect to the database, set the path of the object and create a cursor
+
+        :param db_path: path to db
+        :param profile: name of the performance profile (see PROFILES), None to keep the sqlite defaults
+        :param check_same_thread: only allow the thread creating the connection to use it. Disable for objects
+            handed to another thread, they must never be used by two threads at the same time.
         """
+        if profile is not None and profile not in PROFILES:
+            raise ValueError(f"Profile {profile} not recognized")
+
         self.db_path = os.path.abspath(db_path)
 
-        self.sq_con = Connection(self.db_path)
+        self.sq_con = Connection(self.db_path, check_same_thread=check_same_thread)
         self.sq_cur = self.sq_con.cursor()
 
-    def debug_execute(self, stmt: str):
+        if profile is not None:
+            self.apply_profile(profile)
+
+    def reconnect(self, check_same_thread: bool = True):
+        """
+        Commit, close and open the connection again with the same profile, e.g. to hand the object to another thread.
+
+        :param check_same_thread: see connect
+        :return:
+        """
+        self.flush_deferred()
+        self.sq_con.commit()
+        self.sq_con.close()
+        self.connect(self.db_path, self.profile, check_same_thread=check_same_thread)
+
+    def apply_profile(self, profile: str):
+        """
+        Set the pragmas of a performance profile on the connection. Must be called outside of a transaction.
+
+        :param profile: name of the performance profile (see PROFILES)
+        :return:
+        """
+        pragmas = PROFILES[profile]
+        self.profile = profile
+
+        # page_size before journal_mode, it can't be changed anymore once the db is in WAL mode
+        for pragma in ("page_size", "journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store"):
+            self.debug_execute(f"PRAGMA {pragma} = {pragmas[pragma]}")
+            self.sq_cur.fetchall()
+
+        self.debug_execute("PRAGMA journal_mode")
+        mode = self.sq_cur.fetchone()[0]
+        if mode.upper() != pragmas["journal_mode"]:
+            # Happens if another connection still has the db open
+            logging.getLogger("base_sql").warning(f"Profile {profile}: journal_mode is {mode} instead of "
+                                                  f"{pragmas['journal_mode']}")
+
+    def set_busy_timeout(self, seconds: float):
+        """
+        Time a statement waits for the lock of another connection writing the same database before failing with
+        'database is locked'. Needed if several connections write concurrently (the sqlite3 default is 5s).
+
+        :param seconds: maximum time to wait
+        :return:
+        """
+        self.debug_execute(f"PRAGMA busy_timeout = {int(seconds * 1000)}")
+        self.sq_cur.fetchall()
+
+    def debug_execute(self, stmt: str, params: Union[tuple, dict] = None):
         """
         Function executes statement in database and in case of an exception prints the offending statement.
 
         :param stmt: Statement to execute
+        :param params: Parameters bound to the placeholders of the statement
 
         :return:
         """
         try:
-            self.sq_cur.execute(stmt)
+            if params is None:
+                self.sq_cur.execute(stmt)
+            else:
+                self.sq_cur.execute(stmt, params)
         except Exception as e:
             print(f"Failed to execute:\n{stmt}")
+            if params is not None:
+                print(f"With parameters:\n{params}")
             raise e
 
+    def defer_execute(self, stmt: str, params: Union[tuple, dict]):
+        """
+        Queue a statement for execution with flush_deferred. Only for statements whose result isn't needed and whose
+        effect isn't read before the flush (e.g. last_seen updates, INSERT OR IGNORE of links).
+
+        :param stmt: Statement with placeholders
+        :param params: Parameters bound to the placeholders of the statement
+
+        :return:
+        """
+        self.deferred.setdefault(stmt, []).append(params)
+
+    def flush_deferred(self) -> int:
+        """
+        Execute all deferred statements, one executemany per distinct statement.
+
+        :return: number of rows in the executed statements
+        """
+        rows = 0
+        for stmt, params in self.deferred.items():
+            try:
+                self.sq_cur.executemany(stmt, params)
+            except Exception as e:
+                print(f"Failed to execute:\n{stmt}\nWith {len(params)} parameter sets")
+                raise e
+            rows += len(params)
+
+        self.deferred = {}
+        return rows
+
     def cleanup(self):
         """
         Actions performed:
+        - Execute the deferred statements
         - Commit the changes
         - Close the connection
         - clear the variables
         """
+        self.flush_deferred()
         self.sq_con.commit()
         self.sq_con.close()
 
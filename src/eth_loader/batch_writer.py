@@ -0,0 +1,129 @@
+import logging
+import time
+from typing import Any, Callable, Iterable, List, Tuple
+
+from eth_loader.base_sql import BaseSQliteDB
+from eth_loader.worker_pool import IDLE
+
+"""
+# Batched writer for the dequeue side of the loaders
+
+The loaders have a single consumer thread writing the results of all workers to the database. The writer hands every
+result to the store function of the loader, which executes the statements it needs the outcome of right away
+(lookups, inserts of new records) and defers the rest (last_seen updates, links) with defer_execute.
+
+A batch ends after `batch_size` results or `batch_ms` milliseconds. The results of a batch are collected and applied
+at its end: the results are stored, the deferred statements are executed with one executemany per statement and the
+transaction is committed. The database sees one transaction per batch instead of hundreds of thousands of single
+statements, and the write lock is only held while the batch is applied, not while waiting for the downloads (other
+writers of the same database, like the pipelined loaders, aren't locked out).
+
+Sinks: further databases (e.g. the base64 and the plain database) written from the same results, each with its own
+store function. The downloads happen once, every batch is applied to the sinks first and to the database of the loader
+last, in one transaction per database. The loader may hand the results on to a later stage, which can rely on the
+sinks being written by then.
+"""
+
+
+class BatchWriter:
+    """
+    Drives the consumer loop of a loader, applies the results in batches of one transaction each.
+    """
+    def __init__(self, db: BaseSQliteDB, store: Callable[[Any], None], batch_size: int = 500, batch_ms: int = 1000,
+                 logger_name: str = "thread_handler"):
+        """
+        :param db: database object (loader) the results are written to
+        :param store: function writing a single result, called as store(result). Must not commit.
+        :param batch_size: maximum number of results per transaction
+        :param batch_ms: maximum time in milliseconds a result waits for its transaction to be committed
+        :param logger_name: logger of the owning loader
+        """
+        if batch_size < 1:
+            raise ValueError("Batch size must be greater than 0")
+
+        if batch_ms < 1:
+            raise ValueError("Batch time must be greater than 0")
+
+        self.db = db
+        self.store = store
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self.logger = logging.getLogger(logger_name)
+
+        self.rows = 0
+        self.deferred_rows = 0
+        self.batches = 0
+        self.busy = 0.0
+        self.elapsed = 0.0
+
+        self.sinks: List[Tuple[BaseSQliteDB, Callable[[Any], None]]] = []
+
+        self.__batch = []
+        self.__batch_start = None
+
+    def add_sink(self, db: BaseSQliteDB, store: Callable[[Any], None]):
+        """
+        Write every batch to another database as well.
+
+        :param db: database object of the sink
+        :param store: function writing a single result to the sink, called as store(result). Must not commit.
+        :return:
+        """
+        self.sinks.append((db, store))
+
+    def run(self, results: Iterable[Any]):
+        """
+        Consume all results and write them. Returns once the last batch is committed.
+
+        :param results: results of a WorkerPool or AsyncEngine (IDLE markers are used to end a batch in time)
+        :return:
+        """
+        start = time.perf_counter()
+
+        for res in results:
+            if not (isinstance(res, str) and res == IDLE):
+                if self.__batch_start is None:
+                    self.__batch_start = time.perf_counter()
+                self.__batch.append(res)
+
+            if len(self.__batch) >= self.batch_size:
+                self.flush()
+            elif (self.__batch_start is not None
+                  and (time.perf_counter() - self.__batch_start) * 1000 >= self.batch_ms):
+                self.flush()
+
+        self.flush()
+        self.elapsed += time.perf_counter() - start
+        self.logger.info(self.stats_str())
+
+    def flush(self):
+        """
+        Store the results of the current batch, execute the deferred statements and commit it. Sinks first, the
+        database of the loader last.
+
+        :return:
+        """
+        t = time.perf_counter()
+        for db, store in self.sinks + [(self.db, self.store)]:
+            for res in self.__batch:
+                store(res)
+
+            self.deferred_rows += db.flush_deferred()
+            db.sq_con.commit()
+        self.busy += time.perf_counter() - t
+
+        if len(self.__batch) > 0:
+            self.rows += len(self.__batch)
+            self.batches += 1
+        self.__batch = []
+        self.__batch_start = None
+
+    def stats_str(self) -> str:
+        """
+        Human readable summary of the writer counters for the logs.
+        """
+        rate = self.rows / self.elapsed if self.elapsed > 0 else 0
+        busy_rate = self.rows / self.busy if self.busy > 0 else 0
+        return (f"Writer: {self.rows} results in {self.batches} batches ({self.deferred_rows} deferred rows), "
+                f"{rate:.0f} results/s overall, {busy_rate:.0f} results/s while writing, "
+                f"busy {self.busy:.1f}s of {self.elapsed:.1f}s")
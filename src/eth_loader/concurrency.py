@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import List, Tuple, Union
+
+from eth_loader.rate_limit import RateLimiter
+from eth_loader.retry import error_class
+
+"""
+# Adaptive concurrency of the downloads
+
+The number of workers (threads or requests in flight of the async engine) is the upper bound, AdaptiveConcurrency
+limits how many of them have a request in flight. The limit follows AIMD (additive increase, multiplicative decrease):
+- the completed requests are evaluated in windows of `limit` requests (at least min_window)
+- a healthy window (errors and median latency fine) raises the limit by one
+- a window with too many timeouts or a median latency above latency_factor times the baseline (lowest median seen,
+    drifting slowly towards the current one) lowers it by the factor `decrease`
+- a 429 or 5xx response lowers it right away, at most once per window
+
+The gate works for worker threads (acquire blocks) and for the async engine (acquire_async awaits). The fetch
+functions wrap every request in slot(concurrency, rate_limit, url), which waits for a token of the rate limit (before
+taking a slot, a request waiting for its token doesn't hold one), measures the latency and classifies the outcome.
+"""
+
+BACKOFF = ("throttle", "server", "timeout")
+
+
+class AdaptiveConcurrency:
+    """
+    Resizable gate for the requests of a stage, shared by all workers. Thread-safe.
+    """
+
+    def __init__(self, initial: int = 10, minimum: int = 1, maximum: int = 100, decrease: float = 0.5,
+                 latency_factor: float = 2.0, error_rate: float = 0.05, min_window: int = 10,
+                 log_interval: float = 10.0, logger_name: str = "thread_handler"):
+        """
+        :param initial: limit at the start of the stage
+        :param minimum: lowest limit
+        :param maximum: highest limit, more than the number of workers has no effect
+        :param decrease: factor applied to the limit on backoff
+        :param latency_factor: median latency of a window relative to the baseline that counts as spike
+        :param error_rate: share of timeouts in a window that causes a backoff
+        :param min_window: minimum number of requests per window
+        :param log_interval: seconds between the log messages of the current limit
+        :param logger_name: logger of the owning loader
+        """
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError("Limits must satisfy 1 <= minimum <= initial <= maximum")
+
+        if not 0 < decrease < 1:
+            raise ValueError("Decrease must be between 0 and 1")
+
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.error_rate = error_rate
+        self.min_window = min_window
+        self.log_interval = log_interval
+        self.logger = logging.getLogger(logger_name)
+
+        self.baseline: Union[float, None] = None
+        self.increases = 0
+        self.decreases = 0
+        # (seconds since start, limit) after every change
+        self.history: List[Tuple[float, int]] = [(0.0, initial)]
+
+        self.__cond = threading.Condition()
+        self.__waiters: List[asyncio.Future] = []
+        self.__in_flight = 0
+        self.__latencies: List[float] = []
+        self.__timeouts = 0
+        self.__backed_off = False
+        self.__start = time.monotonic()
+        self.__last_log = self.__start
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Number of requests currently holding a slot.
+        """
+        return self.__in_flight
+
+    def acquire(self):
+        """
+        Take a slot, blocks the calling thread while the limit is reached.
+        """
+        with self.__cond:
+            while self.__in_flight >= self.limit:
+                self.__cond.wait()
+            self.__in_flight += 1
+
+    async def acquire_async(self):
+        """
+        Take a slot, waits without blocking the event loop while the limit is reached.
+        """
+        while True:
+            with self.__cond:
+                if self.__in_flight < self.limit:
+                    self.__in_flight += 1
+                    return
+                waiter = asyncio.get_running_loop().create_future()
+                self.__waiters.append(waiter)
+            await waiter
+
+    def release(self, latency: float, error: str = None):
+        """
+        Return a slot and account the request.
+
+        :param latency: seconds the request took
+        :param error: error class of the request (see retry.error_class), None if it succeeded
+        """
+        with self.__cond:
+            self.__in_flight -= 1
+            self.__observe(latency, error)
+
+            self.__cond.notify_all()
+            free = self.limit - self.__in_flight
+            wake, self.__waiters = self.__waiters[:free], self.__waiters[free:]
+
+        for waiter in wake:
+            waiter.get_loop().call_soon_threadsafe(self.__wake, waiter)
+
+    @staticmethod
+    def __wake(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def __observe(self, latency: float, error: Union[str, None]):
+        """
+        AIMD step, called with the lock held.
+        """
+        self.__latencies.append(latency)
+        if error == "timeout":
+            self.__timeouts += 1
+
+        if error in BACKOFF and error != "timeout" and not self.__backed_off:
+            self.__set_limit(int(self.limit * self.decrease), f"{error} error")
+            self.__backed_off = True
+
+        n = len(self.__latencies)
+        if n < max(self.limit, self.min_window):
+            return
+
+        median = sorted(self.__latencies)[n // 2]
+        if self.__timeouts / n > self.error_rate:
+            self.__set_limit(int(self.limit * self.decrease), f"{self.__timeouts} timeouts in {n} requests")
+        elif self.baseline is not None and median > self.baseline * self.latency_factor:
+            self.__set_limit(int(self.limit * self.decrease),
+                             f"median latency {median:.3f}s, baseline {self.baseline:.3f}s")
+        elif not self.__backed_off:
+            self.__set_limit(self.limit + 1, None)
+
+        if self.baseline is None or median < self.baseline:
+            self.baseline = median
+        else:
+            self.baseline += 0.05 * (median - self.baseline)
+
+        self.__latencies = []
+        self.__timeouts = 0
+        self.__backed_off = False
+
+    def __set_limit(self, limit: int, reason: Union[str, None]):
+        """
+        Change the limit within minimum and maximum, log backoffs right away and the limit every log_interval.
+        """
+        limit = max(self.minimum, min(self.maximum, limit))
+        now = time.monotonic()
+
+        if limit != self.limit:
+            if limit > self.limit:
+                self.increases += 1
+            else:
+                self.decreases += 1
+                self.logger.info(f"Concurrency {self.limit} -> {limit}, backing off after {reason}")
+            self.limit = limit
+            self.history.append((now - self.__start, limit))
+
+        if now - self.__last_log >= self.log_interval:
+            self.__last_log = now
+            self.logger.info(f"Concurrency {self.limit}, {self.__in_flight} requests in flight")
+
+    def stats_str(self) -> str:
+        """
+        Human readable summary of the controller for the logs.
+        """
+        limits = [limit for _, limit in self.history]
+        return (f"Concurrency: final limit {self.limit} (range {min(limits)}-{max(limits)}), "
+                f"{self.increases} increases, {self.decreases} backoffs")
+
+
+class Slot:
+    """
+    Context manager around a single request: waits for a token of the rate limit, takes a slot of the controller,
+    measures the latency and returns the slot with the outcome. Set `error` to the error class of the response before
+    leaving the block, exceptions are classified on their own. Does nothing without controller and rate limit.
+    """
+
+    def __init__(self, concurrency: Union[AdaptiveConcurrency, None], rate_limit: Union[RateLimiter, None] = None,
+                 url: str = None):
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        self.url = url
+        self.error = None
+        # seconds waited for the token
+        self.waited = 0.0
+        self.__start = None
+
+    def __enter__(self):
+        if self.rate_limit is not None:
+            self.waited = self.rate_limit.wait(self.url)
+        if self.concurrency is not None:
+            self.concurrency.acquire()
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        latency = time.perf_counter() - self.__start
+        if self.rate_limit is not None:
+            self.rate_limit.record(latency)
+        if self.concurrency is not None:
+            error = error_class(exc=exc) if exc is not None else self.error
+            self.concurrency.release(latency, error)
+        return False
+
+    async def __aenter__(self):
+        if self.rate_limit is not None:
+            self.waited = await self.rate_limit.wait_async(self.url)
+        if self.concurrency is not None:
+            await self.concurrency.acquire_async()
+        self.__start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+
+def slot(concurrency: Union[AdaptiveConcurrency, None], rate_limit: Union[RateLimiter, None] = None,
+         url: str = None) -> Slot:
+    """
+    Slot of the controller for a single request, see Slot.
+
+    :param concurrency: controller of the stage, None for no limit
+    :param rate_limit: rate limit of the stage, None for no limit
+    :param url: url of the request, selects the token buckets
+    """
+    return Slot(concurrency, rate_limit, url)
@@ -1,12 +1,15 @@
 from eth_loader.base_sql import BaseSQliteDB
 import json
-from eth_loader.aux import from_b64
+from eth_loader.aux import from_b64, json_digest
 
 
 class AddJsonHash(BaseSQliteDB):
     """
     Converter adds a has of the json data to the metadata and episodes table.
     Point being - I can detect possibly identical json based on hash
+
+    Also replaces the legacy hashes (from hash(), randomized per process) with the stable json_digest. Rows with
+    diffs (record_type 1) keep the hash of the full state they were created with.
     """
     def __init__(self, db_path: str, b64: bool = False):
         super().__init__(db_path)
@@ -50,7 +53,10 @@ class AddJsonHash(BaseSQliteDB):
         """
         Populate the hash columns
         """
-        self.debug_execute(f"SELECT key, json FROM {tbl} WHERE json_hash is NULL")
+        stmt = (f"SELECT key, json FROM {tbl} "
+                f"WHERE key > ? AND (json_hash is NULL OR (record_type IS NOT 1 AND length(json_hash) != 32)) "
+                f"ORDER BY key ASC")
+        self.debug_execute(stmt, (-1,))
         res = self.sq_cur.fetchone()
 
         while res:
@@ -64,10 +70,10 @@ class AddJsonHash(BaseSQliteDB):
                 print(f"Error decoding {tbl} key {key} json {json_string}")
                 sorted_string = json_string
 
-            json_hash = hash(sorted_string)
-            self.debug_execute(f"UPDATE {tbl} SET json_hash = '{json_hash}' WHERE key = {key}")
+            json_hash = json_digest(sorted_string)
+            self.debug_execute(f"UPDATE {tbl} SET json_hash = ? WHERE key = ?", (json_hash, key))
 
-            self.debug_execute(f"SELECT key, json FROM {tbl} WHERE json_hash is NULL")
+            self.debug_execute(stmt, (key,))
             res = self.sq_cur.fetchone()
 
 
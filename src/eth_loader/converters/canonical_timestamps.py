@@ -0,0 +1,64 @@
+from eth_loader.base_sql import BaseSQliteDB
+
+
+class CanonicalTimestamps(BaseSQliteDB):
+    """
+    Converter rewrites found and last_seen of all tables into the canonical form YYYY-MM-DD HH:MM:SS (what datetime()
+    of sqlite returns). The loaders compare the columns directly (last_seen >= '...') instead of
+    datetime(last_seen) >= datetime('...'), so the indexes on last_seen can be used. Values in any other format
+    (fractional seconds, T separator, ...) would be compared as plain text otherwise.
+
+    Values sqlite can't parse (e.g. the 'dummy' row of the streams table) are left as they are.
+    """
+    tables = ("sites", "metadata", "episodes", "streams")
+    columns = ("found", "last_seen")
+
+    def __init__(self, db_path: str):
+        super().__init__(db_path)
+
+    def convert(self):
+        """
+        Convert the tables and create the indexes on the timestamps
+        """
+        for tbl in self.tables:
+            for col in self.columns:
+                self._convert_column(tbl, col)
+
+        self.create_indexes()
+
+    def _convert_column(self, tbl: str, col: str):
+        """
+        Rewrite a single timestamp column
+        """
+        self.debug_execute(f"SELECT COUNT(key) FROM {tbl} WHERE {col} IS NOT NULL AND datetime({col}) IS NULL")
+        invalid = self.sq_cur.fetchone()[0]
+        if invalid > 0:
+            print(f"{tbl}.{col}: {invalid} values can't be parsed, leaving them unchanged")
+
+        self.debug_execute(f"UPDATE {tbl} SET {col} = datetime({col}) WHERE {col} != datetime({col})")
+        print(f"{tbl}.{col}: converted {self.sq_cur.rowcount} values")
+        self.sq_con.commit()
+
+    def create_indexes(self):
+        """
+        Create the indexes on the timestamps (identical to the ones created by the loaders)
+        """
+        print("Creating indexes")
+        self.debug_execute("CREATE INDEX IF NOT EXISTS site_video_last_seen_index ON sites (IS_VIDEO, last_seen)")
+        self.debug_execute("CREATE INDEX IF NOT EXISTS metadata_last_seen_index ON metadata (last_seen)")
+        self.debug_execute("CREATE INDEX IF NOT EXISTS metadata_type_last_seen_index "
+                           "ON metadata (record_type, last_seen)")
+        self.debug_execute("CREATE INDEX IF NOT EXISTS episodes_last_seen_index ON episodes (last_seen)")
+        self.debug_execute("CREATE INDEX IF NOT EXISTS episodes_type_last_seen_index "
+                           "ON episodes (record_type, last_seen)")
+        self.debug_execute("CREATE INDEX IF NOT EXISTS streams_last_seen_index ON streams (last_seen)")
+        self.sq_con.commit()
+
+
+if __name__ == "__main__":
+    # path = "/home/alisot2000/Documents/01_ReposNCode/eth-video-indexer/scripts/seq_sites.db"
+    path = "/home/alisot2000/Documents/01_ReposNCode/eth-video-indexer/scripts/seq_sites_b64.db"
+
+    cts = CanonicalTimestamps(path)
+    cts.convert()
+    cts.cleanup()
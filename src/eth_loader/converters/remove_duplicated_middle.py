@@ -1,5 +1,6 @@
 import sys
 
+from eth_loader.aux import json_digest
 from eth_loader.base_sql import BaseSQliteDB
 
 
@@ -22,8 +23,7 @@ class MiddlePruner(BaseSQliteDB):
         while row_0 is not None:
             key = row_0[0]
             json = row_0[1]
-            json = json.replace("'", "''")
-            self.debug_execute(f"INSERT INTO hash_table VALUES ({key}, '{hash(json)}')")
+            self.debug_execute("INSERT INTO hash_table VALUES (?, ?)", (key, json_digest(json)))
             print(f"Processed {key}", flush=True, end="\r")
             self.debug_execute(f"SELECT key, json FROM episodes WHERE key > {key} ORDER BY key ASC")
             row_0 = self.sq_cur.fetchone()
@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Union
+
+from requests.cookies import RequestsCookieJar
+
+"""
+# Login cookies of the series with a specific login
+
+All episodes of a series share the login cookie of the series, the cache logs in once per series (the first episode
+of the series enqueued) and hands the same cookie jar to all jobs of the series, by reference. The jars in the cache
+are never modified once handed out, a new login creates a new jar.
+
+An entry expires after `ttl` seconds or when the first of its cookies expires, the next job of the series logs in
+again. A download answered with 401 / 403 calls refresh: the login is repeated once for all jobs holding the stale
+jar, jobs arriving later with the same stale jar get the new one. A series whose login was refreshed less than
+`min_interval` seconds ago isn't logged in again (wrong credentials or no access would log in for every episode). The
+same holds for a failed login (no jar): get returns None (the caller falls back to the cookies it has without the
+login) until `min_interval` seconds passed.
+"""
+
+Login = Callable[[], Union[RequestsCookieJar, None]]
+
+
+class _Entry:
+    def __init__(self, login: Login):
+        self.login = login
+        self.jar: Union[RequestsCookieJar, None] = None
+        self.expires = 0.0
+        self.logged_in = None
+        self.lock = threading.Lock()
+
+
+class CookieCache:
+    """
+    Login cookie jar per series url. Thread-safe, logins of different series don't block each other.
+    """
+
+    def __init__(self, ttl: float = 3600, min_interval: float = 30, logger_name: str = "stream_loader"):
+        """
+        :param ttl: seconds a login is used at most
+        :param min_interval: minimum seconds between two logins of the same series triggered by 401 / 403 or after a
+            failed login
+        :param logger_name: logger of the owning loader
+        """
+        if ttl <= 0:
+            raise ValueError("TTL must be greater than 0")
+
+        self.ttl = ttl
+        self.min_interval = min_interval
+        self.logger = logging.getLogger(logger_name)
+
+        self.__lock = threading.Lock()
+        self.__entries: Dict[str, _Entry] = {}
+
+        self.logins = 0
+        self.hits = 0
+        self.refreshes = 0
+
+    def __entry(self, key: str, login: Login = None) -> Union[_Entry, None]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None and login is not None:
+                entry = self.__entries[key] = _Entry(login)
+            return entry
+
+    def __login(self, key: str, entry: _Entry):
+        """
+        Log in and store the jar, called with the lock of the entry held.
+        """
+        jar = entry.login()
+        now = time.time()
+
+        # cookies of the jar expiring before the ttl
+        expiries: List[float] = [c.expires for c in jar if c.expires is not None] if jar is not None else []
+        entry.jar = jar
+        entry.expires = min([now + self.ttl] + expiries)
+        entry.logged_in = now
+
+        with self.__lock:
+            self.logins += 1
+        self.logger.debug(f"Logged in for {key}")
+
+    def get(self, key: str, login: Login) -> Union[RequestsCookieJar, None]:
+        """
+        Cookie jar of a series, logs in if there's none or it expired. After a failed login (no jar) the series is
+        logged in again once min_interval seconds passed.
+
+        :param key: url of the series (or episode) without file extension
+        :param login: performs the login, returns the cookie jar. Stored with the entry and used for refresh.
+        :return: cookie jar, shared with all other jobs of the series, None if the login failed. Don't modify it.
+        """
+        entry = self.__entry(key, login)
+        with entry.lock:
+            now = time.time()
+            if entry.logged_in is None:
+                due = True
+            elif entry.jar is None:
+                due = now - entry.logged_in >= self.min_interval
+            else:
+                due = now >= entry.expires
+
+            if due:
+                self.__login(key, entry)
+            else:
+                with self.__lock:
+                    self.hits += 1
+            return entry.jar
+
+    def refresh(self, key: str, stale: Union[RequestsCookieJar, None]) -> Union[RequestsCookieJar, None]:
+        """
+        Log in again after the jar was refused (401 / 403). Only once for all holders of the same stale jar.
+
+        :param key: url of the series (or episode) without file extension
+        :param stale: jar the request was refused with
+        :return: new jar, the stale one if the login of the series was refreshed too recently or failed
+        """
+        entry = self.__entry(key)
+        if entry is None:
+            return stale
+
+        with entry.lock:
+            # after a failed login the holders use fallback cookies, not the (missing) jar of the entry
+            if (entry.jar is stale or entry.jar is None) and time.time() - entry.logged_in >= self.min_interval:
+                self.logger.info(f"Login for {key} refused, logging in again")
+                self.__login(key, entry)
+                with self.__lock:
+                    self.refreshes += 1
+            return entry.jar if entry.jar is not None else stale
+
+    def stats_str(self) -> str:
+        """
+        Human readable summary of the cache for the logs.
+        """
+        with self.__lock:
+            return (f"Cookie cache: {len(self.__entries)} series, {self.logins} logins ({self.refreshes} after "
+                    f"401 / 403), {self.hits} reused")
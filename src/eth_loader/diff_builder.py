@@ -1,19 +1,92 @@
+import functools
 import json
 import logging
-import multiprocessing as mp
 import os
 from datetime import datetime
-from typing import List, Tuple
-import queue
+from typing import List, Tuple, Union
 
-import time
 import jsondiff as jd
 
 import eth_loader.aux as aux
 from eth_loader.base_sql import BaseSQliteDB
+from eth_loader.keyframes import Keyframes
+from eth_loader.worker_pool import WorkerPool
 
 
-def build_diff(_b64: bool, target: dict, candidate: dict, tbl: str):
+"""
+# Diff workers
+
+The parent process loads the arguments of the targets (record_type NULL) and hands them to the worker processes in
+chunks of `chunk` targets per message. A worker diffs the targets of a chunk and returns one compact result tuple
+per target (see build_diff), the parent applies all results of a chunk with one executemany per statement and commits
+them together. The columns of the new final record which are copied from the target (URL, parent, found, json_hash)
+never travel through the queues, they're read from the target row by the statements.
+"""
+
+# (target key, json of the final record, json of the diff, key of the final record to update, None to insert one)
+DiffResult = Tuple[int, str, str, Union[int, None]]
+
+# Diff of identical documents
+EMPTY_DIFF = "{}"
+
+# Differ of jsondiff.diff(load=True, dump=True) without the loading and dumping
+_differ = jd.JsonDiffer()
+
+
+def _subtree_diff(a, b):
+    """
+    Diff of two parsed documents in the compact syntax of jsondiff, not marshalled. Nested dicts are descended
+    and equal values skipped, jsondiff only runs on the values that differ.
+
+    Exact for dicts: jsondiff emits the changed keys of a dict, the added keys and the removed keys, unless the two
+    dicts have no key in common (replace) which is left to jsondiff. The similarity of a value only decides whether
+    the value is listed as changed, i.e. whether it differs. Lists aren't descended, the similarity of their items
+    decides which items jsondiff matches.
+    """
+    if not (isinstance(a, dict) and isinstance(b, dict)) or a.keys().isdisjoint(b.keys()):
+        return _differ.diff(a, b)
+
+    changed = {}
+    removed = []
+    for k, v in a.items():
+        if k not in b:
+            removed.append(k)
+            continue
+
+        w = b[k]
+        if v == w:
+            continue
+
+        changed[k] = _subtree_diff(v, w) if isinstance(v, dict) and isinstance(w, dict) else _differ.diff(v, w)
+
+    for k, w in b.items():
+        if k not in a:
+            changed[k] = w
+
+    if removed:
+        changed[jd.delete] = removed
+    return changed
+
+
+def regular_diff(candidate_json: str, target_json: str) -> str:
+    """
+    Diff between two json documents as stored in the incremental records, byte-identical to
+    json.dumps(json.loads(jd.diff(candidate_json, target_json, load=True, dump=True)), sort_keys=True).
+
+    :param candidate_json: json of the older record
+    :param target_json: json of the new record
+    :return: diff with sorted keys
+    """
+    if candidate_json == target_json:
+        return EMPTY_DIFF
+
+    d = _subtree_diff(json.loads(candidate_json), json.loads(target_json))
+
+    # Dumped and loaded once more like jsondiff's output: positions of list diffs become string keys
+    return json.dumps(json.loads(json.dumps(_differ.marshal(d))), sort_keys=True)
+
+
+def build_diff(_b64: bool, target: dict, candidate: dict, tbl: str) -> DiffResult:
     # Asserts about the table
     assert tbl in ["episodes", "metadata"], f"Table {tbl} not recognized"
     assert set(target.keys()) == {'json', 'parent', 'url', 'found', 'json_hash', 'key'}
@@ -25,92 +98,55 @@ def build_diff(_b64: bool, target: dict, candidate: dict, tbl: str):
         assert target['parent'] is not None, "Parent must not be None for metadata"
 
 
-    assert set(candidate.keys()) == {'json_raw', 'record_type', 'key'}
+    assert set(candidate.keys()) == {'json_raw', 'record_type', 'key', 'json_hash'}
 
     t = target
     c = candidate
-    res = []
 
     # Conglomerate the json
     tgt_json = aux.from_b64(t['json']) if _b64 else t['json']
     c_json = aux.from_b64(c['json_raw']) if _b64 else c['json_raw']
 
-    # Compute the diff
-    json_diff = jd.diff(c_json, tgt_json, load=True, dump=True)
-
-    # Regularize Json
-    reg_json_diff = json.dumps(json.loads(json_diff), sort_keys=True)
+    # Compute the diff, identical documents (same digest) don't need to be parsed
+    if aux.is_json_digest(t['json_hash']) and t['json_hash'] == c['json_hash']:
+        reg_json_diff = EMPTY_DIFF
+    else:
+        reg_json_diff = regular_diff(c_json, tgt_json)
 
-    # Back convert to matching format
-    diff_json_out = aux.to_b64(reg_json_diff) if _b64 else reg_json_diff.replace("'", "''")
-    tgt_json_out = aux.to_b64(tgt_json) if _b64 else tgt_json.replace("'", "''")
+    # Back convert to matching format, the statements bind the values so no quoting needed
+    diff_json_out = aux.to_b64(reg_json_diff) if _b64 else reg_json_diff
+    tgt_json_out = aux.to_b64(tgt_json) if _b64 else tgt_json
 
-    # Case 1: record_type 0, compute diff, and add a new final record, store diff in new incremental (now null)
+    # Case 1: record_type 0, add a new final record
     if c['record_type'] == 0:
-        # INFO: Don't add an entry in the found column as this needs to be empty per definition of the
-        #   final record.
-        if tbl == "episodes":
-            res.append(f"INSERT INTO episodes "
-                               f"(URL, json, last_seen, record_type, json_hash) "
-                               f"VALUES ('{t['url']}', '{tgt_json_out}', '{t['found']}', 2, {t['json_hash']})")
-        elif tbl == "metadata":
-            res.append(f"INSERT INTO metadata "
-                               f"(parent, URL, json, last_seen, record_type, json_hash) "
-                               f"VALUES ({t['parent']}, '{t['url']}', '{tgt_json_out}',"
-                               f" '{t['found']}', 2, {t['json_hash']})")
-        else:
-            raise ValueError(f"Table {tbl} not recognized")
+        final_key = None
 
-    # Case 2: compute diff between final and target, store diff in new incremental, update null to incremental
-    # store new json in final, update final
+    # Case 2: store new json in the final record, update final
     else:
         assert c['record_type'] == 2, f"Record type is {c['record_type']}, expected 2"
+        final_key = c['key']
+
+    # In both cases the target is turned into the incremental record holding the diff
+    return t['key'], tgt_json_out, diff_json_out, final_key
 
-        # Update the final record with the new json
-        res.append(f"UPDATE {tbl} SET json = '{tgt_json_out}', last_seen = '{t['found']}', "
-                           f"json_hash = '{t['json_hash']}' WHERE key = {c['key']}")
+def diff_handler(worker_id: int, data: List[dict], tbl: str, b64: bool) -> List[DiffResult]:
+    """
+    Job function that is executed in multiple processes to perform the diff of the json of a chunk of targets.
 
-    # Update the null record to incremental and store the diff in place of the full json
-    res.append(f"UPDATE {tbl} "
-                       f"SET json ='{diff_json_out}', record_type = 1 WHERE key = {t['key']}")
+    :return: result tuple per target, targets whose diff failed are left out (they keep record_type NULL)
+    """
+    logger = logging.getLogger("increment_builder")
+    res = []
 
-    return res
+    # perform the diff for these rows.
+    for args in data:
+        try:
+            res.append(build_diff(_b64=b64, target=args['target'], candidate=args['candidate'], tbl=tbl))
+        except Exception as e:
+            logger.error(f"{worker_id:02}: Error: {e}", exc_info=e)
+            logger.debug(f"{worker_id:02}: Data: {args}")
 
-def diff_handler(worker_id: int, in_q: mp.Queue, out_q: mp.Queue, tbl: str, b64: bool):
-        """
-        Handler function that is executed in multiple processes to perform the diff of the json.
-        """
-        logger = logging.getLogger("increment_builder")
-        local_logger = logging.getLogger("thread_handler")
-        local_logger.info(f"{worker_id:02}: Started")
-
-        # timeout of 60s
-        count = 0
-        while count < 60:
-            try:
-                data: dict | None = in_q.get(block=False)
-                count = 0
-            except queue.Empty:
-                count += 1
-                time.sleep(1)
-                continue
-
-            # enqueue Nones to indicate we're done.
-            if data is None:
-                break
-
-            # perform the diff for these rows.
-            try:
-                stmts = build_diff(_b64=b64, target=data['target'], candidate=data['candidate'], tbl=tbl)
-            except Exception as e:
-                logger.error(f"{worker_id:02}: Error: {e}", exc_info=e)
-                logger.debug(f"{worker_id:02}: Data: {data}")
-                out_q.put([])
-                continue
-
-            out_q.put(stmts)
-
-        local_logger.info(f"{worker_id:02}: exiting...")
+    return res
 
 
 class IncrementBuilder(BaseSQliteDB):
@@ -118,25 +154,31 @@ class IncrementBuilder(BaseSQliteDB):
     Given a database which has newly added objects with a NULL record_type, this class will build the diff,
     update the final and set the new diff record.
     """
-    workers: List[mp.Process] | None = None
+    pool: WorkerPool | None = None
     task_count: int = -1
-    cmd_queue = mp.Queue()
-    result_queue = mp.Queue()
 
     timeout: int
     __parallel: bool = True
 
-    def __init__(self, db_path: str, b64: bool, start_dt: datetime, workers: int = None, timeout: int = 300):
+    def __init__(self, db_path: str, b64: bool, start_dt: datetime, workers: int = None, timeout: int = 300,
+                 profile: str = None, prefetch: int = 256, chunk: int = 16, keyframe_every: int = None,
+                 keyframe_size: int = None):
         """
         Initialize the class with the database path and the base64
 
         :param db_path: Path to the database
         :param b64: If the json is base64 encoded
         :param workers: Number of workers to use
-        :param timeout: Timeout for ending draining pipeline
+        :param timeout: Seconds after which a waiting builder checks that the workers are still alive
         :param start_dt: Start date of the database
+        :param profile: sqlite performance profile of the connection (see base_sql.PROFILES), None for the defaults
+        :param prefetch: number of targets whose arguments are loaded with a single query
+        :param chunk: number of targets handed to a worker per message
+        :param keyframe_every: write a keyframe of an url after this many diffs (see keyframes), None for no limit
+        :param keyframe_size: write a keyframe of an url once its diffs since the last one exceed this many
+            characters, None for no limit. No keyframes are written if both are None.
         """
-        super().__init__(db_path=db_path)
+        super().__init__(db_path=db_path, profile=profile)
         self.ub64 = b64
         self.logger = logging.getLogger("increment_builder")
         self.start_dt = start_dt
@@ -151,6 +193,18 @@ class IncrementBuilder(BaseSQliteDB):
 
         self.timeout = timeout
 
+        if prefetch < 1:
+            raise ValueError("Prefetch must be greater than 0")
+        self.prefetch = prefetch
+
+        if chunk < 1:
+            raise ValueError("Chunk must be greater than 0")
+        self.chunk = chunk
+
+        self.keyframes = None
+        if keyframe_every is not None or keyframe_size is not None:
+            self.keyframes = Keyframes(self, b64=b64, every=keyframe_every, max_size=keyframe_size)
+
     def build_increment_metadata(self):
         """
         Build the increment for the metadata table
@@ -160,6 +214,9 @@ class IncrementBuilder(BaseSQliteDB):
         else:
             self._sequential_metadata_diff_builder()
 
+        if self.keyframes is not None:
+            self.keyframes.write("metadata")
+
     def build_increment_episodes(self):
         """
         Build the increment for the episodes table
@@ -169,6 +226,9 @@ class IncrementBuilder(BaseSQliteDB):
         else:
             self._sequential_episode_diff_builder()
 
+        if self.keyframes is not None:
+            self.keyframes.write("episodes")
+
     # ==================================================================================================================
     # Private functions to handle the busines of the class
     # ==================================================================================================================
@@ -177,34 +237,13 @@ class IncrementBuilder(BaseSQliteDB):
         """
         Start the workers for multiprocessed diffing
         """
-        if self.workers is not None:
+        if self.pool is not None:
             raise ValueError("workers aren't none. Only one process at a time.")
 
-        self.workers = [mp.Process(target=diff_handler, args=(i, self.cmd_queue, self.result_queue, tbl, self.ub64))
-                        for i in range(self.task_count)]
-
-        for worker in self.workers:
-            worker.start()
-
-    def _is_one_alive(self):
-        """
-        Check if at least one of the workers is still alive
-        """
-        alive = False
-        for i in range(len(self.workers)):
-            worker = self.workers[i]
-            alive = worker.is_alive() or alive
-            if worker.is_alive():
-                self.logger.debug(f"Worker: {i} is still alive")
-
-        return alive
-
-    def _send_stop(self):
-        """
-        Send stop signal to workers
-        """
-        for _ in range(self.task_count):
-            self.cmd_queue.put(None)
+        self.pool = WorkerPool(job_fn=functools.partial(diff_handler, tbl=tbl, b64=self.ub64),
+                               workers=self.task_count, processes=True, logger_name="increment_builder",
+                               liveness_interval=self.timeout)
+        self.pool.start()
 
     def _stop_workers(self):
         """
@@ -212,95 +251,182 @@ class IncrementBuilder(BaseSQliteDB):
 
         All workers have exited once this function returns
         """
-        for w in self.workers:
+        self.pool.stop()
+        for w in self.pool.workers:
             if w.is_alive():
                 print(f"Worker was still alive. Killing")
                 w.kill()
 
             w.join()
 
-        self.workers = None
+        self.pool = None
+
+    def _execute_diff(self, res: List[DiffResult] | None, tbl: str) -> int:
+        """
+        Apply the results of a chunk produced by a worker, one executemany per statement, committed together.
+
+        :return: number of targets applied
+        """
+        # Job failed in the pool itself
+        if res is None:
+            return 0
+
+        # INFO: We want to check for type list not an instance of list.
+        assert type(res) == list, f"Expected list, got {type(res)}"
+        if len(res) == 0:
+            return 0
+
+        if tbl == "episodes":
+            columns = "URL"
+        elif tbl == "metadata":
+            columns = "parent, URL"
+        else:
+            raise ValueError(f"Table {tbl} not recognized")
+
+        inserts = []
+        updates = []
+        diffs = []
+        for key, final_json, diff_json, final_key in res:
+            if final_key is None:
+                inserts.append((final_json, key))
+            else:
+                updates.append((final_json, key, final_key))
+            diffs.append((diff_json, key))
+
+        try:
+            # New final record, copies the columns of the target. INFO: Don't add an entry in the found column as
+            #   this needs to be empty per definition of the final record.
+            self.sq_cur.executemany(f"INSERT INTO {tbl} ({columns}, json, last_seen, record_type, json_hash) "
+                                    f"SELECT {columns}, ?, found, 2, json_hash FROM {tbl} WHERE key = ?", inserts)
+
+            # Update the final record with the new json
+            self.sq_cur.executemany(f"UPDATE {tbl} SET json = ?, (last_seen, json_hash) = "
+                                    f"(SELECT found, json_hash FROM {tbl} WHERE key = ?) WHERE key = ?", updates)
+
+            # Update the null record to incremental and store the diff in place of the full json
+            self.sq_cur.executemany(f"UPDATE {tbl} SET json = ?, record_type = 1 WHERE key = ?", diffs)
+        except Exception as e:
+            print(f"Failed to apply the diffs of the keys {[r[0] for r in res]} in {tbl}")
+            raise e
+
+        self.sq_con.commit()
+        return len(res)
 
     def _generic_parallel_diff_builder(self, tbl: str):
         """
         Perform the parallel diff building
         """
-        # Check preconditions for the function
-        if not self.result_queue.empty() or not self.cmd_queue.empty():
-            assert False, "Queue not empty, should be empty when this function is called"
-
         # Get the rows
         self.debug_execute(f"SELECT key FROM {tbl} WHERE record_type IS NULL ORDER BY LENGTH(json) DESC")
         keys = [r[0] for r in self.sq_cur.fetchall()]
 
-        # Update the number of processes
-        if len(keys) < self.task_count:
-            self.task_count = len(keys)
-
         self.logger.info(f"Building differential records for {len(keys)} entries in {tbl}")
+        if len(keys) == 0:
+            return
 
-        # Prefill queue
-        for x in range(self.task_count):
-            self.cmd_queue.put(self._get_args(keys.pop(0), tbl))
+        # Update the number of processes, one chunk per worker at least
+        chunks = -(-len(keys) // self.chunk)
+        if chunks < self.task_count:
+            self.task_count = chunks
 
-        # Start the workers with filled queue
         self._start_workers(tbl=tbl)
+        results = self.pool.results()
+        done = object()
 
-        count = 0
         progress = 0
         rep_progress = 0
 
-        while len(keys) > 0 and count < self.timeout:
-            try:
-                res = self.result_queue.get(block=False)
-                count = 0
-            except queue.Empty:
-                time.sleep(1)
-                count += 1
-                continue
-
-            # INFO: We want to check for type list not an instance of list.
-            assert type(res) == list, f"Expected list, got {type(res)}"
-
-            # Add a new argument
-            self.cmd_queue.put(self._get_args(keys.pop(0), tbl))
+        # The arguments of a chunk of keys are loaded with one query, not two per key
+        for i in range(0, len(keys), self.prefetch):
+            args = self._prefetch_args(keys[i:i + self.prefetch], tbl)
+            for j in range(0, len(args), self.chunk):
+                # The arguments contain the full json, only keep one chunk per worker in flight (plus the one being
+                # added)
+                while self.pool.pending >= self.task_count:
+                    res = next(results, done)
+                    if res is done:
+                        self.logger.error(f"Workers exited, aborting with {self.pool.pending} pending in {tbl}")
+                        self._stop_workers()
+                        return
+
+                    progress += self._execute_diff(res, tbl)
+
+                    # Logging of progress
+                    if progress - rep_progress > 100:
+                        self.logger.info(f"Done with {progress} entries")
+                        rep_progress = progress
+
+                self.pool.submit(args[j:j + self.chunk])
+
+        # Drain the remaining results, returns once the last one is written
+        self.pool.close()
+        for res in results:
+            self._execute_diff(res, tbl)
 
-            # Execute Statements for results
-            for stmt in res:
-                # INFO: We want to check for type list not an instance of list.
-                assert type(stmt) == str, f"Expected str, got {type(stmt)}"
-                self.debug_execute(stmt)
+        self._stop_workers()
 
-            progress += 1
+    def _prefetch_args(self, keys: List[int], tbl: str) -> List[dict]:
+        """
+        Get the arguments for the concurrent program of several keys with three queries instead of two per key.
+        Equivalent to _get_args for every key: the candidate of a target is the record with the same URL (and parent
+        for metadata) and the highest record_type of 0, 1, 2.
 
-            # Logging of progress
-            if progress - rep_progress > 100:
-                self.logger.info(f"Done with {progress} entries")
-                rep_progress = progress
+        The candidates are picked on the keys and record types only (covered by the URL index), the json is only
+        loaded for the picked ones. A single window function query over the joined tables is planned as a scan by
+        sqlite and is slower than the lookups per key.
 
-        # Stop the workers
-        self._send_stop()
+        :param keys: keys of the targets (record_type NULL)
+        :param tbl: table of the targets
+        :return: arguments in the order of the keys
+        """
+        if tbl == "episodes":
+            parent = "NULL"
+        elif tbl == "metadata":
+            parent = "parent"
+        else:
+            raise ValueError(f"Table {tbl} not recognized")
 
-        counter = 0
+        marks = ", ".join("?" for _ in keys)
+        self.debug_execute(f"SELECT key, json, {parent}, URL, found, json_hash FROM {tbl} WHERE key IN ({marks})",
+                           tuple(keys))
+        targets = {r[0]: {"json": r[1], "parent": r[2], "url": r[3], "found": r[4], "json_hash": r[5], "key": r[0]}
+                   for r in self.sq_cur.fetchall()}
+        assert len(targets) == len(keys), f"Expected {len(keys)} rows for key query, got {len(targets)}"
+
+        # Highest record_type per (URL, parent), lowest key among equal record types
+        urls = list({t["url"] for t in targets.values()})
+        marks = ", ".join("?" for _ in urls)
+        self.debug_execute(f"SELECT URL, {parent}, key, record_type FROM {tbl} "
+                           f"WHERE URL IN ({marks}) AND record_type IN (0, 1, 2)", tuple(urls))
+        best = {}
+        for url, par, key, record_type in self.sq_cur.fetchall():
+            current = best.get((url, par))
+            if current is None or (-record_type, key) < (-current[1], current[0]):
+                best[(url, par)] = (key, record_type)
+
+        picked = list({best[(t["url"], t["parent"])][0] for t in targets.values() if (t["url"], t["parent"]) in best})
+        marks = ", ".join("?" for _ in picked)
+        self.debug_execute(f"SELECT key, json, json_hash FROM {tbl} WHERE key IN ({marks})", tuple(picked))
+        candidate_rows = {r[0]: r for r in self.sq_cur.fetchall()}
+
+        found = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
+        args = []
+        for key in keys:
+            target = targets[key]
+            pick = best.get((target["url"], target["parent"]))
+            assert pick is not None, f"Expected one candidate, got none for key {key} in table {tbl}"
 
-        # Wait for the workers to finish, and queue to empty
-        while (self._is_one_alive() or not self.result_queue.empty()) and counter < self.timeout:
-            try:
-                res = self.result_queue.get(block=False)
-                counter = 0
-            except queue.Empty:
-                time.sleep(1)
-                counter += 1
-                continue
+            row = candidate_rows[pick[0]]
+            candidate = {"key": pick[0], "json_raw": row[1], "record_type": pick[1], "json_hash": row[2]}
 
-            assert type(res) == list, f"Expected list, got {type(res)}"
+            # Printing information about mismatching start_dt
+            if target["found"] != found:
+                self.logger.warning(f"Entry with mismatching found date. Database not saved properly?, "
+                                    f"found {target['found']}")
 
-            # Execute Statements for results
-            for stmt in res:
-                assert type(stmt) == str, f"Expected str, got {type(stmt)}"
-                self.debug_execute(stmt)
+            args.append({"target": target, "candidate": candidate})
 
-        self._stop_workers()
+        return args
 
     def _get_args(self, key: int, tbl: str):
         """
@@ -322,7 +448,7 @@ class IncrementBuilder(BaseSQliteDB):
                        "parent": None}
 
             # Get the next candidate for the differential record
-            self.debug_execute(f"SELECT key, json, record_type "
+            self.debug_execute(f"SELECT key, json, record_type, json_hash "
                                f"FROM episodes WHERE URL = '{target['url']}' AND record_type IN (0, 1, 2) "
                                f"ORDER BY record_type DESC LIMIT 1")
 
@@ -345,7 +471,7 @@ class IncrementBuilder(BaseSQliteDB):
             }
 
             # Get the information about the candidate
-            self.debug_execute(f"SELECT key, json, record_type "
+            self.debug_execute(f"SELECT key, json, record_type, json_hash "
                                f"FROM metadata WHERE URL = '{target['url']}' AND parent = {target['parent']} "
                                f"AND record_type IN (0, 1, 2) "
                                f"ORDER BY record_type DESC LIMIT 1")
@@ -356,7 +482,7 @@ class IncrementBuilder(BaseSQliteDB):
             raise ValueError(f"Table {tbl} not recognized")
 
         # Fetch the candidate information and return
-        candidate = {"key": raw[0][0], "json_raw": raw[0][1], "record_type": raw[0][2]}
+        candidate = {"key": raw[0][0], "json_raw": raw[0][1], "record_type": raw[0][2], "json_hash": raw[0][3]}
 
         # Printing information about mismatching start_dt
         if target["found"] != self.start_dt.strftime("%Y-%m-%d %H:%M:%S"):
@@ -402,7 +528,7 @@ class IncrementBuilder(BaseSQliteDB):
                 #   final record.
                 self.debug_execute(f"INSERT INTO episodes "
                                    f"(URL, json, last_seen, record_type, json_hash) "
-                                   f"VALUES ('{t['url']}', '{tgt_json_out}', '{t['found']}', 2, {t['json_hash']})")
+                                   f"VALUES ('{t['url']}', '{tgt_json_out}', '{t['found']}', 2, '{t['json_hash']}')")
 
             # Case 2: compute diff between final and target, store diff in new incremental, update null to incremental
             # store new json in final, update final
@@ -445,7 +571,7 @@ class IncrementBuilder(BaseSQliteDB):
                 self.debug_execute(f"INSERT INTO metadata "
                                    f"(parent, URL, json, last_seen, record_type, json_hash) "
                                    f"VALUES ({t['parent']}, '{t['url']}', '{tgt_json_out}',"
-                                   f" '{t['found']}', 2, {t['json_hash']})")
+                                   f" '{t['found']}', 2, '{t['json_hash']}')")
 
             # Case 2: compute diff between final and target, store diff in incremental,
             # store new json in final, update final
@@ -476,10 +602,7 @@ class IncrementBuilder(BaseSQliteDB):
         c_json = aux.from_b64(candidate_json) if self.ub64 else candidate_json
 
         # Compute the diff
-        json_diff = jd.diff(c_json, tgt_json, load=True, dump=True)
-
-        # Regularize Json
-        reg_json_diff = json.dumps(json.loads(json_diff), sort_keys=True)
+        reg_json_diff = regular_diff(c_json, tgt_json)
 
         # Back convert to matching format
         diff_json_out = aux.to_b64(reg_json_diff) if self.ub64 else reg_json_diff.replace("'", "''")
@@ -0,0 +1,130 @@
+import logging
+import posixpath
+import re
+import threading
+from typing import Dict, Set, Union
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+"""
+# Crawl frontier of the site indexer
+
+Every url found by the crawler passes the frontier before it is scheduled:
+- normalize: resolve relative hrefs against the site, lowercase scheme and host, drop default port and fragment,
+    remove dot segments and duplicate slashes. Urls of other hosts are rejected.
+- depth limit: the depth of a site is the number of links followed from the top level site of its section
+    (/lectures.html is depth 0). Sections can have a maximum depth, deeper sites are dropped.
+- visited set: every normalized url is scheduled once per crawl. Pages linked from several parents are downloaded and
+    written once.
+- priority: number used by the WorkerPool's priority queue (lower first). Defaults to the depth (breadth first), a
+    per section offset moves whole sections ahead or back.
+
+Thread-safe, push is called concurrently by the workers.
+"""
+
+_DUPLICATE_SLASHES = re.compile(r"/{2,}")
+
+
+class Frontier:
+    """
+    Visited set, url normalization, depth limits and priorities of a single crawl.
+    """
+    def __init__(self, base_url: str = "https://www.video.ethz.ch", max_depth: Dict[str, int] = None,
+                 priorities: Dict[str, int] = None, logger_name: str = "site_indexer"):
+        """
+        :param base_url: site of the crawl, relative hrefs are resolved against it, other hosts are rejected
+        :param max_depth: section (like /lectures) -> maximum depth, sections without entry are unlimited
+        :param priorities: section -> offset added to the priority of its sites (lower is crawled earlier)
+        :param logger_name: logger of the owning crawler
+        """
+        self.base_url = self.normalize(base_url, base=base_url + "/")
+        self.host = urlsplit(self.base_url).netloc
+        self.max_depth = max_depth if max_depth is not None else {}
+        self.priorities = priorities if priorities is not None else {}
+        self.logger = logging.getLogger(logger_name)
+
+        self.__lock = threading.Lock()
+        self.__visited: Set[str] = set()
+
+        self.scheduled = 0
+        self.duplicates = 0
+        self.too_deep = 0
+        self.rejected = 0
+
+    @staticmethod
+    def normalize(href: str, base: str) -> str:
+        """
+        Canonical form of an url.
+
+        :param href: absolute url or href relative to base
+        :param base: url of the site containing the href
+        :return: normalized absolute url
+        """
+        scheme, netloc, path, query, _ = urlsplit(urljoin(base, href.strip()))
+        scheme = scheme.lower()
+        netloc = netloc.lower()
+
+        if (scheme == "https" and netloc.endswith(":443")) or (scheme == "http" and netloc.endswith(":80")):
+            netloc = netloc.rsplit(":", 1)[0]
+
+        if path != "":
+            trailing = path.endswith("/")
+            path = posixpath.normpath(_DUPLICATE_SLASHES.sub("/", path))
+            # normpath keeps a leading // (posix), and drops the trailing slash
+            path = "/" + path.lstrip("/")
+            if trailing and path != "/":
+                path += "/"
+
+        return urlunsplit((scheme, netloc, path, query, ""))
+
+    @staticmethod
+    def section(uri: str) -> str:
+        """
+        Top level section of a site, like /lectures for /lectures/d-infk/2015.html
+        """
+        return "/" + uri.lstrip("/").split("/")[0].split(".")[0]
+
+    def uri(self, url: str) -> str:
+        """
+        Path of a normalized url of the crawled site, used as prefix of the site's children.
+        """
+        return url[len(self.base_url):]
+
+    def push(self, href: str, depth: int) -> Union[dict, None]:
+        """
+        Register an url found by the crawler.
+
+        :param href: href as found on the site (relative to the base url) or absolute url
+        :param depth: depth of the site
+        :return: job dict with url, prefix, depth and priority if the url needs to be crawled, None otherwise
+        """
+        url = self.normalize(href, base=self.base_url + "/")
+        if urlsplit(url).netloc != self.host:
+            with self.__lock:
+                self.rejected += 1
+            self.logger.debug(f"Rejected url of other host: {href}")
+            return None
+
+        uri = self.uri(url)
+        sec = self.section(uri)
+        limit = self.max_depth.get(sec)
+
+        with self.__lock:
+            if limit is not None and depth > limit:
+                self.too_deep += 1
+                return None
+
+            if url in self.__visited:
+                self.duplicates += 1
+                return None
+
+            self.__visited.add(url)
+            self.scheduled += 1
+
+        return {"url": url, "prefix": uri, "depth": depth, "priority": self.priorities.get(sec, 0) + depth}
+
+    def stats_str(self) -> str:
+        """
+        Human readable summary of the frontier counters for the logs.
+        """
+        return (f"Frontier: {self.scheduled} urls scheduled, {self.duplicates} duplicate fetches avoided, "
+                f"{self.too_deep} beyond depth limit, {self.rejected} of other hosts rejected")
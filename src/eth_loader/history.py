@@ -0,0 +1,419 @@
+import bisect
+import collections
+import datetime
+import json
+import logging
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+import jsondiff as jd
+
+import eth_loader.aux as aux
+from eth_loader.base_sql import BaseSQliteDB
+
+"""
+# Point in time queries over the history of metadata and episodes
+
+Every url of the metadata and episodes tables has a chain of records: the initial record (record_type 0), one diff per
+change (record_type 1) and the final record (record_type 2, the current state). found of the initial record and of a
+diff is the date its state was first seen, last_seen the last date it was still seen. The state at a date is the one
+of the latest record of the chain found at or before the date.
+
+Answering a query takes a constant number of queries, however many urls are involved:
+- the plan: one row per url with the key of the state at the date, the final and initial record and the nearest
+  keyframe before the date (see keyframes)
+- the json of the records (and keyframes) the replay starts from
+- the json of the diffs between the start and the state at the date
+The states are then replayed in memory, starting from the nearest of: a state in the cache, a keyframe, the final
+record (no change after the date) or the initial record.
+
+Reconstructed states are kept in an LRU cache keyed by the record they belong to, the same state reached by different
+dates is reconstructed once. The returned documents are shared with the cache, don't modify them.
+"""
+
+# Maximum number of variables in a statement of older sqlite versions
+MAX_VARIABLES = 900
+
+# (tbl, URL, parent)
+Identity = Tuple[str, str, Union[int, None]]
+
+
+class _Plan:
+    __slots__ = ("target", "final", "later", "initial", "keyframe")
+
+    def __init__(self, target: int, final: int, later: bool, initial: int, keyframe: int):
+        # key of the record whose state is in effect at the date
+        self.target = target
+        self.final = final
+        # a diff was found after the date, the final record doesn't hold the state
+        self.later = later
+        self.initial = initial
+        # key of the record the nearest keyframe before the date was taken after
+        self.keyframe = keyframe
+
+
+class History(BaseSQliteDB):
+    """
+    Read side of the history of the metadata and episodes tables.
+    """
+
+    def __init__(self, db_path: str, b64: bool, cache_size: int = 1024, profile: str = None):
+        """
+        :param db_path: Path to the database
+        :param b64: If the json is base64 encoded
+        :param cache_size: number of reconstructed documents kept
+        :param profile: sqlite performance profile of the connection (see base_sql.PROFILES), None for the defaults
+        """
+        super().__init__(db_path=db_path, profile=profile)
+        if cache_size < 0:
+            raise ValueError("Cache size must not be negative")
+
+        self.ub64 = b64
+        self.cache_size = cache_size
+        self.logger = logging.getLogger("history")
+
+        self.__differ = jd.JsonDiffer(marshal=True)
+        self.__cache: collections.OrderedDict = collections.OrderedDict()
+        # identity -> sorted keys of the cached states of the url
+        self.__cached_keys: Dict[Identity, List[int]] = {}
+        self.hits = 0
+        self.misses = 0
+
+        self.debug_execute("SELECT name FROM sqlite_master WHERE type='table' AND name='keyframes'")
+        self.has_keyframes = self.sq_cur.fetchone() is not None
+
+    # ==================================================================================================================
+    # Queries
+    # ==================================================================================================================
+
+    def as_of(self, tbl: str, url: str, dt: datetime.datetime, parent: int = None) -> Any:
+        """
+        Json of an url as it was at a date.
+
+        :param tbl: metadata or episodes
+        :param url: url of the metadata or episode
+        :param dt: date of the state, the changes found at that date are included
+        :param parent: parent of the metadata, None for any parent (the url must have only one)
+        :return: parsed json, None if the url wasn't known at that date
+        """
+        states = self.as_of_many(tbl, [url], dt, parent)
+        if len(states) > 1:
+            raise ValueError(f"{url} has {len(states)} parents in {tbl}, specify the parent")
+        return next(iter(states.values()), None)
+
+    def as_of_many(self, tbl: str, urls: Iterable[str], dt: datetime.datetime,
+                   parent: int = None) -> Dict[Identity, Any]:
+        """
+        Json of many urls as they were at a date.
+
+        :param tbl: metadata or episodes
+        :param urls: urls of the metadata or episodes
+        :param dt: date of the states
+        :param parent: parent of the metadata, None for any parent
+        :return: (tbl, URL, parent) -> parsed json, urls not known at that date are left out
+        """
+        urls = list(dict.fromkeys(urls))
+        plans = {}
+        for i in range(0, len(urls), MAX_VARIABLES):
+            chunk = urls[i:i + MAX_VARIABLES]
+            plans.update(self._plans(tbl, f"h.URL IN ({', '.join('?' for _ in chunk)})", tuple(chunk), dt, parent))
+        return self._states(tbl, plans)
+
+    def episodes_as_of(self, url: str, dt: datetime.datetime, parent: int = None) -> Dict[str, Any]:
+        """
+        All episodes of a series as they were at a date: the episodes linked to the state of the series at that date.
+
+        :param url: url of the series metadata
+        :param dt: date of the states
+        :param parent: parent of the metadata, None for any parent
+        :return: URL of the episode -> parsed json
+        """
+        series_parent = "" if parent is None else " AND parent = ?"
+        params = (url,) + (() if parent is None else (parent,)) + (self.__dt(dt),)
+
+        # Episodes linked to the latest record of the series found at the date
+        urls = (f"h.URL IN (SELECT e.URL FROM metadata_episode_assoz a JOIN episodes e ON e.key = a.episode_key "
+                f"WHERE a.metadata_key IN (SELECT MAX(key) FROM metadata WHERE URL = ?{series_parent} "
+                f"AND record_type IN (0, 1) AND found <= ? GROUP BY parent))")
+
+        states = self._states("episodes", self._plans("episodes", urls, params, dt))
+        return {ident[1]: state for ident, state in states.items()}
+
+    def history(self, tbl: str, url: str, parent: int = None) -> List[dict]:
+        """
+        All states of an url, oldest first.
+
+        :param tbl: metadata or episodes
+        :param url: url of the metadata or episode
+        :param parent: parent of the metadata, None for any parent (the url must have only one)
+        :return: dicts with key, record_type (0 initial, 1 diff), found, last_seen and the parsed json of each state
+        """
+        parent_col = self.__parent(tbl)
+        condition = ""
+        params = (url,)
+        if parent is not None:
+            if tbl != "metadata":
+                raise ValueError("Parent is only supported for metadata")
+            condition = " AND parent = ?"
+            params += (parent,)
+
+        self.debug_execute(f"SELECT {parent_col}, key, record_type, found, last_seen, json FROM {tbl} "
+                           f"WHERE URL = ?{condition} AND record_type IN (0, 1) ORDER BY key", params)
+        records = self.sq_cur.fetchall()
+
+        parents = {r[0] for r in records}
+        if len(parents) > 1:
+            raise ValueError(f"{url} has {len(parents)} parents in {tbl}, specify the parent")
+
+        res = []
+        state = None
+        for _, key, record_type, found, last_seen, stored in records:
+            state = self._load(stored) if record_type == 0 else self._patch(state, stored)
+            res.append({"key": key, "record_type": record_type, "found": found, "last_seen": last_seen,
+                        "json": state})
+        return res
+
+    def changed_between(self, dt1: datetime.datetime, dt2: datetime.datetime,
+                        tables: Iterable[str] = ("metadata", "episodes")) -> Dict[str, Dict[str, List[str]]]:
+        """
+        Urls added, changed and removed after dt1 up to and including dt2.
+
+        - added: initial record found in the interval
+        - changed: diff found in the interval (urls added in the interval aren't listed again)
+        - removed: the state in effect at dt2 was last seen before the last run up to dt2 (latest last_seen of the
+            table), but not before the last run up to dt1, i.e. a run in the interval didn't see the url anymore
+
+        :param dt1: start of the interval (exclusive)
+        :param dt2: end of the interval (inclusive)
+        :param tables: tables to check
+        :return: table -> {"added": urls, "changed": urls, "removed": urls}
+        """
+        dts1 = self.__dt(dt1)
+        dts2 = self.__dt(dt2)
+
+        res = {}
+        for tbl in tables:
+            parent = self.__parent(tbl)
+
+            self.debug_execute(f"SELECT DISTINCT URL FROM {tbl} WHERE record_type = 0 AND found > ? AND found <= ?",
+                               (dts1, dts2))
+            added = [r[0] for r in self.sq_cur.fetchall()]
+
+            self.debug_execute(f"SELECT DISTINCT URL FROM {tbl} WHERE record_type = 1 AND found > ? AND found <= ?",
+                               (dts1, dts2))
+            known = set(added)
+            changed = [r[0] for r in self.sq_cur.fetchall() if r[0] not in known]
+
+            # Runs are identified by the last_seen they set
+            self.debug_execute(f"SELECT MAX(last_seen) FROM {tbl} WHERE last_seen <= ?", (dts1,))
+            first_run = self.sq_cur.fetchone()[0]
+            self.debug_execute(f"SELECT MAX(last_seen) FROM {tbl} WHERE last_seen <= ?", (dts2,))
+            last_run = self.sq_cur.fetchone()[0]
+
+            removed = []
+            if last_run is not None:
+                self.debug_execute(f"SELECT DISTINCT s.URL FROM {tbl} s WHERE s.key IN "
+                                   f"(SELECT MAX(key) FROM {tbl} WHERE record_type IN (0, 1) AND found <= ? "
+                                   f"GROUP BY URL, {parent}) "
+                                   f"AND s.last_seen >= ? AND s.last_seen < ?",
+                                   (dts2, first_run if first_run is not None else "", last_run))
+                removed = [r[0] for r in self.sq_cur.fetchall()]
+
+            res[tbl] = {"added": added, "changed": changed, "removed": removed}
+        return res
+
+    def stats_str(self) -> str:
+        """
+        Human readable summary of the cache for the logs.
+        """
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total > 0 else 0
+        return (f"History: {len(self.__cache)} documents cached, {self.hits} hits, {self.misses} misses "
+                f"({rate:.0f}% hit rate)")
+
+    # ==================================================================================================================
+    # Replay
+    # ==================================================================================================================
+
+    def _plans(self, tbl: str, urls: str, params: tuple, dt: datetime.datetime,
+               parent: int = None) -> Dict[Identity, _Plan]:
+        """
+        Records needed for the states of the urls selected by a condition at a date, one row per url.
+
+        :param urls: condition on the table (alias h) selecting the urls
+        :param params: parameters of the condition
+        :param dt: date of the states
+        :param parent: parent of the metadata, None for any parent
+        """
+        dts = self.__dt(dt)
+        parent_col = self.__parent(tbl, "h")
+        if parent is not None:
+            if tbl != "metadata":
+                raise ValueError("Parent is only supported for metadata")
+            urls += " AND h.parent = ?"
+            params += (parent,)
+
+        keyframe = "NULL"
+        keyframe_params = ()
+        if self.has_keyframes:
+            keyframe = (f"(SELECT MAX(k.record_key) FROM keyframes k WHERE k.tbl = ? AND k.URL = h.URL "
+                        f"AND k.parent IS {parent_col} AND k.found <= ?)")
+            keyframe_params = (tbl, dts)
+
+        self.debug_execute(f"SELECT h.URL, {parent_col}, "
+                           f"MAX(CASE WHEN h.record_type IN (0, 1) AND h.found <= ? THEN h.key END), "
+                           f"MAX(CASE WHEN h.record_type = 2 THEN h.key END), "
+                           f"MAX(h.record_type = 1 AND h.found > ?), "
+                           f"MAX(CASE WHEN h.record_type = 0 THEN h.key END), "
+                           f"{keyframe} FROM {tbl} h WHERE {urls} GROUP BY h.URL, {parent_col}",
+                           (dts, dts) + keyframe_params + params)
+
+        return {(tbl, url, par): _Plan(target, final, bool(later), initial, kf)
+                for url, par, target, final, later, initial, kf in self.sq_cur.fetchall() if target is not None}
+
+    def _states(self, tbl: str, plans: Dict[Identity, _Plan]) -> Dict[Identity, Any]:
+        """
+        Replay the planned states, loading the json of all urls with a constant number of queries.
+        """
+        res = {}
+        # identity -> (key of the target state, start, key of the start record). The start is ("state", document),
+        # ("keyframe", None) or ("record", None)
+        starts = {}
+        for ident, plan in plans.items():
+            cached = self.__cache_get((ident, plan.target))
+            if cached is not None:
+                res[ident] = cached
+                continue
+
+            # No change after the date, the final record holds the state
+            if plan.final is not None and not plan.later:
+                starts[ident] = ("record", None, plan.final)
+                continue
+
+            # Nearest of cached state, keyframe and initial record before the target
+            lowest = max(k for k in (plan.keyframe, plan.initial, 0) if k is not None)
+            cached_key = self.__cached_before(ident, plan.target)
+            if cached_key is not None and cached_key > lowest:
+                starts[ident] = ("state", self.__cache[(ident, cached_key)], cached_key)
+            elif plan.keyframe is not None and plan.keyframe >= lowest:
+                starts[ident] = ("keyframe", None, plan.keyframe)
+            elif plan.initial is not None:
+                starts[ident] = ("record", None, plan.initial)
+            else:
+                self.logger.warning(f"No initial record of {ident[1]} in {tbl}")
+
+        jsons = self._jsons(tbl, [key for kind, _, key in starts.values() if kind == "record"])
+        kf_jsons = self._jsons(tbl, [key for kind, _, key in starts.values() if kind == "keyframe"], keyframes=True)
+        diffs = self._diffs(tbl, {ident: (key, plans[ident].target) for ident, (_, _, key) in starts.items()
+                                  if key != plans[ident].target and key != plans[ident].final})
+
+        for ident, (kind, state, key) in starts.items():
+            if kind == "keyframe":
+                state = self._load(kf_jsons[key])
+            elif kind == "record":
+                state = self._load(jsons[key])
+
+            for diff in diffs.get(ident, []):
+                state = self._patch(state, diff)
+
+            self.__cache_put((ident, plans[ident].target), state)
+            res[ident] = state
+        return res
+
+    def _jsons(self, tbl: str, keys: List[int], keyframes: bool = False) -> Dict[int, str]:
+        """
+        Stored json of records (or keyframes taken after records) by key, loaded in chunks.
+        """
+        res = {}
+        keys = list(set(keys))
+        for i in range(0, len(keys), MAX_VARIABLES):
+            chunk = keys[i:i + MAX_VARIABLES]
+            marks = ", ".join("?" for _ in chunk)
+            if keyframes:
+                self.debug_execute(f"SELECT record_key, json FROM keyframes WHERE tbl = ? AND record_key IN ({marks})",
+                                   (tbl,) + tuple(chunk))
+            else:
+                self.debug_execute(f"SELECT key, json FROM {tbl} WHERE key IN ({marks})", tuple(chunk))
+            res.update(self.sq_cur.fetchall())
+        return res
+
+    def _diffs(self, tbl: str, ranges: Dict[Identity, Tuple[int, int]]) -> Dict[Identity, List[str]]:
+        """
+        Stored diffs of urls after a key up to and including a key, ordered by key, loaded in chunks.
+
+        :param ranges: identity -> (key after which the diffs start, key of the last diff)
+        """
+        res = {}
+        idents = list(ranges)
+        per_chunk = MAX_VARIABLES // 5
+        for i in range(0, len(idents), per_chunk):
+            chunk = idents[i:i + per_chunk]
+            params = ()
+            for j, ident in enumerate(chunk):
+                params += (j, ident[1], ident[2]) + ranges[ident]
+
+            # The ranges drive the join, every range is a search in the url index
+            self.debug_execute(f"WITH r (i, URL, parent, lo, hi) AS "
+                               f"(VALUES {', '.join('(?, ?, ?, ?, ?)' for _ in chunk)}) "
+                               f"SELECT r.i, h.json FROM r CROSS JOIN {tbl} h ON h.URL = r.URL "
+                               f"AND {self.__parent(tbl, 'h')} IS r.parent AND h.record_type = 1 "
+                               f"AND h.key > r.lo AND h.key <= r.hi ORDER BY r.i, h.key", params)
+            for j, stored in self.sq_cur.fetchall():
+                res.setdefault(chunk[j], []).append(stored)
+        return res
+
+    def _load(self, stored: str) -> Any:
+        return json.loads(aux.from_b64(stored) if self.ub64 else stored)
+
+    def _patch(self, state: Any, stored_diff: str) -> Any:
+        return self.__differ.patch(state, self._load(stored_diff))
+
+    def __cache_get(self, key: Tuple[Identity, int]) -> Any:
+        state = self.__cache.get(key)
+        if state is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.__cache.move_to_end(key)
+        return state
+
+    def __cached_before(self, ident: Identity, key: int) -> Union[int, None]:
+        """
+        Key of the latest cached state of an url before a key.
+        """
+        keys = self.__cached_keys.get(ident)
+        if not keys:
+            return None
+        i = bisect.bisect_left(keys, key)
+        return keys[i - 1] if i > 0 else None
+
+    def __cache_put(self, key: Tuple[Identity, int], state: Any):
+        if self.cache_size == 0:
+            return
+
+        if key not in self.__cache:
+            bisect.insort(self.__cached_keys.setdefault(key[0], []), key[1])
+        self.__cache[key] = state
+        self.__cache.move_to_end(key)
+
+        while len(self.__cache) > self.cache_size:
+            (ident, evicted), _ = self.__cache.popitem(last=False)
+            keys = self.__cached_keys[ident]
+            keys.remove(evicted)
+            if len(keys) == 0:
+                del self.__cached_keys[ident]
+
+    @staticmethod
+    def __parent(tbl: str, alias: str = None) -> str:
+        """
+        Expression of the parent in the table, episodes have none.
+        """
+        if tbl == "episodes":
+            return "NULL"
+        elif tbl == "metadata":
+            return f"{alias}.parent" if alias is not None else "parent"
+        raise ValueError(f"Table {tbl} not recognized")
+
+    @staticmethod
+    def __dt(dt: datetime.datetime) -> str:
+        return dt.strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,128 @@
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests as rq
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class SessionPool:
+    """
+    Thread-safe HTTP session shared by all download workers of a stage.
+
+    Wraps a single requests.Session with one keep-alive connection pool per host. The pool holds as many connections
+    as there are workers, so every worker can reuse an open TCP + TLS connection instead of performing a new
+    handshake for every request.
+    """
+    session: rq.Session
+    pool_size: int
+
+    def __init__(self, pool_size: int = 10, hosts: int = 4):
+        """
+        Create the session and mount the pooled adapter.
+
+        :param pool_size: number of connections kept open per host, should match the number of workers.
+        :param hosts: number of hosts for which a connection pool is cached.
+        """
+        if pool_size < 1:
+            raise ValueError("Pool size must be greater than 0")
+
+        self.pool_size = pool_size
+        self.__lock = threading.Lock()
+        self.__requests = 0
+        self.__connects = 0
+
+        self.session = rq.Session()
+
+        # INFO: Cookies are passed per request (login cookies differ between jobs), don't persist any cookies
+        #   from the responses in the shared session.
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        self.__adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=pool_size, pool_block=True)
+        self.__adapter.poolmanager.pool_classes_by_scheme = self.__counting_pool_classes()
+        self.session.mount("https://", self.__adapter)
+        self.session.mount("http://", self.__adapter)
+
+    def __counting_pool_classes(self) -> dict:
+        """
+        Build urllib3 pool classes whose connections report every (re-)connect to this object. The counters of
+        urllib3 itself miss reconnects of dropped keep-alive connections.
+        """
+        count = self.__count_connect
+
+        class _HTTPConnection(HTTPConnection):
+            def connect(self):
+                count()
+                super().connect()
+
+        class _HTTPSConnection(HTTPSConnection):
+            def connect(self):
+                count()
+                super().connect()
+
+        class _HTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = _HTTPConnection
+
+        class _HTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = _HTTPSConnection
+
+        return {"http": _HTTPConnectionPool, "https": _HTTPSConnectionPool}
+
+    def __count_connect(self):
+        with self.__lock:
+            self.__connects += 1
+
+    def __count_request(self):
+        with self.__lock:
+            self.__requests += 1
+
+    def get(self, url: str, **kwargs) -> rq.Response:
+        """
+        Perform a GET request over the pooled connections. Signature matches requests.get.
+
+        :param url: url to download
+        :param kwargs: arguments passed on to requests (headers, cookies, timeout, ...)
+        """
+        self.__count_request()
+        return self.session.get(url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> rq.Response:
+        """
+        Perform a POST request over the pooled connections. Signature matches requests.post.
+
+        :param url: url to post to
+        :param kwargs: arguments passed on to requests (headers, cookies, data, ...)
+        """
+        self.__count_request()
+        return self.session.post(url, **kwargs)
+
+    def stats(self) -> dict:
+        """
+        Get the pool counters summed over all hosts and workers.
+
+        - requests: number of requests sent
+        - misses: number of connections that had to be opened (i.e. handshakes)
+        - hits: number of requests that reused an already open connection
+
+        :return: dict with the counters
+        """
+        with self.__lock:
+            req_count = self.__requests
+            con_count = self.__connects
+
+        return {"requests": req_count, "hits": max(req_count - con_count, 0), "misses": con_count}
+
+    def stats_str(self) -> str:
+        """
+        Human readable summary of the pool counters for the logs.
+        """
+        s = self.stats()
+        return (f"HTTP pool: {s['requests']} requests, {s['hits']} reused connections, "
+                f"{s['misses']} new connections")
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+        self.session.close()
@@ -0,0 +1,130 @@
+import datetime
+from typing import Dict, Iterable, Set
+
+from eth_loader.base_sql import BaseSQliteDB
+
+"""
+# Job ledger of the download stages
+
+Side table with the status of every url of a stage (sites, metadata, episodes) in the current run, identified by the
+start_dt of the loader:
+- pending: scheduled, no result written yet
+- done: result written
+- failed: downloaded without usable result (error status, exception), attempts and last_error tell why
+
+The status is written with the result in the same transaction (deferred until the flush of the batch), a run that dies
+midway leaves the ledger consistent with the tables. Starting the stage again with the same start_dt resumes the run:
+the urls done are skipped, pending and failed ones are downloaded. A new start_dt starts a new run, the rows of the
+previous run of the stage are removed. The urls failed in the previous run are kept in previous_failed, the loaders
+download them first.
+"""
+
+
+class JobLedger:
+    """
+    Status of the urls of a stage in the current run.
+    """
+
+    def __init__(self, db: BaseSQliteDB, stage: str):
+        """
+        :param db: database object (loader) to store the ledger in. The connection of the loader is used.
+        :param stage: name of the stage, like metadata or episodes
+        """
+        self.db = db
+        self.stage = stage
+        self.run = None
+        self.resumed = False
+        self.previous_failed: Set[str] = set()
+        self.check_table()
+
+    def check_table(self):
+        """
+        Create the job_ledger table if it doesn't exist.
+        """
+        self.db.debug_execute("CREATE TABLE IF NOT EXISTS job_ledger "
+                              "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
+                              "stage TEXT, "
+                              "run TEXT, "
+                              "URL TEXT, "
+                              "status TEXT CHECK (job_ledger.status IN ('pending', 'done', 'failed')), "
+                              "attempts INTEGER DEFAULT 0, "
+                              "last_error TEXT, "
+                              "updated TEXT, "
+                              "UNIQUE (stage, URL))")
+
+    def start(self, dt: datetime.datetime, urls: Iterable[str] = ()) -> Set[str]:
+        """
+        Begin the run of dt, or resume it if the ledger already has entries of it. Commits.
+
+        :param dt: start_dt of the run
+        :param urls: urls known up front, registered as pending
+        :return: urls already done in this run (empty unless resumed)
+        """
+        self.run = dt.strftime("%Y-%m-%d %H:%M:%S")
+
+        self.db.debug_execute("SELECT URL FROM job_ledger WHERE stage = ? AND run = ? AND status = 'done'",
+                              (self.stage, self.run))
+        done = {r[0] for r in self.db.sq_cur.fetchall()}
+
+        self.db.debug_execute("SELECT COUNT(key) FROM job_ledger WHERE stage = ? AND run = ?", (self.stage, self.run))
+        self.resumed = self.db.sq_cur.fetchone()[0] > 0
+
+        if not self.resumed:
+            self.db.debug_execute("SELECT URL FROM job_ledger WHERE stage = ? AND status = 'failed'", (self.stage,))
+            self.previous_failed = {r[0] for r in self.db.sq_cur.fetchall()}
+            self.db.debug_execute("DELETE FROM job_ledger WHERE stage = ?", (self.stage,))
+
+        self.db.sq_cur.executemany("INSERT INTO job_ledger (stage, run, URL, status, updated) "
+                                   "VALUES (?, ?, ?, 'pending', ?) ON CONFLICT (stage, URL) DO NOTHING",
+                                   ((self.stage, self.run, url, self.run) for url in urls))
+        self.db.sq_con.commit()
+        return done
+
+    def done(self, url: str):
+        """
+        Mark an url as done. Deferred until the next flush of the database object.
+
+        :param url: url of the job
+        """
+        self.__set(url, "done", None)
+
+    def failed(self, url: str, error: str):
+        """
+        Mark an url as failed. Deferred until the next flush of the database object.
+
+        :param url: url of the job
+        :param error: description of the error, like the status code
+        """
+        self.__set(url, "failed", error)
+
+    def __set(self, url: str, status: str, error):
+        """
+        Upsert the status of an url, urls not registered up front (pipelined mode) are added.
+        """
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.db.defer_execute("INSERT INTO job_ledger (stage, run, URL, status, attempts, last_error, updated) "
+                              "VALUES (?, ?, ?, ?, 1, ?, ?) "
+                              "ON CONFLICT (stage, URL) DO UPDATE SET status = excluded.status, "
+                              "attempts = job_ledger.attempts + 1, last_error = excluded.last_error, "
+                              "updated = excluded.updated, run = excluded.run",
+                              (self.stage, self.run, url, status, error, now))
+
+    def counts(self) -> Dict[str, int]:
+        """
+        Number of urls per status in the current run.
+
+        :return: dict status -> count
+        """
+        self.db.debug_execute("SELECT status, COUNT(key) FROM job_ledger WHERE stage = ? AND run = ? GROUP BY status",
+                              (self.stage, self.run))
+        counts = {"pending": 0, "done": 0, "failed": 0}
+        counts.update(dict(self.db.sq_cur.fetchall()))
+        return counts
+
+    def stats_str(self) -> str:
+        """
+        Human readable summary of the ledger for the logs.
+        """
+        counts = self.counts()
+        return (f"Ledger {self.stage} run {self.run}{' (resumed)' if self.resumed else ''}: {counts['done']} done, "
+                f"{counts['failed']} failed, {counts['pending']} pending")
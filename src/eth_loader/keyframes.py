@@ -0,0 +1,257 @@
+import datetime
+import json
+import logging
+from typing import Any, List, Tuple, Union
+
+import jsondiff as jd
+
+import eth_loader.aux as aux
+from eth_loader.base_sql import BaseSQliteDB
+
+"""
+# Keyframes of the history of metadata and episodes
+
+The history of an url is stored as initial record (record_type 0), one diff per change (record_type 1, the diff from
+the previous state to the state found that day) and the final record (record_type 2, the current state). The json of
+an url at an old date is the initial json with all diffs up to the date applied, hundreds of patches for long lived
+series.
+
+A keyframe is the full json of an url right after one of its diffs, stored in the side table keyframes (the record
+types of the tables are constrained to 0 - 3):
+- tbl, URL, parent: the url (parent NULL for episodes)
+- record_key: key of the diff the keyframe was taken after
+- found: found of that diff
+- json: json of the url from that day until the next diff, encoded like the table (base64 or not)
+
+A keyframe is written after every `every` diffs of an url or once the diffs since the last keyframe exceed
+`max_size` characters. reconstruct starts from the nearest keyframe before the date and applies the remaining diffs
+only, at most `every` of them.
+
+Keyframes are optional, tables without keyframes are reconstructed from the initial record. write adds the keyframes
+for the diffs since the last keyframe of every url, including the history written before keyframes were enabled.
+"""
+
+
+class Keyframes:
+    """
+    Keyframes of the history of the metadata and episodes tables.
+    """
+
+    def __init__(self, db: BaseSQliteDB, b64: bool, every: int = 32, max_size: int = None,
+                 logger_name: str = "increment_builder"):
+        """
+        :param db: database object to store the keyframes in. The connection of the object is used.
+        :param b64: If the json is base64 encoded
+        :param every: number of diffs after which a keyframe is written, None for no limit
+        :param max_size: characters of the diffs since the last keyframe after which a keyframe is written, None for
+            no limit
+        :param logger_name: logger of the owning object
+        """
+        if every is None and max_size is None:
+            raise ValueError("Either every or max_size must be set")
+
+        if every is not None and every < 1:
+            raise ValueError("Every must be greater than 0")
+
+        if max_size is not None and max_size < 1:
+            raise ValueError("Max size must be greater than 0")
+
+        self.db = db
+        self.ub64 = b64
+        self.every = every
+        self.max_size = max_size
+        self.logger = logging.getLogger(logger_name)
+
+        # Differ that unmarshals the stored (dumped) diffs before patching
+        self.__differ = jd.JsonDiffer(marshal=True)
+        self.written = 0
+        self.check_table()
+
+    def check_table(self):
+        """
+        Create the keyframes table if it doesn't exist.
+        """
+        self.db.debug_execute("CREATE TABLE IF NOT EXISTS keyframes "
+                              "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
+                              "tbl TEXT CHECK (keyframes.tbl IN ('metadata', 'episodes')), "
+                              "URL TEXT, "
+                              "parent INTEGER, "
+                              "record_key INTEGER, "
+                              "found TEXT, "
+                              "json TEXT, "
+                              "UNIQUE (tbl, record_key))")
+        self.db.debug_execute("CREATE INDEX IF NOT EXISTS keyframes_url_index "
+                              "ON keyframes (tbl, URL, parent, record_key)")
+
+    @staticmethod
+    def _columns(tbl: str, alias: str = None) -> str:
+        """
+        Expression of the parent in the table, episodes have none.
+        """
+        if tbl == "episodes":
+            return "NULL"
+        elif tbl == "metadata":
+            return f"{alias}.parent" if alias is not None else "parent"
+        raise ValueError(f"Table {tbl} not recognized")
+
+    def _load(self, stored: str) -> Any:
+        return json.loads(aux.from_b64(stored) if self.ub64 else stored)
+
+    def _dump(self, state: Any) -> str:
+        dumped = json.dumps(state)
+        return aux.to_b64(dumped) if self.ub64 else dumped
+
+    def _patch(self, state: Any, stored_diff: str) -> Any:
+        return self.__differ.patch(state, self._load(stored_diff))
+
+    def write(self, tbl: str) -> int:
+        """
+        Write the keyframes of all urls whose diffs since their last keyframe reached the limits. Commits.
+
+        :param tbl: metadata or episodes
+        :return: number of keyframes written
+        """
+        parent = self._columns(tbl, "e")
+        having = []
+        params = [tbl]
+        if self.every is not None:
+            having.append("COUNT(key) >= ?")
+            params.append(self.every)
+        if self.max_size is not None:
+            having.append("SUM(size) >= ?")
+            params.append(self.max_size)
+
+        # Urls with enough diffs after their last keyframe (or their initial record)
+        self.db.debug_execute(f"SELECT URL, p, last FROM "
+                              f"(SELECT e.key, e.URL, {parent} AS p, LENGTH(e.json) AS size, "
+                              f"COALESCE((SELECT MAX(k.record_key) FROM keyframes k WHERE k.tbl = ? AND "
+                              f"k.URL = e.URL AND k.parent IS {parent}), 0) AS last "
+                              f"FROM {tbl} e WHERE e.record_type = 1) "
+                              f"WHERE key > last GROUP BY URL, p HAVING {' OR '.join(having)}", tuple(params))
+        due = self.db.sq_cur.fetchall()
+
+        rows = []
+        for url, par, last in due:
+            rows.extend(self.__replay(tbl, url, par, last))
+
+        self.db.sq_cur.executemany("INSERT INTO keyframes (tbl, URL, parent, record_key, found, json) "
+                                   "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.db.sq_con.commit()
+
+        self.written += len(rows)
+        self.logger.info(f"Wrote {len(rows)} keyframes for {len(due)} urls in {tbl}")
+        return len(rows)
+
+    def __replay(self, tbl: str, url: str, parent: Union[int, None], last: int) -> List[Tuple]:
+        """
+        Apply the diffs of an url after its last keyframe, returns the rows of the new keyframes.
+        """
+        state, start = self.__start(tbl, url, parent, last, None)
+        if start is None:
+            self.logger.warning(f"No initial record of {url} in {tbl}, no keyframes written")
+            return []
+
+        self.db.debug_execute(f"SELECT key, found, json FROM {tbl} WHERE URL = ? AND {self._columns(tbl)} IS ? "
+                              f"AND record_type = 1 AND key > ? ORDER BY key", (url, parent, start))
+        diffs = self.db.sq_cur.fetchall()
+
+        rows = []
+        count = 0
+        size = 0
+        for key, found, diff in diffs:
+            state = self._patch(state, diff)
+            count += 1
+            size += len(diff)
+
+            if ((self.every is not None and count >= self.every)
+                    or (self.max_size is not None and size >= self.max_size)):
+                rows.append((tbl, url, parent, key, found, self._dump(state)))
+                count = 0
+                size = 0
+
+        # The replayed state must be the final record, otherwise the history is broken
+        self.db.debug_execute(f"SELECT json FROM {tbl} WHERE URL = ? AND {self._columns(tbl)} IS ? "
+                              f"AND record_type = 2", (url, parent))
+        final = self.db.sq_cur.fetchone()
+        if final is not None and self._load(final[0]) != state:
+            self.logger.warning(f"History of {url} in {tbl} doesn't match its final record, no keyframes written")
+            return []
+
+        return rows
+
+    def __start(self, tbl: str, url: str, parent: Union[int, None], before_key: Union[int, None],
+                before_found: Union[str, None]) -> Tuple[Any, Union[int, None]]:
+        """
+        State and key of the nearest keyframe (or the initial record) of an url.
+
+        :param before_key: latest key of the diff the keyframe may be taken after, None for no limit
+        :param before_found: latest found of the keyframe, None for no limit
+        :return: parsed json and key of the record it was taken after, (None, None) without initial record
+        """
+        conditions = ""
+        params = [tbl, url, parent]
+        if before_key is not None:
+            conditions += " AND record_key <= ?"
+            params.append(before_key)
+        if before_found is not None:
+            conditions += " AND found <= ?"
+            params.append(before_found)
+
+        self.db.debug_execute(f"SELECT record_key, json FROM keyframes WHERE tbl = ? AND URL = ? AND parent IS ?"
+                              f"{conditions} ORDER BY record_key DESC LIMIT 1", tuple(params))
+        keyframe = self.db.sq_cur.fetchone()
+        if keyframe is not None:
+            return self._load(keyframe[1]), keyframe[0]
+
+        self.db.debug_execute(f"SELECT key, json, found FROM {tbl} WHERE URL = ? AND {self._columns(tbl)} IS ? "
+                              f"AND record_type = 0", (url, parent))
+        initial = self.db.sq_cur.fetchone()
+        if initial is None or (before_found is not None and initial[2] > before_found):
+            return None, None
+        return self._load(initial[1]), initial[0]
+
+    def reconstruct(self, url: str, at: datetime.datetime, tbl: str = "episodes", parent: int = None) -> Any:
+        """
+        Json of an url as it was found at a date. Starts at the nearest keyframe before the date.
+
+        :param url: url of the metadata or episode
+        :param at: date of the state, the diffs found at that date are included
+        :param tbl: metadata or episodes
+        :param parent: parent of the metadata, None for episodes
+        :return: parsed json, None if the url wasn't known at that date
+        """
+        if (tbl == "metadata") != (parent is not None):
+            raise ValueError("Parent must be set for metadata and only for metadata")
+
+        at_str = at.strftime("%Y-%m-%d %H:%M:%S")
+        parent_col = self._columns(tbl)
+
+        # No diff found after the date: the final record holds the state (the initial record if there's no diff)
+        self.db.debug_execute(f"SELECT COUNT(key) FROM {tbl} WHERE URL = ? AND {parent_col} IS ? "
+                              f"AND record_type = 1 AND found > ?", (url, parent, at_str))
+        if self.db.sq_cur.fetchone()[0] == 0:
+            self.db.debug_execute(f"SELECT json, found, record_type FROM {tbl} WHERE URL = ? AND {parent_col} IS ? "
+                                  f"AND record_type IN (0, 2) ORDER BY record_type DESC", (url, parent))
+            records = {r[2]: r for r in self.db.sq_cur.fetchall()}
+            if 0 not in records or records[0][1] > at_str:
+                return None
+            return self._load(records[2 if 2 in records else 0][0])
+
+        state, start = self.__start(tbl, url, parent, None, at_str)
+        if start is None:
+            return None
+
+        self.db.debug_execute(f"SELECT json FROM {tbl} WHERE URL = ? AND {parent_col} IS ? AND record_type = 1 "
+                              f"AND key > ? AND found <= ? ORDER BY key", (url, parent, start, at_str))
+        for diff, in self.db.sq_cur.fetchall():
+            state = self._patch(state, diff)
+
+        return state
+
+    def stats_str(self) -> str:
+        """
+        Human readable summary for the logs.
+        """
+        self.db.debug_execute("SELECT tbl, COUNT(key) FROM keyframes GROUP BY tbl")
+        counts = ", ".join(f"{n} in {tbl}" for tbl, n in self.db.sq_cur.fetchall())
+        return f"Keyframes: {self.written} written, {counts if counts else 'none'} stored"
@@ -1,19 +1,41 @@
+import asyncio
 import datetime
+import functools
 import json
 import logging
-import multiprocessing as mp
-import queue
-import threading
 import time
+from typing import Callable, Dict, List, Set, Union
 
 import jsondiff as jd
 import requests as rq
 
-from eth_loader.aux import from_b64, to_b64
+from eth_loader.async_engine import AsyncEngine
+from eth_loader.aux import from_b64, is_json_digest, json_digest, to_b64
 from eth_loader.base_sql import BaseSQliteDB
+from eth_loader.batch_writer import BatchWriter
+from eth_loader.concurrency import AdaptiveConcurrency, slot
+from eth_loader.http_session import SessionPool
+from eth_loader.job_ledger import JobLedger
+from eth_loader.rate_limit import RateLimiter
+from eth_loader.retry import RETRYABLE, RetryPolicy, error_class, retry_after
+from eth_loader.validators import ValidatorStore, conditional_headers, response_validators
+from eth_loader.worker_pool import WorkerPool
 
+USER_AGENT = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:100.0) Gecko/20100101 Firefox/100.0"
 
-def retrieve_metadata(website_url: str, identifier: str, headers: dict, parent_id: int = -1) -> dict:
+
+def metadata_url(website_url: str) -> str:
+    """
+    Url of the series-metadata.json of a video site.
+
+    :param website_url: url of the site like /category/subcategory/year/season/lecture_id.html
+    """
+    return website_url.replace(".html", ".series-metadata.json").replace("\n", "")
+
+
+def retrieve_metadata(website_url: str, identifier: str, headers: dict, parent_id: int = -1,
+                      session: SessionPool = None, validators: dict = None, retry: RetryPolicy = None,
+                      concurrency: AdaptiveConcurrency = None, rate_limit: RateLimiter = None) -> dict:
     """
     Function to download a single metadata file for a given video_site. The website_url needs to be of type:
 
@@ -30,23 +52,117 @@ def retrieve_metadata(website_url: str, identifier: str, headers: dict, parent_i
     :param website_url: url to download eg. /category/subcategory/year/season/lecture_id.html
     :param identifier: str for thread to give information where the download was executed in case of an error.
     :param headers: dict to be passed to the request library. Download will fail if no user-agent is provided.
+    :param session: shared session pool to reuse connections, falls back to plain requests if None.
+    :param validators: etag and last_modified of the previous download for a conditional request, None if unknown.
+    :param retry: retry policy for transient errors, None to try once
+    :param concurrency: adaptive limit of the requests in flight, None for no limit
+    :param rate_limit: token buckets per host and path prefix, None for no limit
     """
     logger = logging.getLogger("metadata_loader")
-    url = website_url.replace(".html", ".series-metadata.json").replace("\n", "")
+    http = session if session is not None else rq
+    url = metadata_url(website_url)
+
+    attempt = 0
+    while True:
+        try:
+            with slot(concurrency, rate_limit, url) as request:
+                result = http.get(url=url, headers=conditional_headers(headers, validators))
+                request.error = error = error_class(status=result.status_code)
+            after = retry_after(result.headers)
+        except Exception as e:
+            result, error, after = e, error_class(exc=e), None
+
+        if retry is None or not retry.should_retry(error, attempt):
+            break
+
+        logger.warning(f"{identifier:.02} retrying {url} after {error} error")
+        time.sleep(retry.delay(attempt, after))
+        attempt += 1
+
+    if isinstance(result, Exception):
+        logger.exception(f"{identifier:.02} failed to download {url}", exc_info=result)
+        return {"url": url, "parent_id": parent_id, "status": -1, "content": None, "error": error}
+
+    res = conform_metadata(url=url, identifier=identifier, parent_id=parent_id, status=result.status_code,
+                           ok=result.ok, body=result.content, validators=response_validators(result.headers))
+    res["error"] = error
+    return res
+
+
+async def async_retrieve_metadata(session, job: dict, submit=None, retry: RetryPolicy = None,
+                                    concurrency: AdaptiveConcurrency = None, rate_limit: RateLimiter = None) -> dict:
+    """
+    Coroutine equivalent of retrieve_metadata for the async engine.
+
+    :param session: aiohttp.ClientSession of the engine
+    :param job: job dict with url, parent_id and validators, identical to the commands of the worker threads
+    :param submit: unused, part of the engine's fetch signature
+    :param retry: retry policy for transient errors, None to try once
+    :param concurrency: adaptive limit of the requests in flight, None for no limit
+    :param rate_limit: token buckets per host and path prefix, None for no limit
+    """
+    logger = logging.getLogger("metadata_loader")
+    url = metadata_url(job["url"])
+    headers = conditional_headers({"user-agent": USER_AGENT}, job.get("validators"))
+
+    attempt = 0
+    while True:
+        exc, after = None, None
+        try:
+            async with slot(concurrency, rate_limit, url) as request:
+                async with session.get(url, headers=headers) as result:
+                    body = await result.read()
+                    status = result.status
+                    validators = response_validators(result.headers)
+                    after = retry_after(result.headers)
+                request.error = error = error_class(status=status)
+        except Exception as e:
+            exc, error = e, error_class(exc=e)
+
+        if retry is None or not retry.should_retry(error, attempt):
+            break
+
+        logger.warning(f"async retrying {url} after {error} error")
+        await asyncio.sleep(retry.delay(attempt, after))
+        attempt += 1
+
+    if exc is not None:
+        logger.exception(f"async failed to download {url}", exc_info=exc)
+        return {"url": url, "parent_id": job["parent_id"], "status": -1, "content": None, "error": error}
+
+    res = conform_metadata(url=url, identifier="async", parent_id=job["parent_id"], status=status,
+                           ok=status < 400, body=body, validators=validators)
+    res["error"] = error
+    return res
 
-    try:
-        result = rq.get(url=url, headers=headers)
-    except Exception as e:
-        logger.exception(f"{identifier:.02} failed to download {url}", exc_info=e)
-        return {"url": url, "parent_id": parent_id, "status": -1, "content": None}
 
+def conform_metadata(url: str, identifier: str, parent_id: int, status: int, ok: bool, body: bytes,
+                     validators: dict = None) -> dict:
+    """
+    Build the result for the result queue from a downloaded series-metadata.json. Json is regularized (sorted keys).
+
+    :param url: url of the metadata
+    :param identifier: str for thread to give information where the download was executed in case of an error.
+    :param parent_id: id of parent in sites table
+    :param status: http status code of the response
+    :param ok: if the status code indicates success
+    :param body: raw content of the response
+    :param validators: etag and last_modified of the response
+    """
+    logger = logging.getLogger("metadata_loader")
     content = None
 
-    if result.ok:
-        content = result.content.decode("utf-8")
+    # Not modified since the last download, dequeue only updates last_seen
+    if status == 304:
+        logger.debug(f"{identifier} Not modified {url}")
+        return {"url": url, "parent_id": parent_id, "status": status, "content": None, "is_json": False,
+                "validators": validators}
+
+    if ok:
+        content = body.decode("utf-8")
     else:
         # INFO, also dequeue worker will warn
-        logger.error(f"{identifier:.02} error {result.status_code}, {url}")
+        logger.error(f"{identifier:.02} error {status}, {url}")
 
     # remove get arguments
     logger.debug(f"{identifier} Done {url}")
@@ -62,51 +178,37 @@ def retrieve_metadata(website_url: str, identifier: str, headers: dict, parent_i
     except Exception as e:
         logger.error(f"{identifier:.02} Failed to decode json from {url}", exc_info=e)
 
-    return {"url": url, "parent_id": parent_id, "status": result.status_code, "content": content, "is_json": is_json}
+    return {"url": url, "parent_id": parent_id, "status": status, "content": content, "is_json": is_json,
+            "validators": validators}
 
 
-def metadata_download_handler(worker_nr: int, command_queue: mp.Queue, result_queue: mp.Queue):
+def metadata_download_handler(worker_nr: int, arguments: dict, session: SessionPool = None,
+                              retry: RetryPolicy = None, concurrency: AdaptiveConcurrency = None,
+                              rate_limit: RateLimiter = None) -> dict:
     """
-    Function executed in a worker thread. The function tries to download the given url in the queue. If the queue is
-    empty for 20s, it will kill itself.
+    Function executed by a worker of the pool. Downloads the metadata for a single command.
 
     :param worker_nr: Itendifier for debugging
-    :param command_queue: Queue containing dictionaries containing all relevant information for downloading
-    :param result_queue: Queue to put the results in. Handled in main thread.
-    :return:
+    :param arguments: dictionary containing all relevant information for downloading (see make_job)
+    :param session: shared session pool of all workers
+    :param retry: retry policy shared by all workers
+    :param concurrency: adaptive limit of the requests in flight shared by all workers
+    :param rate_limit: rate limit shared by all workers
+    :return: result for the result queue
     """
-    logger = logging.getLogger("metadata_loader")
-    logger.info(f"Starting worker {worker_nr}")
-    local_logger = logging.getLogger("thread_handler")
-    local_logger.info(f"Worker {worker_nr:02} started")
-
-    ctr = 0
-    while ctr < 60:
-        try:
-            arguments = command_queue.get(block=False)
-            ctr = 0
-        except queue.Empty:
-            ctr += 1
-            time.sleep(1)
-            continue
-
-        if arguments is None:
-            ctr = 200
-            break
-
-        result = retrieve_metadata(arguments["url"], str(worker_nr),
-                                   headers={"user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:100.0) "
-                                                          "Gecko/20100101 Firefox/100.0"},
-                                   parent_id=arguments["parent_id"])
-
-        result_queue.put(result)
-    logger.info(f"{worker_nr} Terminated")
-    local_logger.info(f"Worker {worker_nr:02} exiting")
-    return
+    return retrieve_metadata(arguments["url"], str(worker_nr),
+                             headers={"user-agent": USER_AGENT},
+                             parent_id=arguments["parent_id"], session=session,
+                             validators=arguments.get("validators"), retry=retry,
+                             concurrency=concurrency, rate_limit=rate_limit)
 
 
 class MetadataLoader(BaseSQliteDB):
-    def __init__(self, index_db: str, start_dt: datetime.datetime, use_base64: bool = False):
+    def __init__(self, index_db: str, start_dt: datetime.datetime, use_base64: bool = False,
+                 use_validators: bool = True, batch_size: int = 500, batch_ms: int = 1000, profile: str = None,
+                 episode_sink: Callable[[str, int, str], None] = None, use_ledger: bool = True,
+                 retry: RetryPolicy = None, requeue: bool = True, concurrency: AdaptiveConcurrency = None,
+                 rate_limit: RateLimiter = None):
         """
         Initialise downloader function. Provide the function either with a file containing valid urls or a list of urls.
 
@@ -117,16 +219,31 @@ class MetadataLoader(BaseSQliteDB):
         /category/subcategory/site.html
 
         :param index_db: Database result of the indexer.
+        :param use_validators: send conditional requests with the ETag / Last-Modified of the previous run
+        :param batch_size: maximum number of results written per transaction
+        :param batch_ms: maximum time in milliseconds between two commits while results are coming in
+        :param profile: sqlite performance profile of the connection (see base_sql.PROFILES), None for the defaults
+        :param episode_sink: pipelined mode, called as episode_sink(url, key, json) for every series whose json is
+            current after the download, with the key of the record its episodes are linked to (e.g.
+            BetterStreamLoader.episode_sink)
+        :param use_ledger: track the status of every url in the job ledger, a download of the same start_dt resumes
+            the run and skips the urls already done
+        :param retry: retry policy for transient errors (timeouts, 5xx, ...), None for the default policy
+        :param requeue: download the urls failing with a transient error once more after the main pass
+        :param concurrency: adaptive limit of the requests in flight (at most the number of workers), None to keep
+            all workers busy
+        :param rate_limit: token buckets per host and path prefix shared by all requests, None for no limit
         """
-        super().__init__(index_db)
+        super().__init__(index_db, profile=profile)
         self.logger = logging.getLogger("metadata_loader")
+        self.episode_sink = episode_sink
 
-        self.result_queue = mp.Queue()
-        self.command_queue = mp.Queue()
         self.urls = []
         self.nod = 0
 
-        self.workers = None
+        self.pool = None
+        self.session_pool = None
+        self.engine = None
 
         self.genera_cookie = None
         self.ub64 = use_base64
@@ -134,6 +251,33 @@ class MetadataLoader(BaseSQliteDB):
 
         self.check_results_table()
 
+        self.use_validators = use_validators
+        self.validator_store = ValidatorStore(self)
+        self.validators = {}
+
+        self.writer = BatchWriter(self, store=self.store_result, batch_size=batch_size, batch_ms=batch_ms,
+                                  logger_name="metadata_loader")
+
+        self.ledger = JobLedger(self, stage="metadata") if use_ledger else None
+        self.done_urls: Set[str] = set()
+
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.requeue = requeue
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        # (site key, url of the metadata) failed with a transient error, downloaded again in the requeue pass
+        self.failed_jobs = []
+
+        # databases the results are written to as well (add_sink), sites are matched by url
+        self.sinks: List["MetadataLoader"] = []
+        self.site_urls: Dict[int, str] = {}
+        self.site_keys: Dict[str, int] = {}
+
+        self.__g_counter = 0
+        self.__e_counter = 0
+        self.__n_counter = 0
+        self.__e_url = []
+
     def get_video_urls(self, dt: datetime.datetime):
         """
         Get all sites where a video is present from sites table.
@@ -143,10 +287,146 @@ class MetadataLoader(BaseSQliteDB):
 
         self.verify_args_table()
         # Need to check >= since we're now using the same datetime for consistency.
-        self.debug_execute(f"SELECT key, url FROM sites WHERE IS_VIDEO=1 AND datetime(last_seen) >= datetime('{dts}')")
+        self.debug_execute("SELECT key, url FROM sites WHERE IS_VIDEO = 1 AND last_seen >= ?", (dts,))
         self.urls = self.sq_cur.fetchall()
         self.logger.info(f"Retrieved {len(self.urls)} urls for metadata download")
 
+        if self.use_validators:
+            self.validators = self.validator_store.load()
+            self.logger.info(f"Loaded validators for {len(self.validators)} urls")
+
+    def add_sink(self, sink: "MetadataLoader"):
+        """
+        Write the results to another database as well (e.g. the base64 and the plain database, each loader with its
+        own use_base64). The metadata is downloaded once, the parent sites are matched by url in the sink.
+
+        :param sink: metadata loader of the other database
+        :return:
+        """
+        self.sinks.append(sink)
+        self.writer.add_sink(sink, functools.partial(self.__store_in_sink, sink))
+
+    def __prepare_sinks(self, dt: datetime.datetime):
+        """
+        Load the sites of the sinks. Conditional requests are only sent for urls with the same validators in all
+        databases, a sink that missed an update gets the full response.
+        """
+        self.site_urls = {key: url for key, url in self.urls}
+
+        for sink in self.sinks:
+            sink.get_video_urls(dt)
+            sink.site_keys = {url: key for key, url in sink.urls}
+            self.validators = {url: v for url, v in self.validators.items() if sink.validators.get(url) == v}
+
+    def __store_in_sink(self, sink: "MetadataLoader", res: dict):
+        """
+        Write a result to a sink, with the key of the parent site in the sink.
+        """
+        if res is not None:
+            if res["url"] in sink.done_urls:
+                # written before the run was interrupted
+                return
+
+            parent_id = sink.site_keys.get(self.site_urls.get(res["parent_id"]))
+            if parent_id is None:
+                sink.logger.error(f"Site of {res['url']} not in {sink.db_path}, skipping")
+                return
+            res = dict(res, parent_id=parent_id)
+
+        sink.store_result(res)
+
+    def make_job(self, key: int, url: str) -> dict:
+        """
+        Create the command for a downloader.
+
+        :param key: key of the site in the sites table
+        :param url: url of the site
+        :return:
+        """
+        return {"url": url, "parent_id": key, "validators": self.validators.get(metadata_url(url))}
+
+    def start_ledger(self):
+        """
+        Start the run in the job ledgers of the loader and its sinks, or resume it. The urls done in all of them are
+        removed from the urls to download. In pipelined mode, their series are handed to the episode sinks from the
+        database.
+
+        :return:
+        """
+        if self.ledger is None:
+            return
+
+        json_urls = [metadata_url(url) for _, url in self.urls]
+        done = self.ledger.start(self.start_dt, json_urls)
+        for sink in self.sinks:
+            sink.done_urls = sink.ledger.start(sink.start_dt, json_urls) if sink.ledger is not None else set()
+            done &= sink.done_urls
+        self.done_urls = done
+
+        if len(self.ledger.previous_failed) > 0:
+            # urls that failed in the previous run first
+            self.urls.sort(key=lambda u: metadata_url(u[1]) not in self.ledger.previous_failed)
+
+        if not self.ledger.resumed:
+            return
+
+        remaining = []
+        for key, url in self.urls:
+            json_url = metadata_url(url)
+            if json_url not in done:
+                remaining.append((key, url))
+                continue
+
+            self.replay_episodes(parent_id=key, url=json_url)
+            for sink in self.sinks:
+                sink_key = sink.site_keys.get(self.site_urls.get(key))
+                if sink_key is not None:
+                    sink.replay_episodes(parent_id=sink_key, url=json_url)
+
+        self.logger.info(f"Resuming run {self.ledger.run}, {len(self.urls) - len(remaining)} of {len(self.urls)} "
+                         f"urls already done")
+        self.urls = remaining
+
+    def replay_episodes(self, parent_id: int, url: str):
+        """
+        Hand a series written before the run was interrupted to the episode sink (pipelined mode), does nothing
+        without sink. The records aren't modified.
+
+        :param parent_id: id of the parent site in the sites table
+        :param url: url of the metadata
+        :return:
+        """
+        if self.episode_sink is None:
+            return
+
+        # new state written in this run, becomes the latest differential record with the increment
+        now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
+        self.debug_execute("SELECT key, json FROM metadata "
+                           "WHERE URL = ? AND parent = ? AND record_type IS NULL AND found = ? "
+                           "ORDER BY key DESC LIMIT 1", (url, parent_id, now))
+        row = self.sq_cur.fetchone()
+        if row is not None:
+            self.emit_episodes(parent_id=parent_id, url=url, episode_parent=row[0],
+                               json_arg=from_b64(row[1]) if self.ub64 else row[1])
+            return
+
+        self.debug_execute("SELECT key, record_type FROM metadata "
+                           "WHERE URL = ? AND parent = ? AND record_type IN (2, 0) "
+                           "ORDER BY record_type DESC LIMIT 1", (url, parent_id))
+        row = self.sq_cur.fetchone()
+
+        # non-json document, no episodes
+        if row is None:
+            return
+
+        key, record_type = row
+        if record_type == 2:
+            self.debug_execute("SELECT key FROM metadata WHERE record_type = 1 AND parent = ? AND URL = ? "
+                               "ORDER BY found DESC LIMIT 1", (parent_id, url))
+            key = self.sq_cur.fetchone()[0]
+
+        self.emit_episodes(parent_id=parent_id, url=url, episode_parent=key)
+
     def verify_args_table(self):
         """
         Verify that the sites table exists
@@ -181,17 +461,22 @@ class MetadataLoader(BaseSQliteDB):
 
         self.debug_execute("CREATE INDEX IF NOT EXISTS metadata_key_index ON metadata (key)")
         self.debug_execute("CREATE INDEX IF NOT EXISTS metadata_url_parent_index ON metadata (URL, parent)")
+        # Covering index for the change detection, lookups by url don't need to read the json from the table
+        self.debug_execute("CREATE INDEX IF NOT EXISTS metadata_url_hash_index "
+                           "ON metadata (URL, parent, record_type, json_hash, deprecated)")
+        # Timestamps are canonical text (YYYY-MM-DD HH:MM:SS), compared directly so the indexes can be used
+        self.debug_execute("CREATE INDEX IF NOT EXISTS metadata_last_seen_index ON metadata (last_seen)")
+        self.debug_execute("CREATE INDEX IF NOT EXISTS metadata_type_last_seen_index "
+                           "ON metadata (record_type, last_seen)")
 
     def cleanup_workers(self):
         """
-        Waits for all worker processes to terminate and then joins them.
+        Waits for all workers to terminate and then joins them.
         :return:
         """
-        for worker in self.workers:
-            worker: threading.Thread
-            worker.join(10)
+        self.pool.stop()
 
-    def download(self, dt: datetime.datetime, workers: int = 100):
+    def download(self, dt: datetime.datetime, workers: int = 100, engine: str = "thread"):
         """
         Initiate main Download of the urls provided in the init method.
         Calls the enqueue function and then the check_result function.
@@ -200,15 +485,51 @@ class MetadataLoader(BaseSQliteDB):
         or the entire metadata is stored inside the target file. **WARNING the target file WILL be overwritten**
 
         :param dt: datetime of last site indexing
-        :param workers: number of worker threads to run concurrently
+        :param workers: number of worker threads to run concurrently (requests in flight for the async engine)
+        :param engine: "thread" for worker threads, "async" for a single asyncio event loop
         :return:series
         """
+        if engine not in ("thread", "async"):
+            raise ValueError(f"Engine {engine} not recognized")
+
         self.get_video_urls(dt)
-        self.enqueue_th(workers)
+        if len(self.sinks) > 0:
+            self.__prepare_sinks(dt)
+        self.start_ledger()
+        self.failed_jobs = []
+        self.__download_pass(workers, engine)
+
+        if self.requeue and len(self.failed_jobs) > 0:
+            self.logger.info(f"Requeue pass for {len(self.failed_jobs)} failed urls")
+            self.urls = self.failed_jobs
+            self.failed_jobs = []
+            for _, url in self.urls:
+                # unconditional, the 304 of a url without entry is healed as well
+                self.validators.pop(url, None)
+            self.__download_pass(workers, engine)
+
+        self.logger.info(self.retry.stats_str())
+        if self.concurrency is not None:
+            self.logger.info(self.concurrency.stats_str())
+        if self.rate_limit is not None:
+            self.logger.info(self.rate_limit.stats_str())
+        self.logger.info("DOWNLOAD METADATA DONE")
+
+    def __download_pass(self, workers: int, engine: str):
+        """
+        Download self.urls and write the results, returns once the last one is written.
+        """
+        if engine == "async":
+            self.enqueue_async(workers)
+        else:
+            self.enqueue_th(workers)
         self.check_result()
         self.cleanup_workers()
         self.sq_con.commit()
-        self.logger.info("DOWNLOAD METADATA DONE")
+
+        http = self.engine if engine == "async" else self.session_pool
+        self.logger.info(http.stats_str())
+        http.close()
 
     def spawn(self, workers: int):
         """
@@ -217,86 +538,144 @@ class MetadataLoader(BaseSQliteDB):
         :param workers: number of workers to spawn.
         :return:
         """
-        # generate arguments for the worker threads
-        commands = [(i, self.command_queue, self.result_queue,) for i in range(workers)]
-        threads = []
+        # one connection pool shared by all workers
+        self.session_pool = SessionPool(pool_size=workers)
 
-        # spawn threads
-        for command in commands:
-            t = threading.Thread(target=metadata_download_handler, args=command)
-            t.start()
-            threads.append(t)
-
-        self.workers = threads
+        # bounded queues, enqueueing blocks while the workers are busy, downloading while the db writer is behind
+        self.pool = WorkerPool(job_fn=functools.partial(metadata_download_handler, session=self.session_pool,
+                                                        retry=self.retry, concurrency=self.concurrency,
+                                                        rate_limit=self.rate_limit),
+                               workers=workers, cmd_size=2 * workers, result_size=2 * workers,
+                               logger_name="metadata_loader")
+        self.pool.start()
 
     def enqueue_th(self, workers):
         """
-        Function to load the urls and put them inside a queue for the workers to download them. Also spawns the
-        worker threads.
+        Function to load the urls and feed them to the workers to download them. Also spawns the
+        worker threads. Returns immediately, the urls are fed while check_result is writing the results.
 
         :param workers: number of workers. At least 1 maybe at most 10'000
         :return:
         """
+        if self.urls is None:
+            raise ValueError("Database apparently doesn't have any urls, get_urls retrieved None")
 
         self.spawn(workers)
 
-        if self.urls is not None:
-            self.nod = len(self.urls)
-            for url in self.urls:
-                self.command_queue.put({"url": url[1], "parent_id": url[0]})
-        else:
+        self.nod = len(self.urls)
+        self.pool.feed(self.make_job(url[0], url[1]) for url in self.urls)
+
+    def enqueue_async(self, concurrency: int):
+        """
+        Start the async engine with all urls. The event loop thread takes the place of the worker threads.
+
+        :param concurrency: number of requests in flight
+        :return:
+        """
+        if self.urls is None:
             raise ValueError("Database apparently doesn't have any urls, get_urls retrieved None")
 
-        for i in range(workers):
-            self.command_queue.put(None)
+        self.nod = len(self.urls)
+        self.engine = AsyncEngine(fetch=functools.partial(async_retrieve_metadata, retry=self.retry,
+                                                          concurrency=self.concurrency, rate_limit=self.rate_limit),
+                                  concurrency=concurrency, logger_name="metadata_loader")
+        self.engine.start(self.make_job(url[0], url[1]) for url in self.urls)
+        self.pool = self.engine
 
     def check_result(self):
         """
-        Function check the results in the results queue.
+        Function check the results in the results queue. Returns once the result of the last url is written.
+        The results are written in batches, one transaction per batch.
 
         Either choose multi_file, then the target_dir is also evaluated and the site structure is stored inside the dir
         or the entire metadata is stored inside the target file. **WARNING the target file WILL be overwritten**
         :return:
         """
-        g_counter = 0
-        e_counter = 0
-        e_url = []
-
-        ctr = 0
-        res = {"url": "Empty", "content": "empty"}
-        while ctr < 20:
-            if not self.result_queue.empty():
-                try:
-                    res = self.result_queue.get()
-                    parent_id = res["parent_id"]
-                    url = res["url"]
-
-                    if res["status"] == 200:
-                        if res["is_json"]:
-                            self.insert_update_json_db(parent_id=parent_id, url=url,
-                                              json_arg=res["content"])
-                        else:
-                            self.insert_update_other_db(parent_id=parent_id, url=url,
-                                              json_arg=res["content"])
-                    else:
-                        self.logger.error(f"Failed to download {url} with status code {res['status']}")
-                        e_url.append(url)
-                        e_counter += 1
-                    ctr = 0
-                except Exception as e:
-                    self.logger.exception("Exception dequeue from result queue}", e, res)
-                    e_counter += 1
-                g_counter += 1
-            else:
-                time.sleep(1)
-                ctr += 1
-
-        self.logger.info(f"Downloaded {g_counter} with {e_counter} errors.")
-        if len(e_url) > 0:
+        self.__g_counter = 0
+        self.__e_counter = 0
+        self.__n_counter = 0
+        self.__e_url = []
+
+        self.writer.run(self.pool.results(idle_timeout=self.writer.batch_ms / 1000))
+
+        self.logger.info(f"Downloaded {self.__g_counter} with {self.__e_counter} errors, "
+                         f"{self.__n_counter} not modified.")
+        if self.ledger is not None:
+            self.logger.info(self.ledger.stats_str())
+        if len(self.__e_url) > 0:
             self.logger.error(f"Urls with failures:")
-            for url in e_url:
+            for url in self.__e_url:
                 self.logger.error(url)
 
+    def store_result(self, res: dict):
+        """
+        Write a single result of the download workers to the database. Called by the batch writer, doesn't commit.
+
+        :param res: result of retrieve_metadata, None if the job failed
+        :return:
+        """
+        self.__g_counter += 1
+
+        if res is None:
+            self.__e_counter += 1
+            return
+
+        try:
+            parent_id = res["parent_id"]
+            url = res["url"]
+
+            if res["status"] == 304:
+                episode_parent = self.touch_json_db(parent_id=parent_id, url=url)
+                if episode_parent is None:
+                    # Validators without matching entry, next run downloads unconditionally
+                    self.validator_store.remove(url)
+                    self.__e_url.append(url)
+                    self.__e_counter += 1
+                    self.failed_jobs.append((parent_id, url))
+                    self.mark_job(url, error="not modified, but no entry in metadata")
+                else:
+                    self.__n_counter += 1
+                    self.emit_episodes(parent_id=parent_id, url=url, episode_parent=episode_parent)
+                    self.mark_job(url)
+            elif res["status"] == 200:
+                if res["is_json"]:
+                    episode_parent = self.insert_update_json_db(parent_id=parent_id, url=url,
+                                                                json_arg=res["content"])
+                    self.validator_store.store(url, res.get("validators"), self.start_dt)
+                    self.emit_episodes(parent_id=parent_id, url=url, episode_parent=episode_parent,
+                                       json_arg=res["content"])
+                else:
+                    self.insert_update_other_db(parent_id=parent_id, url=url,
+                                                json_arg=res["content"])
+                self.mark_job(url)
+            else:
+                self.logger.error(f"Failed to download {url} with status code {res['status']}")
+                self.__e_url.append(url)
+                self.__e_counter += 1
+                if res.get("error") in RETRYABLE:
+                    self.failed_jobs.append((parent_id, url))
+                self.mark_job(url, error=f"{res.get('error')} error, status {res['status']}")
+        except Exception as e:
+            self.logger.exception(f"Exception dequeue from result queue {res}", exc_info=e)
+            self.__e_counter += 1
+            self.mark_job(res.get("url"), error=f"{type(e).__name__}: {e}")
+
+    def mark_job(self, url: str, error: str = None):
+        """
+        Record the outcome of an url in the job ledger, does nothing without ledger. Deferred until the next flush.
+
+        :param url: url of the metadata
+        :param error: description of the error, None if the result was written
+        :return:
+        """
+        if self.ledger is None or url is None:
+            return
+
+        if error is None:
+            self.ledger.done(url)
+        else:
+            self.ledger.failed(url, error)
+
     def insert_update_other_db(self, parent_id: int, url: str, json_arg: str):
         """
         Insert into db if new, update if exists and check deprecation status.
@@ -309,103 +688,96 @@ class MetadataLoader(BaseSQliteDB):
         # Prepare arguments for function
         now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
         key = None
-        json_hash = hash(json_arg)
-        conv_json_arg = to_b64(json_arg) if self.ub64 else json_arg.replace("'", "''")
+        json_hash = json_digest(json_arg)
+        conv_json_arg = to_b64(json_arg) if self.ub64 else json_arg
 
-        # check existence of initial and final record:
-        self.debug_execute(f"SELECT key, json, deprecated FROM metadata "
-                           f"WHERE parent = {parent_id} AND URL = '{url}' AND record_type = 3 "
-                           f"ORDER BY found DESC")
+        # check existence of initial and final record (json_hash is read from the covering index):
+        self.debug_execute("SELECT key, json_hash, deprecated FROM metadata "
+                           "WHERE URL = ? AND parent = ? AND record_type = 3 "
+                           "ORDER BY found DESC", (url, parent_id))
 
         # Get the results for the non-json entries
         raw = self.sq_cur.fetchall()
-        results = [{"key": res[0], "json": res[1], "deprecated": res[2]} for res in raw]
+        results = [{"key": res[0], "json_hash": res[1], "deprecated": res[2]} for res in raw]
 
         # Check for a match
         for result in results:
-            json_db = from_b64(result["json"]) if self.ub64 else result["json"]
+            if not self.json_matches(key=result["key"], db_hash=result["json_hash"], json_hash=json_hash,
+                                     json_arg=json_arg, is_json=False):
+                continue
 
-            # Check the json matches
-            if json_db == json_arg:
-                if result["deprecated"] == 1:
-                    self.logger.info(f"Reactivating deprecated non-json entry in metadata: {url}")
-                else:
-                    self.logger.debug(f"Found active non-json entry in metadata: {url}")
-                key = result["key"]
-                break
+            if result["deprecated"] == 1:
+                self.logger.info(f"Reactivating deprecated non-json entry in metadata: {url}")
+            else:
+                self.logger.debug(f"Found active non-json entry in metadata: {url}")
+            key = result["key"]
+            break
 
         # No match found, inserting
         if key is None:
             self.logger.debug(f"Inserting new entry to metadata: {url}")
             # Found a new url, is initial so record type 0
             self.debug_execute(
-                f"INSERT INTO metadata (parent, URL, json, found, last_seen, record_type, json_hash) VALUES "
-                f"({parent_id}, '{url}', '{conv_json_arg}', '{now}', '{now}', 3, '{json_hash}')")
+                "INSERT INTO metadata (parent, URL, json, found, last_seen, record_type, json_hash) VALUES "
+                "(?, ?, ?, ?, ?, 3, ?)", (parent_id, url, conv_json_arg, now, now, json_hash))
 
         # Match found, updating last_seen
         else:
             self.logger.debug(f"Updating existing entry to metadata: {url}")
-            self.debug_execute(f"UPDATE metadata SET last_seen = '{now}' WHERE key = {key}")
+            self.defer_execute("UPDATE metadata SET last_seen = ? WHERE key = ?", (now, key))
 
-    def insert_update_json_db(self, parent_id: int, url: str, json_arg: str):
+    def emit_episodes(self, parent_id: int, url: str, episode_parent: int, json_arg: str = None):
+        """
+        Hand a series to the episode sink (pipelined mode), does nothing without sink.
+
+        :param parent_id: id of the parent site in the sites table
+        :param url: url of the metadata
+        :param episode_parent: key of the record the episodes are linked to
+        :param json_arg: json of the series, None to read it from the initial or final record (not modified)
+        :return:
+        """
+        if self.episode_sink is None:
+            return
+
+        if json_arg is None:
+            self.debug_execute("SELECT json FROM metadata WHERE URL = ? AND parent = ? AND record_type IN (2, 0) "
+                               "ORDER BY record_type DESC LIMIT 1", (url, parent_id))
+            json_arg = self.sq_cur.fetchone()[0]
+            json_arg = from_b64(json_arg) if self.ub64 else json_arg
+
+        self.episode_sink(url, episode_parent, json_arg)
+
+    def insert_update_json_db(self, parent_id: int, url: str, json_arg: str) -> int:
         """
         Insert into db if new, update if exists and check deprecation status.
 
         :param parent_id: id of the parent site in the sites table
         :param url: url of the metadata
         :param json_arg: json stored at metadata url (is already properly encoded for the db)
-        :return:
+        :return: key of the record the episodes of the series are linked to (once the increment is built)
         """
         # Prepare arguments for function
         now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
-        key, json_db, deprecated, record_type = None, None, None, None
-        json_hash = hash(json_arg)
-        conv_json_arg = to_b64(json_arg) if self.ub64 else json_arg.replace("'", "''")
+        key, deprecated, record_type = None, None, None
+        json_hash = json_digest(json_arg)
+        conv_json_arg = to_b64(json_arg) if self.ub64 else json_arg
 
-        # check existence of initial and final record:
-        self.debug_execute(f"SELECT key, json, deprecated, record_type FROM metadata "
-                           f"WHERE parent = {parent_id} AND URL = '{url}' AND record_type IN (2, 0) "
-                           f"ORDER BY record_type DESC LIMIT 1")
+        # check existence of initial and final record (json_hash is read from the covering index):
+        self.debug_execute("SELECT key, json_hash, deprecated, record_type FROM metadata "
+                           "WHERE URL = ? AND parent = ? AND record_type IN (2, 0) "
+                           "ORDER BY record_type DESC LIMIT 1", (url, parent_id))
 
         results = self.sq_cur.fetchall()
 
         # check the length is 1, so we can unpack
         if len(results) != 0:
             assert len(results) == 1, "Update of the sql statement violates the assert - only one result expected"
-            key, temp_json, deprecated, record_type = results[0]
-
-            json_db = from_b64(temp_json) if self.ub64 else temp_json
+            key, db_hash, deprecated, record_type = results[0]
 
             # Check the json matches
-            if json.loads(json_db) == json.loads(json_arg):
-
-                # Differing logging messages depending on if the entry is deprecated or not
-                if deprecated == 1:
-                    self.logger.info(f"Reactivating deprecated entry in metadata: {url}")
-                else:
-                    self.logger.debug(f"Found active entry in metadata: {url}")
-
-                # Perform the update of the differential entry that belongs to the final entry.
-                if record_type == 2:
-                    self.debug_execute(f"SELECT key FROM metadata "
-                                       f"WHERE record_type = 1 AND parent = {parent_id} AND URL = '{url}' "
-                                       f"ORDER BY found DESC LIMIT 1")
-                    row = self.sq_cur.fetchone()
-
-                    # Row mustn't be None, since we have a final record
-                    assert row is not None, f"Couldn't find differential entry for {url}."
-                    diff_key = row[0]
-                    self.debug_execute(f"UPDATE metadata SET last_seen = '{now}', deprecated = 0 WHERE key = {diff_key}")
-
-                # Else -> record_type == 0. The final or initial entry needs to be updated anyway, no else block needed
-                # else:
-                #     pass
-
-                # Update the latest entry (i.e. the final entry or the initial entry if the json
-                # has been the same all the time)
-                assert record_type in (0, 2), f"Record type is {record_type}, expected 0 or 2"
-                self.debug_execute(f"UPDATE metadata SET last_seen = '{now}', deprecated = 0 WHERE key = {key}")
-                return
+            if self.json_matches(key=key, db_hash=db_hash, json_hash=json_hash, json_arg=json_arg, is_json=True):
+                return self.update_unchanged_json_db(parent_id=parent_id, url=url, key=key, deprecated=deprecated,
+                                                     record_type=record_type)
 
             # Else -> json is different, need to add something to the database. Don't update but insert for later diff
             # else:
@@ -417,15 +789,112 @@ class MetadataLoader(BaseSQliteDB):
             self.logger.debug(f"Inserting new entry to metadata: {url}")
             # Found a new url, is initial so record type 0
             self.debug_execute(
-                f"INSERT INTO metadata (parent, URL, json, found, last_seen, record_type, json_hash) VALUES "
-                f"({parent_id}, '{url}', '{conv_json_arg}', '{now}', '{now}', 0, '{json_hash}')")
+                "INSERT INTO metadata (parent, URL, json, found, last_seen, record_type, json_hash) VALUES "
+                "(?, ?, ?, ?, ?, 0, ?)", (parent_id, url, conv_json_arg, now, now, json_hash))
         else:
             self.logger.debug(f"Adding new state of existing entry to metadata: {url}")
             # Does exist, but json is different, needs to be a new diff entry, so record_type is left empty
             # for diff building
             self.debug_execute(                                              # INFO, record_type is left empty
-                f"INSERT INTO metadata (parent, URL, json, found, last_seen, json_hash) VALUES "
-                f"({parent_id}, '{url}', '{conv_json_arg}', '{now}', '{now}', '{json_hash}')")
+                "INSERT INTO metadata (parent, URL, json, found, last_seen, json_hash) VALUES "
+                "(?, ?, ?, ?, ?, ?)", (parent_id, url, conv_json_arg, now, now, json_hash))
+
+        # The new initial record, or the new state which becomes the latest differential record
+        return self.sq_cur.lastrowid
+
+    def json_matches(self, key: int, db_hash: str, json_hash: str, json_arg: str, is_json: bool) -> bool:
+        """
+        Compare a downloaded document with a stored record by its json_hash. Only records with a legacy hash (from
+        hash(), which is randomized per process) are compared by their content. If they match, the stored hash is
+        replaced with the digest, so the next run doesn't need the content anymore.
+
+        :param key: key of the stored record
+        :param db_hash: json_hash of the stored record
+        :param json_hash: digest of the downloaded document
+        :param json_arg: downloaded document
+        :param is_json: compare the parsed json instead of the string
+        :return: True if the stored record has the same content
+        """
+        if is_json_digest(db_hash):
+            return db_hash == json_hash
+
+        self.debug_execute("SELECT json FROM metadata WHERE key = ?", (key,))
+        json_db = self.sq_cur.fetchone()[0]
+        json_db = from_b64(json_db) if self.ub64 else json_db
+
+        if is_json:
+            match = json.loads(json_db) == json.loads(json_arg)
+        else:
+            match = json_db == json_arg
+
+        if match:
+            self.defer_execute("UPDATE metadata SET json_hash = ? WHERE key = ?", (json_hash, key))
+        return match
+
+    def touch_json_db(self, parent_id: int, url: str) -> Union[int, None]:
+        """
+        Update the last_seen of an entry whose json wasn't modified since the last download (HTTP 304). The json isn't
+        needed for this.
+
+        :param parent_id: id of the parent site in the sites table
+        :param url: url of the metadata
+        :return: key of the record the episodes are linked to, None if no initial or final record exists for the url
+        """
+        self.debug_execute("SELECT key, deprecated, record_type FROM metadata "
+                           "WHERE parent = ? AND URL = ? AND record_type IN (2, 0) "
+                           "ORDER BY record_type DESC LIMIT 1", (parent_id, url))
+        row = self.sq_cur.fetchone()
+
+        if row is None:
+            self.logger.error(f"Not modified response, but no entry in metadata: {url}")
+            return None
+
+        key, deprecated, record_type = row
+        return self.update_unchanged_json_db(parent_id=parent_id, url=url, key=key, deprecated=deprecated,
+                                             record_type=record_type)
+
+    def update_unchanged_json_db(self, parent_id: int, url: str, key: int, deprecated: int, record_type: int) -> int:
+        """
+        Update last_seen of the latest entry (final or initial) of an url whose json is unchanged and of the
+        differential entry belonging to the final entry.
+
+        :param parent_id: id of the parent site in the sites table
+        :param url: url of the metadata
+        :param key: key of the final or initial record
+        :param deprecated: deprecated flag of the record
+        :param record_type: record type of the record (0 or 2)
+        :return: key of the record the episodes are linked to (latest differential or initial record)
+        """
+        now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
+        diff_key = key
+
+        # Differing logging messages depending on if the entry is deprecated or not
+        if deprecated == 1:
+            self.logger.info(f"Reactivating deprecated entry in metadata: {url}")
+        else:
+            self.logger.debug(f"Found active entry in metadata: {url}")
+
+        # Perform the update of the differential entry that belongs to the final entry.
+        if record_type == 2:
+            self.debug_execute("SELECT key FROM metadata "
+                               "WHERE record_type = 1 AND parent = ? AND URL = ? "
+                               "ORDER BY found DESC LIMIT 1", (parent_id, url))
+            row = self.sq_cur.fetchone()
+
+            # Row mustn't be None, since we have a final record
+            assert row is not None, f"Couldn't find differential entry for {url}."
+            diff_key = row[0]
+            self.defer_execute("UPDATE metadata SET last_seen = ?, deprecated = 0 WHERE key = ?", (now, diff_key))
+
+        # Else -> record_type == 0. The final or initial entry needs to be updated anyway, no else block needed
+        # else:
+        #     pass
+
+        # Update the latest entry (i.e. the final entry or the initial entry if the json
+        # has been the same all the time)
+        assert record_type in (0, 2), f"Record type is {record_type}, expected 0 or 2"
+        self.defer_execute("UPDATE metadata SET last_seen = ?, deprecated = 0 WHERE key = ?", (now, key))
+        return diff_key
 
     def deprecate(self, dt: datetime.datetime):
         """
@@ -440,12 +909,10 @@ class MetadataLoader(BaseSQliteDB):
         self.debug_execute("UPDATE metadata SET deprecated = 0")
 
         dts = dt.strftime("%Y-%m-%d %H:%M:%S")
-        self.debug_execute(f"SELECT COUNT(key) FROM metadata "
-                           f"WHERE datetime(last_seen) < datetime('{dts}')")
+        self.debug_execute("SELECT COUNT(key) FROM metadata WHERE last_seen < ?", (dts,))
         count = self.sq_cur.fetchone()[0]
 
-        self.debug_execute(f"UPDATE metadata SET deprecated = 1 "
-                           f"WHERE datetime(last_seen) < datetime('{dts}')")
+        self.debug_execute("UPDATE metadata SET deprecated = 1 WHERE last_seen < ?", (dts,))
 
         self.sq_con.commit()
         self.logger.info(f"Set {count} entries to deprecated")
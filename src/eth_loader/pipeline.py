@@ -0,0 +1,68 @@
+import datetime
+import logging
+from typing import List, Tuple
+
+from eth_loader.metadata_loader import MetadataLoader
+from eth_loader.stream_loader import BetterStreamLoader
+
+"""
+# Pipelined download of metadata and episodes
+
+Sequentially, the episodes are downloaded once the metadata download is done and the episode urls are read back from
+the metadata table. In the pipelined mode the metadata loader hands every series it wrote to the stream loader
+(episode_sink), whose workers download the episodes while the metadata download is still running. The stage takes
+about as long as the episode download alone.
+
+Both loaders write the same database from their own thread and connection. Their transactions are kept short (batch_ms)
+and a writer waits for the other one (busy_timeout) instead of failing with 'database is locked'. A writer holding
+the lock for a full batch would stall the other stage, its workers block on the full result queue.
+
+The metadata increment must be built after the pipeline (before the episode increment), as in the sequential order.
+
+Sinks: pairs of loaders of further databases (e.g. the base64 and the plain database) written from the same downloads.
+The metadata loader of a sink registers its series with the stream loader of the sink, the episode results are matched
+to them by url.
+"""
+
+
+def download_pipelined(metadata: MetadataLoader, streams: BetterStreamLoader, dt: datetime.datetime,
+                       workers: int = 100, engine: str = "thread", busy_timeout: float = 60, batch_ms: int = 100,
+                       sinks: List[Tuple[MetadataLoader, BetterStreamLoader]] = None):
+    """
+    Download the metadata and the episodes of all video sites in one stage.
+
+    :param metadata: metadata loader of the database
+    :param streams: stream loader of the same database
+    :param dt: datetime of last site indexing
+    :param workers: number of workers per loader (requests in flight for the async engine)
+    :param engine: "thread" for worker threads, "async" for a single asyncio event loop per loader
+    :param busy_timeout: seconds a writer waits for the transaction of the other one
+    :param batch_ms: maximum duration of a transaction of both writers in milliseconds
+    :param sinks: (metadata loader, stream loader) of every further database the results are written to
+    :return:
+    """
+    logger = logging.getLogger("pipeline")
+    sinks = sinks if sinks is not None else []
+
+    for sink_metadata, sink_streams in sinks:
+        metadata.add_sink(sink_metadata)
+        streams.add_sink(sink_streams)
+        sink_metadata.episode_sink = sink_streams.register_series
+        sink_metadata.set_busy_timeout(busy_timeout)
+
+    metadata.episode_sink = streams.episode_sink
+    metadata.writer.batch_ms = batch_ms
+    metadata.set_busy_timeout(busy_timeout)
+    streams.writer.batch_ms = batch_ms
+
+    streams.start_pipeline(workers=workers, engine=engine, busy_timeout=busy_timeout)
+    try:
+        metadata.download(dt, workers, engine=engine)
+    finally:
+        # the stream loader must stop even if the metadata download failed
+        streams.finish_pipeline()
+        metadata.episode_sink = None
+        for sink_metadata, _ in sinks:
+            sink_metadata.episode_sink = None
+
+    logger.info("PIPELINED DOWNLOAD DONE")
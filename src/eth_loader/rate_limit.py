@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+
+"""
+# Rate limit of the requests
+
+Token buckets shared by all fetchers (worker threads, async engine, logins) of a stage. Every request takes a token
+of the bucket of its host and, if configured, of the bucket of the longest matching path prefix (e.g. /lectures) of
+that host. A bucket holds up to `burst` tokens and is refilled with `rate` tokens per second.
+
+A request reserves its tokens under a lock and is told how long to wait until they are available, the waiting happens
+outside the lock (time.sleep in the worker threads, asyncio.sleep on the event loop). Reserved tokens may drive a
+bucket negative, later requests queue up behind the earlier ones.
+
+The time every request waited for its tokens is accounted and compared to the time spent in the requests: a stage
+spending most of its time waiting for tokens is limiter-bound, otherwise network-bound.
+"""
+
+
+class TokenBucket:
+    """
+    Single token bucket, not thread-safe on its own (RateLimiter holds the lock).
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        """
+        :param rate: tokens per second
+        :param burst: capacity of the bucket, defaults to one second worth of tokens (at least 1)
+        """
+        if rate <= 0:
+            raise ValueError("Rate must be greater than 0")
+
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        if self.burst < 1:
+            raise ValueError("Burst must be greater than 0")
+
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+
+    def reserve(self, now: float) -> float:
+        """
+        Take a token.
+
+        :param now: time.monotonic() of the request
+        :return: seconds until the token is available
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateLimiter:
+    """
+    Token buckets per host and per path prefix. Thread-safe, usable from worker threads and event loops at once.
+    """
+
+    def __init__(self, default: Tuple[float, int] = None, hosts: Dict[str, Tuple[float, int]] = None,
+                 prefixes: Dict[str, Tuple[float, int]] = None, logger_name: str = "thread_handler"):
+        """
+        :param default: (rate, burst) of every host without entry in hosts, None for no limit
+        :param hosts: host -> (rate, burst), like {"www.video.ethz.ch": (20, 20)}
+        :param prefixes: path prefix -> (rate, burst), like {"/lectures": (10, 10)}, one bucket per host and prefix.
+            Applies on top of the bucket of the host.
+        :param logger_name: logger of the owning loader
+        """
+        self.default = default
+        self.hosts = hosts if hosts is not None else {}
+        self.prefixes = prefixes if prefixes is not None else {}
+        self.logger = logging.getLogger(logger_name)
+
+        # longest prefix first
+        self.__prefix_order = sorted(self.prefixes, key=len, reverse=True)
+        self.__buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self.__lock = threading.Lock()
+
+        self.requests = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.request_time = 0.0
+
+    def __limits(self, url: str) -> List[Tuple[Tuple[str, str], Tuple[float, int]]]:
+        """
+        (bucket key, (rate, burst)) of all buckets an url takes a token of.
+        """
+        parts = urlsplit(url)
+        host = parts.hostname or ""
+        limits = []
+
+        host_limit = self.hosts.get(host, self.default)
+        if host_limit is not None:
+            limits.append(((host, ""), host_limit))
+
+        for prefix in self.__prefix_order:
+            if parts.path.startswith(prefix):
+                limits.append(((host, prefix), self.prefixes[prefix]))
+                break
+
+        return limits
+
+    def __reserve(self, url: str) -> float:
+        """
+        Take the tokens of an url, returns the seconds to wait for them.
+        """
+        limits = self.__limits(url)
+        with self.__lock:
+            now = time.monotonic()
+            delay = 0.0
+            for key, (rate, burst) in limits:
+                bucket = self.__buckets.get(key)
+                if bucket is None:
+                    bucket = self.__buckets[key] = TokenBucket(rate, burst)
+                delay = max(delay, bucket.reserve(now))
+
+            self.requests += 1
+            if delay > 0:
+                self.waited += 1
+                self.wait_time += delay
+                self.max_wait = max(self.max_wait, delay)
+
+        if delay > 0:
+            self.logger.debug(f"Waiting {delay:.3f}s for a token for {url}")
+        return delay
+
+    def wait(self, url: str) -> float:
+        """
+        Block the calling thread until the request of the url may be sent.
+
+        :param url: url of the request
+        :return: seconds waited
+        """
+        delay = self.__reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    async def wait_async(self, url: str) -> float:
+        """
+        Wait without blocking the event loop until the request of the url may be sent.
+
+        :param url: url of the request
+        :return: seconds waited
+        """
+        delay = self.__reserve(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def record(self, latency: float):
+        """
+        Account the time a request took once it got its token.
+
+        :param latency: seconds of the request
+        """
+        with self.__lock:
+            self.request_time += latency
+
+    def stats_str(self) -> str:
+        """
+        Human readable summary of the waits for the logs.
+        """
+        with self.__lock:
+            total = self.wait_time + self.request_time
+            share = self.wait_time / total * 100 if total > 0 else 0
+            return (f"Rate limit: {self.requests} requests, {self.waited} waited for a token, "
+                    f"{self.wait_time:.1f}s waiting (max {self.max_wait:.2f}s) vs {self.request_time:.1f}s in "
+                    f"requests, {share:.0f}% limiter-bound")
+
@@ -0,0 +1,132 @@
+import asyncio
+import random
+import threading
+from typing import Dict, Union
+
+import requests as rq
+
+"""
+# Retry policy of the downloads
+
+A request failing with a transient error is retried after a jittered exponential backoff (full jitter, a random delay
+between 0 and min(max_delay, base_delay * 2 ** retry)), so the workers don't hit a struggling server in lockstep.
+
+Errors are classified:
+- timeout: the request timed out
+- connection: any other exception (connection refused, reset, dns, ...)
+- server: status 5xx
+- throttle: status 429, a Retry-After header is respected (capped by max_delay)
+- client: any other status >= 400, permanent, never retried
+
+Every class has a number of retries per request (attempts) and a budget of retries for the whole stage. Once the
+budget of a class is spent (e.g. the server is down), its failures are handed to the loader right away instead of
+piling up retries. The loaders download the failed urls once more in a requeue pass after the main pass.
+"""
+
+RETRYABLE = ("timeout", "connection", "server", "throttle")
+
+
+def error_class(status: int = None, exc: BaseException = None) -> Union[str, None]:
+    """
+    Classify the outcome of a request.
+
+    :param status: http status code of the response, None if the request raised
+    :param exc: exception raised by the request
+    :return: error class, None if the request succeeded (including 304)
+    """
+    if exc is not None:
+        if isinstance(exc, (rq.Timeout, asyncio.TimeoutError, TimeoutError)):
+            return "timeout"
+        return "connection"
+
+    if status == 429:
+        return "throttle"
+    if status >= 500:
+        return "server"
+    if status >= 400:
+        return "client"
+    return None
+
+
+def retry_after(headers) -> Union[float, None]:
+    """
+    Seconds from the Retry-After header of a response, None if missing or given as a date.
+
+    :param headers: headers of the response (case-insensitive mapping of requests or aiohttp)
+    """
+    value = headers.get("Retry-After") if headers is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RetryPolicy:
+    """
+    Retries per request and budget per error class of a stage. Thread-safe, shared by all workers of a loader.
+    """
+
+    def __init__(self, attempts: Dict[str, int] = None, budget: Dict[str, int] = None, base_delay: float = 0.5,
+                 max_delay: float = 30.0):
+        """
+        :param attempts: error class -> maximum number of retries of a single request, classes without entry aren't
+            retried. Defaults to 3 for timeout, connection and server errors, 5 when throttled.
+        :param budget: error class -> maximum number of retries of the stage, classes without entry are unlimited.
+        :param base_delay: seconds of the first backoff
+        :param max_delay: maximum seconds of a single backoff
+        """
+        if base_delay < 0 or max_delay < base_delay:
+            raise ValueError("Delays must satisfy 0 <= base_delay <= max_delay")
+
+        self.attempts = attempts if attempts is not None else {"timeout": 3, "connection": 3, "server": 3,
+                                                                 "throttle": 5}
+        self.budget = dict(budget) if budget is not None else {}
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.__lock = threading.Lock()
+        self.retries: Dict[str, int] = {}
+        self.exhausted: Dict[str, int] = {}
+
+    def should_retry(self, error: Union[str, None], retry: int) -> bool:
+        """
+        Decide if a failed request is retried and take the retry from the budget.
+
+        :param error: error class of the request (see error_class), None if it succeeded
+        :param retry: number of retries of the request so far
+        :return: True if the request should be sent again after delay()
+        """
+        if error is None or retry >= self.attempts.get(error, 0):
+            return False
+
+        with self.__lock:
+            if error in self.budget:
+                if self.budget[error] <= 0:
+                    self.exhausted[error] = self.exhausted.get(error, 0) + 1
+                    return False
+                self.budget[error] -= 1
+
+            self.retries[error] = self.retries.get(error, 0) + 1
+        return True
+
+    def delay(self, retry: int, after: float = None) -> float:
+        """
+        Seconds to wait before the retry.
+
+        :param retry: number of retries of the request so far
+        :param after: Retry-After of the response, used as lower bound
+        :return: jittered exponential backoff
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+        if after is not None:
+            delay = max(delay, min(after, self.max_delay))
+        return delay
+
+    def stats_str(self) -> str:
+        """
+        Human readable summary of the retries for the logs.
+        """
+        with self.__lock:
+            retries = ", ".join(f"{k} {v}" for k, v in sorted(self.retries.items())) or "none"
+            exhausted = ", ".join(f"{k} {v}" for k, v in sorted(self.exhausted.items())) or "none"
+        return f"Retries: {retries}; not retried, budget spent: {exhausted}"
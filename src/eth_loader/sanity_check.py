@@ -6,8 +6,8 @@ from eth_loader.base_sql import BaseSQliteDB
 
 
 class SanityCheck(BaseSQliteDB):
-    def __init__(self, db_path: str):
-        super().__init__(db_path)
+    def __init__(self, db_path: str, profile: str = None):
+        super().__init__(db_path, profile=profile)
         self.logger = logging.getLogger("sanity_checker")
 
     def _perform_check(self,
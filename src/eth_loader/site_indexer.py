@@ -1,33 +1,48 @@
 import datetime
+import json
 import os.path
+import re
 import sqlite3
-import requests as rq
 from lxml import etree
 from lxml.etree import _Element
-import multiprocessing as mp
-from threading import Thread
-from time import sleep
-from queue import Empty
 import logging
+from typing import Set, Tuple, Union
+from eth_loader.async_engine import AsyncEngine
+from eth_loader.aux import json_digest
 from eth_loader.base_sql import BaseSQliteDB
+from eth_loader.batch_writer import BatchWriter
+from eth_loader.concurrency import AdaptiveConcurrency, slot
+from eth_loader.frontier import Frontier
+from eth_loader.http_session import SessionPool
+from eth_loader.job_ledger import JobLedger
+from eth_loader.rate_limit import RateLimiter
+from eth_loader.retry import error_class
+from eth_loader.validators import conditional_headers, response_validators
+from eth_loader.worker_pool import WorkerPool
 
 """
 # Functionality of Class:
 
 ## Life cycle of ConcurrentETHSiteIndexer
-- init: create the queues and initialize the attributes, connect to the database
-- index_video_eth: schedule all links (hrefs) found on the root site of video site of the eth for the workers.
-    uses sub_index to add the first results to the ingest queue (can be switched to __sub_index func for debugging)
+- init: initialize the attributes, connect to the database
+- index_video_eth: spawns the worker pool and schedules all links (hrefs) found on the root site of video site of the
+    eth for the workers. uses sub_index to add the first jobs to the pool. Every url passes the frontier (visited set,
+    normalization, depth limits, priority), so each site is downloaded once per crawl.
 - spawn: spawns the workers and returns (doesn't wait for workers to exit)
-- dequeue: dequeues the results from the results queue, uses 'not_in_db' to insert only the new results into the db
-    uses 'workers_alive' to check if new results are still added to the queue, 
+- incremental mode: branch sites store a fingerprint (digest of the sorted list of children) and the validators
+    (ETag, Last-Modified) of the last crawl. A branch site is requested conditionally, if it is unchanged (304 or same
+    fingerprint) its video children aren't downloaded again, their last_seen is carried forward. Branch children are
+    still crawled (conditionally), so new videos on a deeper level are found. After `full_recrawl` days the video
+    children of a branch are downloaded again.
+- dequeue: dequeues the results from the pool in batches, uses 'not_in_db' to insert only the new results into the db
+    returns once the results of all jobs (including the recursively submitted ones) are written
 - gen_parent: create the linking to create the site hirarchie in the database with foreign keys.
-    uses 'get_url_id' to find the key of the parent. store the result in dict to make accessing faster (db is slow)
+    loads url -> key of all branch sites into a dict and links all sites without parent in one executemany.
 
 ## Worker life cycle
-- __indexer: try to dequeue, queue empty for 20s, exit, uses '__sub_index' to recursively search site
-- __sub_index: fetches page from arguments, checks if page is a video if so, put that in queue, and return
-    else, put no video in queue and  get all hrefs, make sure the parent matches, then add them to the todo queue
+- __indexer: job function of the pool, uses '__sub_index' to recursively search site
+- __sub_index: fetches page from arguments, checks if page is a video if so, return that as result
+    else, get all hrefs, make sure the parent matches, submit them to the pool and return no video as result
 
 """
 
@@ -48,6 +63,107 @@ def parent_site(url: str) -> str:
     return url
 
 
+# start of the markup the crawler looks for, the parser starts there instead of the top of the page
+_VIDEO_TAG = re.compile(r"<vp-episode-page[\s/>]", re.IGNORECASE)
+_LINK_BOX = re.compile(r"<div\s[^>]*newsListBox", re.IGNORECASE)
+
+# (opening, closing) of the sections where markup is text
+_RAW_TEXT = (("<script", "</script"), ("<style", "</style"), ("<!--", "-->"))
+
+
+class PageScanner:
+    """
+    Parser target of lxml collecting what the crawler needs from a page without building the tree: whether the page
+    contains the video player (vp-episode-page element) and the hrefs of the <a> elements that are direct children
+    of a <div class="newsListBox">. Equivalent to is_video and the xpath //div[@class='newsListBox']/a on the tree.
+    """
+    def __init__(self):
+        self.video = False
+        self.hrefs = []
+
+        # depth of the open elements and the depths of the open link boxes
+        self.__depth = 0
+        self.__boxes = []
+
+    def start(self, tag, attrib):
+        if tag == "vp-episode-page":
+            self.video = True
+        elif tag == "div" and attrib.get("class") == "newsListBox":
+            self.__boxes.append(self.__depth)
+        elif tag == "a" and len(self.__boxes) > 0 and self.__boxes[-1] == self.__depth - 1:
+            if "href" in attrib:
+                self.hrefs.append(attrib["href"])
+
+        self.__depth += 1
+
+    def end(self, tag):
+        self.__depth -= 1
+        if len(self.__boxes) > 0 and self.__boxes[-1] == self.__depth:
+            self.__boxes.pop()
+
+    @property
+    def in_box(self) -> bool:
+        return len(self.__boxes) > 0
+
+    def close(self):
+        return self.video, self.hrefs
+
+
+def _in_raw_text(html: str, pos: int) -> bool:
+    """
+    Check if the position of the page is inside a script, style or comment, where the parser doesn't see elements.
+    """
+    head = html[:pos].lower()
+    return any(head.rfind(opening) > head.rfind(closing) for opening, closing in _RAW_TEXT)
+
+
+def _feed(html: str, start: int, end: int, chunk_size: int) -> Tuple[bool, list]:
+    """
+    Feed the page from start to the parser, once past end scanning stops as soon as no link box is open.
+    """
+    scanner = PageScanner()
+    parser = etree.HTMLParser(target=scanner)
+
+    for i in range(start, len(html), chunk_size):
+        parser.feed(html[i:i + chunk_size])
+        if scanner.video:
+            return True, []
+        if i + chunk_size > end and not scanner.in_box:
+            break
+
+    video, hrefs = parser.close()
+    return video, [] if video else hrefs
+
+
+def scan_page(html: str, chunk_size: int = 4096) -> Tuple[bool, list]:
+    """
+    Scan a page for the video player and the links of the newsListBox. Same result as is_video and the xpath
+    //div[@class='newsListBox']/a on the tree of the page, but the navigation, header and footer of the page
+    (most of its size) aren't parsed:
+    - the video player is located by its tag, the links of video pages aren't needed.
+    - otherwise the parser starts at the first link box and stops after the last one is closed.
+    If a match is inside a script, style or comment, the whole page is parsed.
+
+    :param html: content of the page
+    :param chunk_size: number of characters fed to the parser at once
+
+    :return: True if the page is a video, hrefs of the links in the newsListBox divs (empty for videos)
+    """
+    video = _VIDEO_TAG.search(html)
+    if video is not None:
+        if not _in_raw_text(html, video.start()):
+            return True, []
+        return _feed(html, 0, len(html), chunk_size)
+
+    box = _LINK_BOX.search(html)
+    if box is None:
+        return False, []
+    if _in_raw_text(html, box.start()):
+        return _feed(html, 0, len(html), chunk_size)
+
+    return _feed(html, box.start(), html.rfind("newsListBox"), chunk_size)
+
+
 def is_video(root: _Element) -> bool:
     """
     Checks if the video is present on the video.
@@ -71,7 +187,9 @@ class ETHSiteIndexer(BaseSQliteDB):
     It also has a found tag which stores the date the site was found.
     """
 
-    def __init__(self, db_file: str, start_dt: datetime.datetime, prefixes: list = None):
+    def __init__(self, db_file: str, start_dt: datetime.datetime, prefixes: list = None, batch_size: int = 500,
+                 batch_ms: int = 1000, profile: str = None, max_depth: dict = None, priorities: dict = None,
+                 use_ledger: bool = True, concurrency: AdaptiveConcurrency = None, rate_limit: RateLimiter = None):
         """
         Initializer for concurrent indexing of entire video.ethz.ch site.
 
@@ -80,6 +198,16 @@ class ETHSiteIndexer(BaseSQliteDB):
         :param db_file: Database where the results are stored. (at the time 6460 urls)
         :param prefixes: provide custom prefixes, main_header [campus, lectures, ...]
         :param start_dt: Datetime at which this operation is performed.
+        :param batch_size: maximum number of results written per transaction
+        :param batch_ms: maximum time in milliseconds between two commits while results are coming in
+        :param profile: sqlite performance profile of the connection (see base_sql.PROFILES), None for the defaults
+        :param max_depth: maximum crawl depth per prefix like {"/lectures": 4}, prefixes without entry are unlimited
+        :param priorities: offset of the crawl priority per prefix, sites with lower priority are crawled first
+        :param use_ledger: track the video sites in the job ledger, a crawl with the same start_dt resumes the run and
+            doesn't download the video sites already done (branch sites are always loaded, they contain the links)
+        :param concurrency: adaptive limit of the requests in flight (at most the number of threads), None to keep all
+            threads busy
+        :param rate_limit: token buckets per host and path prefix shared by all requests, None for no limit
         """
         make_db = not os.path.exists(db_file)
 
@@ -90,16 +218,52 @@ class ETHSiteIndexer(BaseSQliteDB):
         if prefixes is not None:
             self.prefixes = prefixes
 
-        super().__init__(db_file)
+        super().__init__(db_file, profile=profile)
 
         if make_db:
             self.init_db()
 
         self.test_indexes()
+        self.check_crawl_columns()
+
+        self.pool = None
+        self.session_pool = None
+        self.engine = None
+
+        self.max_depth = max_depth
+        self.priorities = priorities
+        self.frontier = None
+
+        # incremental crawl, read only for the workers once the crawl started
+        self.incremental = False
+        self.full_recrawl = 7
+        self.crawl_state = {}
+        self.known_children = {}
+        self.__carried_counter = 0
+
+        # resumed run, read only for the workers once the crawl started
+        self.ledger = JobLedger(self, stage="sites") if use_ledger else None
+        self.done_urls: Set[str] = set()
 
-        self.to_download_queue = mp.Queue()
-        self.found_url_queue = mp.Queue(maxsize=100)
-        self.threads = []
+        # shared by the workers, thread-safe
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+
+        self.writer = BatchWriter(self, store=self.store_result, batch_size=batch_size, batch_ms=batch_ms,
+                                  logger_name="site_indexer")
+        self.__insert_counter = 0
+        self.__found_counter = 0
+
+    def add_sink(self, sink: "ETHSiteIndexer"):
+        """
+        Write the results of the crawl to another database as well (e.g. the base64 and the plain database), the
+        sites are downloaded once. The incremental crawl state is the one of this indexer, the sink should have been
+        written by the same crawls. gen_parent needs to be called on the sink separately.
+
+        :param sink: indexer of the other database
+        :return:
+        """
+        self.writer.add_sink(sink, sink.store_result)
 
     def val_uri(self, url: str) -> bool:
         """
@@ -132,6 +296,39 @@ class ETHSiteIndexer(BaseSQliteDB):
         self.debug_execute("CREATE INDEX IF NOT EXISTS c ON sites (key)")
         self.debug_execute("CREATE INDEX IF NOT EXISTS site_url_index ON sites (URL)")
         self.debug_execute("CREATE INDEX IF NOT EXISTS site_parent_index ON sites (parent)")
+        # Timestamps are canonical text (YYYY-MM-DD HH:MM:SS), compared directly so the indexes can be used
+        self.debug_execute("CREATE INDEX IF NOT EXISTS site_video_last_seen_index ON sites (IS_VIDEO, last_seen)")
+
+    def check_crawl_columns(self):
+        """
+        Add the columns of the incremental crawl to the sites table if they don't exist (databases created before).
+        """
+        self.debug_execute("PRAGMA table_info(sites)")
+        columns = {row[1] for row in self.sq_cur.fetchall()}
+
+        for col in ("fingerprint", "etag", "last_modified", "last_full_crawl"):
+            if col not in columns:
+                self.logger.info(f"Adding column {col} to sites")
+                self.debug_execute(f"ALTER TABLE sites ADD COLUMN {col} TEXT")
+        self.sq_con.commit()
+
+    def load_crawl_state(self):
+        """
+        Load fingerprint, validators and the children of the last crawl of all branch sites for the incremental crawl.
+        Children of the last crawl are the sites linked to the branch with the same last_seen.
+        """
+        self.debug_execute("SELECT URL, fingerprint, etag, last_modified, last_full_crawl FROM sites "
+                           "WHERE IS_VIDEO = 0 AND fingerprint IS NOT NULL")
+        self.crawl_state = {row[0]: {"fingerprint": row[1], "etag": row[2], "last_modified": row[3],
+                                     "last_full_crawl": row[4]} for row in self.sq_cur.fetchall()}
+
+        self.known_children = {}
+        self.debug_execute("SELECT p.URL, c.URL, c.IS_VIDEO FROM sites AS c JOIN sites AS p ON c.parent = p.key "
+                           "WHERE p.IS_VIDEO = 0 AND p.fingerprint IS NOT NULL AND c.last_seen = p.last_seen")
+        for parent_url, url, video in self.sq_cur.fetchall():
+            self.known_children.setdefault(parent_url, {})[url] = video
+
+        self.logger.info(f"Loaded crawl state of {len(self.crawl_state)} branch sites")
 
 
     def init_db(self):
@@ -165,17 +362,46 @@ class ETHSiteIndexer(BaseSQliteDB):
             f"VALUES (0, -1, 'https://www.video.ethz.ch', 0, '{now}', '{now}')")
         self.logger.info("Table Created")
 
-    def index_video_eth(self, threads : int = 100):
+    def index_video_eth(self, threads : int = 100, engine: str = "thread", incremental: bool = False,
+                        full_recrawl: int = 7):
         """
         Starts the indexing of the site.
 
-        :param threads: number of concurrent threads to spawn.
+        :param threads: number of concurrent threads to spawn (requests in flight for the async engine).
+        :param engine: "thread" for worker threads, "async" for a single asyncio event loop
+        :param incremental: don't download the video children of unchanged branch sites again
+        :param full_recrawl: days after which the video children of a branch site are downloaded again in
+            incremental mode
 
         :return:
         """
+        if engine not in ("thread", "async"):
+            raise ValueError(f"Engine {engine} not recognized")
+
+        if full_recrawl < 0:
+            raise ValueError("Full recrawl interval must not be negative")
+
+        self.incremental = incremental
+        self.full_recrawl = full_recrawl
+        if incremental:
+            self.load_crawl_state()
+
+        if self.ledger is not None:
+            self.done_urls = self.ledger.start(self.start_dt)
+            for sink, _ in self.writer.sinks:
+                if sink.ledger is not None:
+                    self.done_urls &= sink.ledger.start(sink.start_dt)
+            if self.ledger.resumed:
+                self.logger.info(f"Resuming run {self.ledger.run}, {len(self.done_urls)} video sites already done")
+
+        # one connection pool shared by all indexer threads
+        self.session_pool = SessionPool(pool_size=threads)
+        self.frontier = Frontier(max_depth=self.max_depth, priorities=self.priorities, logger_name="site_indexer")
+
         # load main site
         try:
-            resp = rq.get("https://www.video.ethz.ch/", headers={"user-agent": "Mozilla Firefox"})
+            with slot(None, self.rate_limit, "https://www.video.ethz.ch/"):
+                resp = self.session_pool.get("https://www.video.ethz.ch/", headers={"user-agent": "Mozilla Firefox"})
         except Exception as e:
             self.logger.exception("Failed to load main site", exc_info=e)
             return
@@ -200,78 +426,225 @@ class ETHSiteIndexer(BaseSQliteDB):
                 if self.val_uri(uri) and uri not in uris:
                     uris.append(uri)
                     self.logger.debug(f"uri {uri}")
-                    self.sub_index(f"https://www.video.ethz.ch{uri}", uri)
 
-        self.spawn(threads=threads)
+        if engine == "async":
+            self.engine = AsyncEngine(fetch=self.__async_sub_index, concurrency=threads, logger_name="site_indexer")
+            jobs = [self.frontier.push(uri, depth=0) for uri in uris]
+            self.engine.start(job for job in jobs if job is not None)
+            self.pool = self.engine
+        else:
+            self.spawn(threads=threads)
+            for uri in uris:
+                self.sub_index(uri, depth=0)
+            self.pool.close()
+
         self.dequeue()
 
         self.logger.info("Cleanup")
         self.cleanup_workers()
         self.sq_con.commit()
 
-    def __sub_index(self, url: str, prefix: str):
+        self.logger.info(self.frontier.stats_str())
+        if self.ledger is not None:
+            self.logger.info(self.ledger.stats_str())
+        if self.incremental:
+            self.logger.info(f"Carried last_seen of {self.__carried_counter} unchanged video sites forward")
+        self.logger.info(self.session_pool.stats_str())
+        self.session_pool.close()
+        if self.engine is not None:
+            self.logger.info(f"Async engine {self.engine.stats_str()}")
+        if self.concurrency is not None:
+            self.logger.info(self.concurrency.stats_str())
+        if self.rate_limit is not None:
+            self.logger.info(self.rate_limit.stats_str())
+
+    def __sub_index(self, url: str, prefix: str, depth: int):
         """
         Function that loads sub site and then proceeds to search it for either a video div or a list of sub sites.
-        Sub sites are put into the to_download queue, video urls are put in the video_url queue
+        Sub sites are submitted to the pool, the site itself is returned as the result of the job.
 
-        WARNING: This function is a member function of the same object. As a result it has access to the queues.
-        HOWEVER, it can create data-races so DO NOT ACCESS ANYTHING ELSE OTHER THAN THE QUEUES!
+        WARNING: This function is a member function of the same object. As a result it has access to the pool.
+        HOWEVER, it can create data-races so DO NOT ACCESS ANYTHING ELSE OTHER THAN THE POOL (AND THE THREAD-SAFE
+        SESSION POOL)!
 
         :param url: full url of sub site to index like https://www.video.ethz.ch/speakers/d-infk/2015.html
         :param prefix: prefix of the site, only searching urls with identical prefix, like /speakers/d-infk
+        :param depth: depth of the site in the crawl
 
-        :return:
+        :return: dict with url and is_video, None if the site couldn't be loaded
         """
+        # video site written before the run was interrupted
+        if url in self.done_urls:
+            return None
+
+        state = self.crawl_state.get(url) if self.incremental else None
+
         # load target site
         try:
-            resp = rq.get(url, headers={"user-agent": "Mozilla Firefox"})
+            with slot(self.concurrency, self.rate_limit, url) as request:
+                resp = self.session_pool.get(url, headers=conditional_headers({"user-agent": "Mozilla Firefox"}, state))
+                request.error = error_class(status=resp.status_code)
         except Exception as e:
             self.logger.exception(f"Failed to load {url}", exc_info=e)
-            return
-        # get the html
-        html = resp.content.decode("utf-8")
+            return None
 
-        # prepare for xpath
-        tree = etree.HTML(html)
-        # x = tree.xpath("//a")
+        if resp.status_code == 304:
+            found, children = self.__plan_unmodified(url, state, response_validators(resp.headers))
+        else:
+            # get the html
+            html = resp.content.decode("utf-8")
+            found, children = self.__process_page(url, prefix, html)
+            found, children = self.__plan_children(found, children, state, response_validators(resp.headers))
+
+        # children need to be submitted before the result is handed out, otherwise the pool might consider itself done
+        for uri in children:
+            self.sub_index(uri, depth=depth + 1)
 
-        # get the box where the list of 'child organizers' are stored say d-infk/[list of all years.]
-        x = tree.xpath("//div[@class='newsListBox']/a")
+        self.logger.debug(f"Done {url}")
+        return found
+
+    async def __async_sub_index(self, session, job: dict, submit):
+        """
+        Coroutine equivalent of __sub_index for the async engine. Child sites are submitted to the engine instead of
+        the pool.
+
+        :param session: aiohttp.ClientSession of the engine
+        :param job: dict with url, prefix and depth, identical to the arguments of __sub_index
+        :param submit: schedules a job in the engine
+
+        :return: dict with url and is_video, None if the site couldn't be loaded
+        """
+        url = job["url"]
+        if url in self.done_urls:
+            return None
+
+        state = self.crawl_state.get(url) if self.incremental else None
+        try:
+            headers = conditional_headers({"user-agent": "Mozilla Firefox"}, state)
+            async with slot(self.concurrency, self.rate_limit, url) as request:
+                async with session.get(url, headers=headers) as resp:
+                    html = (await resp.read()).decode("utf-8")
+                    status = resp.status
+                    validators = response_validators(resp.headers)
+                request.error = error_class(status=status)
+        except Exception as e:
+            self.logger.exception(f"Failed to load {url}", exc_info=e)
+            return None
+
+        if status == 304:
+            found, children = self.__plan_unmodified(url, state, validators)
+        else:
+            found, children = self.__process_page(url, job["prefix"], html)
+            found, children = self.__plan_children(found, children, state, validators)
+        for uri in children:
+            child = self.frontier.push(uri, depth=job["depth"] + 1)
+            if child is not None:
+                submit(child)
+
+        self.logger.debug(f"Done {url}")
+        return found
+
+    def __process_page(self, url: str, prefix: str, html: str) -> Tuple[dict, list]:
+        """
+        Searches a loaded site for either a video div or a list of sub sites.
+
+        :param url: full url of the site
+        :param prefix: prefix of the site, only searching urls with identical prefix, like /speakers/d-infk
+        :param html: content of the site
+
+        :return: result for the site (dict with url and is_video), list of uris of the sub sites to index
+        """
+        # single pass over the page for the video player and the box where the list of 'child organizers' are
+        # stored say d-infk/[list of all years.]
+        video, hrefs = scan_page(html)
 
         # dump the site to the list of video urls if it matches
-        if is_video(tree):
+        if video:
 
             self.logger.debug(f"put {url}, video")
-            self.found_url_queue.put({"url": url, "is_video": 1})
-            return
+            return {"url": url, "is_video": 1}, []
 
         else:
             self.logger.debug(f"put {url}, branch")
-            self.found_url_queue.put({"url": url, "is_video": 0})
 
-        # find all <a> elements
-        for a in x:
-            a: _Element
+        children = []
 
-            # asure href is a key
-            if "href" in a.keys():
-                uri = a.attrib["href"]
+        # hrefs of all <a> elements in the boxes
+        for uri in hrefs:
+            # verify it is on the same branch but not the same uri
+            if (prefix.split(".")[0] in uri) and (prefix != uri):
+                children.append(uri)
 
-                # verify it is on the same branch but not the same uri
-                if (prefix.split(".")[0] in uri) and (prefix != uri):
-                    self.sub_index(f"https://www.video.ethz.ch{uri}", uri)
+        return {"url": url, "is_video": 0}, children
 
-        self.logger.debug(f"Done {url}")
+    def __plan_unmodified(self, url: str, state: dict, validators: dict) -> Tuple[dict, list]:
+        """
+        Result and children of a branch site answered with 304. The children are the ones of the last crawl.
+
+        :param url: full url of the site
+        :param state: crawl state of the site (fingerprint, validators, last_full_crawl)
+        :param validators: validators of the 304 response
+
+        :return: result for the site, list of uris of the sub sites to index
+        """
+        children = [u[len(self.frontier.base_url):] for u in self.known_children.get(url, {})]
+        found = {"url": url, "is_video": 0, "fingerprint": state["fingerprint"]}
+
+        # a 304 may omit the validators, keep the ones of the request
+        validators = {k: validators.get(k) or state.get(k) for k in ("etag", "last_modified")}
+        return self.__plan_children(found, children, state, validators, unchanged=True)
+
+    def __plan_children(self, found: dict, children: list, state: Union[dict, None], validators: dict,
+                        unchanged: bool = False) -> Tuple[dict, list]:
+        """
+        Decide which children of a site are crawled. If the site is unchanged since the last crawl and the video
+        children were downloaded within the full recrawl interval, the video children aren't downloaded, they're
+        handed to the writer to carry their last_seen forward.
+
+        :param found: result for the site
+        :param children: uris of the sub sites
+        :param state: crawl state of the site, None if unknown or not crawling incrementally
+        :param validators: validators of the response
+        :param unchanged: site is known to be unchanged (304)
+
+        :return: result for the site (with fingerprint, validators, carried video urls), list of uris to crawl
+        """
+        if found["is_video"] == 1:
+            return found, children
+
+        if "fingerprint" not in found:
+            found["fingerprint"] = json_digest(json.dumps(sorted(set(children))))
+        found["validators"] = validators
+        found["carried"] = []
+        found["full_crawl"] = True
+
+        if state is None:
+            return found, children
+
+        unchanged = unchanged or found["fingerprint"] == state["fingerprint"]
+        limit = (self.start_dt - datetime.timedelta(days=self.full_recrawl)).strftime("%Y-%m-%d %H:%M:%S")
+        if not unchanged or state["last_full_crawl"] is None or state["last_full_crawl"] <= limit:
+            return found, children
+
+        known = self.known_children.get(found["url"], {})
+        crawl = []
+        for uri in children:
+            url = self.frontier.normalize(uri, base=self.frontier.base_url + "/")
+            if known.get(url) == 1:
+                found["carried"].append(url)
+            else:
+                crawl.append(uri)
+
+        found["full_crawl"] = False
+        return found, crawl
 
     def cleanup_workers(self):
         """
-        Waits for all worker processes to terminate and then joins them.
+        Waits for all workers to terminate and then joins them.
 
         :return:
         """
-        for worker in self.threads:
-            worker: Thread
-            worker.join(10)
+        self.pool.stop()
 
     def spawn(self, threads: int = 100):
         """
@@ -284,98 +657,107 @@ class ETHSiteIndexer(BaseSQliteDB):
         if not 1 < threads < 10000:
             raise ValueError("Thread number outside supported range [1:10'000]")
 
-        for i in range(threads):
-            t = Thread(target=self.__indexer, args=(i,))
-            t.start()
-            self.threads.append(t)
+        # The workers submit the sub sites themselves, an upper bound on the command queue could deadlock the pool.
+        self.pool = WorkerPool(job_fn=self.__indexer, workers=threads, result_size=100, logger_name="site_indexer",
+                               priority=True)
+        self.pool.start()
 
-        self.logger.info("Workers Spawned")
+    def __indexer(self, identifier: int, target: dict) -> dict:
+        """
+        Job function of the worker pool. Calls the __sub_index func for the target.
+
+        WARNING: This function is a member function of the same object. As a result it has access to the pool.
+        HOWEVER, it can create data-races so DO NOT ACCESS ANYTHING ELSE OTHER THAN THE POOL!
 
-    def __indexer(self, identifier: int):
+        :param identifier: number of the worker
+        :param target: dict with url, prefix and depth
+
+        :return: result of __sub_index
         """
-        Function executed by a worker thread. If the to_download queue is empty for 10s,
-        the worker kills itself.
-        For every target in the queue, it calls the __sub_index func.
+        return self.__sub_index(target["url"], target["prefix"], target["depth"])
 
-        WARNING: This function is a member function of the same object. As a result it has access to the queues.
-        HOWEVER, it can create data-races so DO NOT ACCESS ANYTHING ELSE OTHER THAN THE QUEUES!
+    def sub_index(self, uri: str, depth: int):
+        """
+        Schedule a site for the workers if the frontier accepts it (not visited yet, within the depth limit).
+
+        :param uri: href of the sub site like /speakers/d-infk/2015.html
+        :param depth: depth of the site in the crawl
 
         :return:
         """
-        # after timeout of 10s the indexer subprocess kills itself
-        local_logger = logging.getLogger("thread_handler")
-        local_logger.info(f"Worker {identifier:02} started")
-        counter = 0
-        while counter < 10:
-            try:
-                # dequeue the next element
-                target = self.to_download_queue.get(block=False)
+        job = self.frontier.push(uri, depth=depth)
+        if job is not None:
+            self.pool.submit(job, priority=job["priority"])
 
-                # perform sub index task
-                self.__sub_index(target["url"], target["prefix"])
+    def dequeue(self):
+        """
+        Function retrieves the results from the pool and writes them to the database in batches.
+        Function exits once the results of all sites are written.
 
-                # reset timeout
-                counter = 0
+        :return:
+        """
+        self.__insert_counter = 0
+        self.__found_counter = 0
 
-            # sleep and timeout if queue is empty
-            except Empty:
-                counter += 1
-                sleep(1)
-        local_logger.info(f"Worker {identifier:02} exiting")
-        return
+        self.writer.run(self.pool.results(idle_timeout=self.writer.batch_ms / 1000))
 
-    def sub_index(self, url: str, prefix: str):
-        """
-        Wrapper for __sub_index function. (Here to allow for multiprocessing) switch back in case you want to debug or
-        test something, have here the self.__sub__index function
+        self.sq_con.commit()
+        self.logger.info(f"Inserted {self.__insert_counter} entries in sites table")
+        self.logger.info(f"Updated {self.__found_counter} entries in sites table")
 
-        :param url: full url of sub site to index like https://www.video.ethz.ch/speakers/d-infk/2015.html
-        :param prefix: prefix of the site, only searching urls with identical prefix, like /speakers/d-infk
+    def store_result(self, arguments: dict):
+        """
+        Write a single result of the workers to the database. Called by the batch writer, doesn't commit.
 
+        :param arguments: dict with url and is_video (branch sites also fingerprint, validators, carried video urls
+            and full_crawl), None if the site couldn't be loaded
         :return:
         """
-        self.to_download_queue.put({"url": url, "prefix": prefix})
+        # site couldn't be loaded
+        if arguments is None:
+            return
 
-    def dequeue(self):
-        """
-        Function retrieves the urls from the video_url queue and writes them to the file specified in init.
-        Function exits after 10s of an empty queue or when all workers are done.
+        now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
+        url = arguments["url"]
+        a_video = arguments["is_video"]
 
+        try:
+            if self.not_in_db(url=url, video=a_video):
+                self.debug_execute("INSERT INTO sites (URL, IS_VIDEO, found, last_seen) VALUES (?, ?, ?, ?)",
+                                   (url, a_video, now, now))
+                self.__insert_counter += 1
+                self.logger.info(f"Found new: {url}")
+            else:
+                self.update_found(url=url, video=a_video)
+                self.__found_counter += 1
+                self.logger.debug(f"Already in DB: {url}")
+            if a_video == 1 and self.ledger is not None:
+                self.ledger.done(url)
+        except sqlite3.IntegrityError as e:
+            self.logger.exception(f"Error while insert updating url {url}", exc_info=e)
+
+        if "fingerprint" in arguments:
+            self.store_crawl_state(arguments)
+
+    def store_crawl_state(self, arguments: dict):
+        """
+        Store fingerprint and validators of a branch site and carry the last_seen of its unchanged video children
+        forward. Deferred until the next flush.
+
+        :param arguments: result of a branch site
         :return:
         """
-        # Timeout to prevent endless loop if a subprocesses crash
-        insert_counter = 0
-        found_counter = 0
-        counter = 0
         now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
-        while counter < 10 and self.one_workers_alive():
-            try:
-                arguments = self.found_url_queue.get(block=False)
-            except Empty:
-                counter += 1
-                sleep(1)
-                continue
-
-            url = arguments["url"]
-            a_video = arguments["is_video"]
-
-            try:
-                if self.not_in_db(url=url, video=a_video):
-                    self.debug_execute("INSERT INTO sites (URL, IS_VIDEO, found, last_seen) VALUES "
-                                        f"('{url}', {a_video}, '{now}', '{now}')")
-                    insert_counter += 1
-                    self.logger.info(f"Found new: {url}")
-                else:
-                    self.update_found(url=url, video=a_video)
-                    found_counter += 1
-                    self.logger.debug(f"Already in DB: {url}")
-            except sqlite3.IntegrityError as e:
-                self.logger.exception(f"Error while insert updating url {url}", e)
-            counter = 0
+        validators = arguments["validators"]
+        self.defer_execute("UPDATE sites SET fingerprint = ?, etag = ?, last_modified = ?, "
+                           "last_full_crawl = CASE WHEN ? THEN ? ELSE last_full_crawl END "
+                           "WHERE URL = ? AND IS_VIDEO = 0",
+                           (arguments["fingerprint"], validators.get("etag"), validators.get("last_modified"),
+                            arguments["full_crawl"], now, arguments["url"]))
 
-        self.sq_con.commit()
-        self.logger.info(f"Inserted {insert_counter} entries in sites table")
-        self.logger.info(f"Updated {found_counter} entries in sites table")
+        for url in arguments["carried"]:
+            self.update_found(url=url, video=1)
+        self.__carried_counter += len(arguments["carried"])
 
     def not_in_db(self, url: str, video: int):
         """
@@ -386,12 +768,12 @@ class ETHSiteIndexer(BaseSQliteDB):
 
         :return:
         """
-        self.debug_execute(f"SELECT key FROM sites WHERE URL = '{url}' AND IS_VIDEO = {video}")
+        self.debug_execute("SELECT key FROM sites WHERE URL = ? AND IS_VIDEO = ?", (url, video))
         return self.sq_cur.fetchone() is None
 
     def update_found(self, url: str, video: int):
         """
-        Update the found entry of a given row to the current date and time.
+        Update the found entry of a given row to the current date and time. Deferred until the next flush.
 
         :param url: url to match for the update for the last seen time.
         :param video: int(bool) if the site is a video
@@ -399,46 +781,48 @@ class ETHSiteIndexer(BaseSQliteDB):
         :return:
         """
         now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
-        self.debug_execute(f"UPDATE sites SET last_seen = '{now}' WHERE URL = '{url}' AND IS_VIDEO = {video}")
+        self.defer_execute("UPDATE sites SET last_seen = ? WHERE URL = ? AND IS_VIDEO = ?", (now, url, video))
 
     def gen_parent(self):
         """
         Generates the tree hierarchy for the site index.
 
+        All branch sites seen in this run are loaded into a dict url -> key, the parents of all sites without parent
+        are resolved in memory and written with a single executemany. Sites whose parent isn't found get parent -1.
+
         :return:
         """
-        # temporary storage of parent url:key to parent_id:value.
-        parent_ids = {}
+        now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
 
-        self.debug_execute("SELECT key, URL FROM sites WHERE parent IS NULL")
-        one = self.sq_cur.fetchone()
-        x = 0
+        # url -> key of all candidate parents
+        self.debug_execute("SELECT URL, key FROM sites WHERE IS_VIDEO = 0 AND last_seen = ?", (now,))
+        parent_ids = dict(self.sq_cur.fetchall())
 
-        # perform the parent linking while there are entries that have no parent.
-        while one is not None:
-            x += 1
-            key = one[0]
-            url = one[1]
+        self.debug_execute("SELECT key, URL FROM sites WHERE parent IS NULL")
+        orphans = self.sq_cur.fetchall()
 
+        updates = []
+        unresolved = set()
+        for key, url in orphans:
             # generate the parent url from own url.
             parent_url = parent_site(url)
-
-            # try to locate the parent_id in the temporary dictionary.
             parent_id = parent_ids.get(parent_url)
 
-            # if no id is found, search the id and put it in the temp dict.
             if parent_id is None:
-                parent_id = self.get_url_id(parent_url)
-                parent_ids[parent_url] = parent_id
+                if parent_url not in unresolved:
+                    self.logger.error(f"Failed to find {parent_url} with found {now} and is_video 0")
+                    unresolved.add(parent_url)
+                parent_id = -1
 
-            self.logger.debug(f"UPDATE sites SET parent = {parent_id} WHERE key IS {key}")
-            self.debug_execute(f"UPDATE sites SET parent = {parent_id} WHERE key IS {key}")
+            updates.append((parent_id, key))
 
-            # Fetch the next entry which has no parent.
-            self.debug_execute("SELECT key, URL FROM sites WHERE parent IS NULL")
-            one = self.sq_cur.fetchone()
+        self.sq_cur.executemany("UPDATE sites SET parent = ? WHERE key = ?", updates)
         self.sq_con.commit()
-        self.logger.info(f"Updated parents of: {x} entries")
+
+        self.logger.info(f"Updated parents of: {len(updates)} entries")
+        if len(unresolved) > 0:
+            self.logger.warning(f"{len(unresolved)} parents not found, "
+                                f"{sum(1 for u in updates if u[0] == -1)} entries linked to -1")
 
     def get_url_id(self, url: str):
         """
@@ -450,8 +834,7 @@ class ETHSiteIndexer(BaseSQliteDB):
         :return: key or -1 if no key found.
         """
         now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
-        self.debug_execute(f"SELECT (key) FROM sites WHERE URL = '{url}' AND datetime(last_seen) = datetime('{now}')"
-                           f" AND IS_VIDEO = 0")
+        self.debug_execute("SELECT (key) FROM sites WHERE URL = ? AND last_seen = ? AND IS_VIDEO = 0", (url, now))
         query_result = self.sq_cur.fetchall()
 
         if len(query_result) == 0 or len(query_result[0]) == 0:
@@ -466,9 +849,4 @@ class ETHSiteIndexer(BaseSQliteDB):
 
         :return:
         """
-        for worker in self.threads:
-            worker: Thread
-            if worker.is_alive():
-                return True
-
-        return False
+        return self.pool is not None and self.pool.is_alive()
@@ -1,26 +1,46 @@
+import asyncio
 import datetime
+import functools
 import json
 import logging
-import multiprocessing as mp
-import pickle
 import queue
+import threading
 import time
 from dataclasses import dataclass
-from threading import Thread
-from typing import List
+from typing import Dict, Iterable, List, Set, Union
 
 import jsondiff as jd
 import requests as rq
 
 import eth_loader.aux as aux
+from eth_loader.async_engine import AsyncEngine
 from eth_loader.base_sql import BaseSQliteDB
+from eth_loader.batch_writer import BatchWriter
+from eth_loader.concurrency import AdaptiveConcurrency, slot
+from eth_loader.cookie_cache import CookieCache
+from eth_loader.http_session import SessionPool
+from eth_loader.job_ledger import JobLedger
+from eth_loader.rate_limit import RateLimiter
+from eth_loader.retry import RETRYABLE, RetryPolicy, error_class, retry_after
+from eth_loader.validators import ValidatorStore, conditional_headers, response_validators
+from eth_loader.worker_pool import WorkerPool
 
 
 # gro-21w
 # fG9LdsA
 
+USER_AGENT = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:100.0) Gecko/20100101 Firefox/100.0"
 
-def get_stream(website_url: str, identifier: str, headers: dict, cookies: bytes, parent_id: int) -> dict:
+# status codes of a refused login cookie
+LOGIN_REFUSED = (401, 403)
+# refreshes of the cookie jar per request: one to catch up with a jar renewed meanwhile, one to log in again
+RELOGINS = 2
+
+
+def get_stream(website_url: str, identifier: str, headers: dict, cookies: rq.cookies.RequestsCookieJar,
+               parent_id: int, session: SessionPool = None, validators: dict = None, retry: RetryPolicy = None,
+               concurrency: AdaptiveConcurrency = None, rate_limit: RateLimiter = None,
+               cookie_cache: CookieCache = None, cookie_key: str = None) -> dict:
     """
     Function to download a single metadata file for a given video_site and video entry. The website_url needs to be of type:
 
@@ -33,28 +53,152 @@ def get_stream(website_url: str, identifier: str, headers: dict, cookies: bytes,
     The function **expects** to receive a valid lecture url. If an url is provided, that doesn't contain a video,
     it will try to download it anyway. The function shouldn't fail except if the site doesn't exist.
 
-    :param cookies:
+    :param cookies: login cookie jar, shared with the other jobs of the series (not modified), None if not logged in
     :param parent_id: Id of parent entry in metadata table
     :param website_url: url to download eg. /category/subcategory/year/season/lecture_id.html
     :param identifier: str for thread to give information where the download was executed in case of an error.
     :param headers: dict to be passed to the request library. Download will fail if no user-agent is provided.
+    :param session: shared session pool to reuse connections, falls back to plain requests if None.
+    :param validators: etag and last_modified of the previous download for a conditional request, None if unknown.
+    :param retry: retry policy for transient errors, None to try once
+    :param concurrency: adaptive limit of the requests in flight, None for no limit
+    :param rate_limit: token buckets per host and path prefix, None for no limit
+    :param cookie_cache: cache the cookie jar is from, a refused jar (401 / 403) is refreshed (see RELOGINS)
+    :param cookie_key: key of the cookie jar in the cache, None if it isn't from the cache
     """
+    http = session if session is not None else rq
 
     url = website_url.replace("\n", "")
-    cj = pickle.loads(cookies)
-    try:
-        result = rq.get(url=url, headers=headers, cookies=cj)
-    except Exception as e:
-        logging.getLogger("stream_loader").error(f"{identifier:.02} error {e}", exc_info=e)
-        return {"url": url, "status": -1, "content": None, "parent_id": parent_id}
+    cj = cookies
+    relogins = RELOGINS if cookie_cache is not None and cookie_key is not None else 0
+
+    attempt = 0
+    while True:
+        try:
+            with slot(concurrency, rate_limit, url) as request:
+                result = http.get(url=url, headers=conditional_headers(headers, validators), cookies=cj)
+                request.error = error = error_class(status=result.status_code)
+            after = retry_after(result.headers)
+        except Exception as e:
+            result, error, after = e, error_class(exc=e), None
+
+        if relogins > 0 and not isinstance(result, Exception) and result.status_code in LOGIN_REFUSED:
+            relogins -= 1
+            new = cookie_cache.refresh(cookie_key, cj)
+            # logged in too recently (or the login failed), the same cookies would be refused again
+            if new is cj:
+                break
+            cj = new
+            continue
+
+        if retry is None or not retry.should_retry(error, attempt):
+            break
+
+        logging.getLogger("stream_loader").warning(f"{identifier:.02} retrying {url} after {error} error")
+        time.sleep(retry.delay(attempt, after))
+        attempt += 1
+
+    if isinstance(result, Exception):
+        logging.getLogger("stream_loader").error(f"{identifier:.02} error {result}", exc_info=result)
+        return {"url": url, "status": -1, "content": None, "parent_id": parent_id, "error": error}
+
+    res = conform_stream(url=url, identifier=identifier, parent_id=parent_id, status=result.status_code,
+                         ok=result.ok, body=result.content, validators=response_validators(result.headers))
+    res["error"] = error
+    return res
+
+
+async def async_get_stream(session, job: dict, submit=None, retry: RetryPolicy = None,
+                             concurrency: AdaptiveConcurrency = None, rate_limit: RateLimiter = None,
+                             cookie_cache: CookieCache = None) -> dict:
+    """
+    Coroutine equivalent of get_stream for the async engine.
+
+    :param session: aiohttp.ClientSession of the engine
+    :param job: job dict with url, cookie-jar, cookie-key, parent_id and validators, identical to the commands of the
+        worker threads
+    :param submit: unused, part of the engine's fetch signature
+    :param retry: retry policy for transient errors, None to try once
+    :param concurrency: adaptive limit of the requests in flight, None for no limit
+    :param rate_limit: token buckets per host and path prefix, None for no limit
+    :param cookie_cache: cache the cookie jar of the job is from, a refused jar (401 / 403) is refreshed (see
+        RELOGINS)
+    """
+    url = job["url"].replace("\n", "")
+    cj = job["cookie-jar"]
+    cookies = rq.utils.dict_from_cookiejar(cj) if cj is not None else None
+    relogins = RELOGINS if cookie_cache is not None and job.get("cookie-key") is not None else 0
+    headers = conditional_headers({"user-agent": USER_AGENT}, job.get("validators"))
+
+    attempt = 0
+    while True:
+        exc, after = None, None
+        try:
+            async with slot(concurrency, rate_limit, url) as request:
+                async with session.get(url, headers=headers, cookies=cookies) as result:
+                    body = await result.read()
+                    status = result.status
+                    validators = response_validators(result.headers)
+                    after = retry_after(result.headers)
+                request.error = error = error_class(status=status)
+        except Exception as e:
+            exc, error = e, error_class(exc=e)
+
+        if relogins > 0 and exc is None and status in LOGIN_REFUSED:
+            relogins -= 1
+            # the login is a blocking request
+            new = await asyncio.get_running_loop().run_in_executor(None, cookie_cache.refresh, job["cookie-key"], cj)
+            # logged in too recently (or the login failed), the same cookies would be refused again
+            if new is cj:
+                break
+            cj = new
+            cookies = rq.utils.dict_from_cookiejar(cj) if cj is not None else None
+            continue
+
+        if retry is None or not retry.should_retry(error, attempt):
+            break
+
+        logging.getLogger("stream_loader").warning(f"async retrying {url} after {error} error")
+        await asyncio.sleep(retry.delay(attempt, after))
+        attempt += 1
+
+    if exc is not None:
+        logging.getLogger("stream_loader").error(f"async error {exc}", exc_info=exc)
+        return {"url": url, "status": -1, "content": None, "parent_id": job["parent_id"], "error": error}
+
+    res = conform_stream(url=url, identifier="async", parent_id=job["parent_id"], status=status,
+                         ok=status < 400, body=body, validators=validators)
+    res["error"] = error
+    return res
+
+
+def conform_stream(url: str, identifier: str, parent_id: int, status: int, ok: bool, body: bytes,
+                   validators: dict = None) -> dict:
+    """
+    Build the result for the result queue from a downloaded episode series-metadata.json. Json is regularized
+    (sorted keys).
 
+    :param url: url of the episode
+    :param identifier: str for thread to give information where the download was executed in case of an error.
+    :param parent_id: Id of parent entry in metadata table
+    :param status: http status code of the response
+    :param ok: if the status code indicates success
+    :param body: raw content of the response
+    :param validators: etag and last_modified of the response
+    """
     content = None
     is_json: bool = False
 
-    if result.ok:
-        content = result.content.decode("utf-8")
+    # Not modified since the last download, dequeue only updates last_seen
+    if status == 304:
+        logging.getLogger("stream_loader").debug(f"{identifier} Not modified {url}")
+        return {"url": url, "status": status, "content": None, "parent_id": parent_id, "is_json": False,
+                "validators": validators}
+
+    if ok:
+        content = body.decode("utf-8")
     else:
-        logging.getLogger("stream_loader").error(f"{identifier:.02} error {result.status_code}")
+        logging.getLogger("stream_loader").error(f"{identifier:.02} error {status}")
 
     # conform json
     try:
@@ -66,46 +210,31 @@ def get_stream(website_url: str, identifier: str, headers: dict, cookies: bytes,
     except Exception as e:
         logging.getLogger("stream_loader").error(f"{identifier:.02} Failed to decode json from {url}", exc_info=e)
 
-    return {"url": url, "status": result.status_code, "content": content, "parent_id": parent_id, "is_json": is_json}
+    return {"url": url, "status": status, "content": content, "parent_id": parent_id, "is_json": is_json,
+            "validators": validators}
 
 
-def stream_download_handler(worker_nr: int, command_queue: mp.Queue, result_queue: mp.Queue):
+def stream_download_handler(worker_nr: int, arguments: dict, session: SessionPool = None,
+                            retry: RetryPolicy = None, concurrency: AdaptiveConcurrency = None,
+                            rate_limit: RateLimiter = None, cookie_cache: CookieCache = None) -> dict:
     """
-    Function executed in a worker thread. The function tries to download the given url in the queue. If the queue is
-    empty for 20s, it will kill itself.
+    Function executed by a worker of the pool. Downloads the episode for a single command.
 
     :param worker_nr: Itendifier for debugging
-    :param command_queue: Queue containing dictionaries containing all relevant information for downloading
-    :param result_queue: Queue to put the results in. Handled in main thread.
-    :return:
+    :param arguments: dictionary containing all relevant information for downloading (see generate_jobs)
+    :param session: shared session pool of all workers
+    :param retry: retry policy shared by all workers
+    :param concurrency: adaptive limit of the requests in flight shared by all workers
+    :param rate_limit: rate limit shared by all workers
+    :param cookie_cache: login cookies of the series shared by all workers
+    :return: result for the result queue
     """
-    logging.getLogger("stream_loader").info(f"{worker_nr}: Starting")
-    local_logger = logging.getLogger("thread_handler")
-    local_logger.info(f"Worker {worker_nr:02} started")
-    ctr = 0
-    while ctr < 20:
-        try:
-            arguments = command_queue.get(block=False)
-            ctr = 0
-        except queue.Empty:
-            ctr += 1
-            time.sleep(1)
-            continue
-
-        if arguments is None:
-            ctr = 200
-            break
-
-        result = get_stream(arguments["url"], str(worker_nr),
-                            headers={"user-agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:100.0) "
-                                                   "Gecko/20100101 Firefox/100.0"}, cookies=arguments["cookie-jar"],
-                            parent_id=arguments["parent_id"])
-
-        result_queue.put(result)
-    logging.getLogger("stream_loader").info(f"{worker_nr} Terminated")
-    local_logger.info(f"Worker {worker_nr:02} exiting")
-
-    return
+    return get_stream(arguments["url"], str(worker_nr),
+                      headers={"user-agent": USER_AGENT}, cookies=arguments["cookie-jar"],
+                      parent_id=arguments["parent_id"], session=session,
+                      validators=arguments.get("validators"), retry=retry,
+                      concurrency=concurrency, rate_limit=rate_limit,
+                      cookie_cache=cookie_cache, cookie_key=arguments.get("cookie-key"))
 
 
 @dataclass
@@ -126,6 +255,43 @@ class EpisodeEntry:
     parent_id: int
 
 
+def series_episodes(series: dict, series_url: str, parent_id: int) -> List[EpisodeEntry]:
+    """
+    Episodes listed in the series-metadata.json of a series.
+
+    :param series: parsed series-metadata.json
+    :param series_url: url of the series-metadata.json
+    :param parent_id: key of the metadata record the episodes are linked to (latest differential or initial record)
+    :return: one entry per episode with an id
+    """
+    logger = logging.getLogger("stream_loader")
+    episodes = series.get("episodes")
+
+    # verify existence of episodes key
+    if episodes is None:
+        logger.warning(f"No episodes found {series_url}")
+        return []
+
+    # parent url without file extension
+    strip_url = series_url.replace(".html", "").replace(".series-metadata.json", "")
+    entries = []
+
+    # iterate over episodes.
+    for ep in episodes:
+        ep_id = ep.get("id")
+
+        # verify existence of episode id.
+        if ep_id is None:
+            logger.error(f"Failed to generate id with Content", ep)
+            continue
+
+        # episode url with file extension
+        ep_url = f"{strip_url}/{ep_id}.series-metadata.json"
+        entries.append(EpisodeEntry(parent_id=parent_id, series_url=series_url, episode_url=ep_url))
+
+    return entries
+
+
 class BetterStreamLoader(BaseSQliteDB):
     """
     Class loads all stream file urls for the given database.
@@ -133,7 +299,10 @@ class BetterStreamLoader(BaseSQliteDB):
 
     def __init__(self, db: str, start_dt: datetime.datetime, user_name: str = None, password: str = None,
                  spec_login: List[SpecLogin] = None, verify_tbl: bool = True,
-                 use_base64: bool = False):
+                 use_base64: bool = False, use_validators: bool = True, batch_size: int = 500,
+                 batch_ms: int = 1000, profile: str = None, use_ledger: bool = True, retry: RetryPolicy = None,
+                 requeue: bool = True, concurrency: AdaptiveConcurrency = None, rate_limit: RateLimiter = None,
+                 cookie_ttl: float = 3600):
 
         """
         Perform initialisation and acquire the login cookie for the indexing.
@@ -144,8 +313,21 @@ class BetterStreamLoader(BaseSQliteDB):
         :param verify_tbl: If the table should be verified on init
         :param spec_login: list of SpecLogin Dataclass objects. Containing an url for which the login is intended,
             the username and the password
+        :param use_validators: send conditional requests with the ETag / Last-Modified of the previous run
+        :param batch_size: maximum number of results written per transaction
+        :param batch_ms: maximum time in milliseconds between two commits while results are coming in
+        :param profile: sqlite performance profile of the connection (see base_sql.PROFILES), None for the defaults
+        :param use_ledger: track the status of every url in the job ledger, a download of the same start_dt resumes
+            the run and skips the episodes already done
+        :param retry: retry policy for transient errors (timeouts, 5xx, ...), None for the default policy
+        :param requeue: download the episodes failing with a transient error once more after the main pass
+        :param concurrency: adaptive limit of the requests in flight (at most the number of workers), None to keep
+            all workers busy
+        :param rate_limit: token buckets per host and path prefix shared by all requests (including the logins), None
+            for no limit
+        :param cookie_ttl: seconds the login cookie of a series (spec_login) is used before logging in again
         """
-        super().__init__(db_path=db)
+        super().__init__(db_path=db, profile=profile)
 
         self.logger = logging.getLogger("stream_loader")
         self.download_list = []
@@ -153,33 +335,28 @@ class BetterStreamLoader(BaseSQliteDB):
         if verify_tbl:
             self.check_results_table()
 
-        if spec_login is not None:
-            self.specific_urls = [entry.url for entry in spec_login]
-            self.specific_auth = spec_login
-        else:
-            self.specific_urls = []
-            self.specific_auth = []
-
-        # prepare urls for matching (removing file extension)
-        for i in range(len(self.specific_urls)):
+        # url prepared for matching (removing file extension) -> login
+        self.specific_urls: Dict[str, SpecLogin] = {}
+        for entry in spec_login if spec_login is not None else []:
             # turn
             # /category/subcategory/year/season/lecture_id.series-metadata.json
             # or
             # /category/subcategory/year/season/lecture_id.html
             # into
             # /category/subcategory/year/season/lecture_id
-            self.specific_urls[i] = (self.specific_urls[i]
-                                     .replace(".html", "")
-                                     .replace(".series-metadata.json", ""))
+            self.specific_urls[entry.url.replace(".html", "").replace(".series-metadata.json", "")] = entry
 
-        self.workers = []
+        # login cookies of the series in specific_urls, one login per series instead of one per episode
+        self.cookie_cache = CookieCache(ttl=cookie_ttl, logger_name="stream_loader")
 
-        self.result_queue = mp.Queue()
-        self.command_queue = mp.Queue()
+        self.pool = None
+        self.session_pool = None
+        self.engine = None
 
         self.nod = 0
 
         self.general_cookie = None
+        self.rate_limit = rate_limit
         self.login(user_name, password)
 
         self.__processed_episodes = 0
@@ -191,6 +368,34 @@ class BetterStreamLoader(BaseSQliteDB):
         self.ub64 = use_base64
         self.start_dt = start_dt
 
+        self.use_validators = use_validators
+        self.validator_store = ValidatorStore(self)
+
+        self.writer = BatchWriter(self, store=self.store_result, batch_size=batch_size, batch_ms=batch_ms,
+                                  logger_name="stream_loader")
+        self.__e_url = []
+        self.validators = {}
+
+        self.ledger = JobLedger(self, stage="episodes") if use_ledger else None
+        self.done_urls: Set[str] = set()
+
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.requeue = requeue
+        self.concurrency = concurrency
+        # episodes failed with a transient error, downloaded again in the requeue pass
+        self.failed_jobs: List[EpisodeEntry] = []
+
+        # databases the results are written to as well (add_sink), series are matched by url
+        self.sinks: List["BetterStreamLoader"] = []
+        self.series_urls: Dict[int, str] = {}
+        self.series_keys: Dict[str, int] = {}
+
+        # pipelined mode, series handed over by the metadata loader and the thread writing the results
+        self.__series_queue: Union[queue.Queue, None] = None
+        self.__writer_thread: Union[threading.Thread, None] = None
+        self.__engine_name = None
+        self.__workers = 0
+
     def get_episode_urls(self):
         """
         Retrieves the urls for all episodes from the metadata (series-metadata.json of first episode) table.
@@ -216,9 +421,6 @@ class BetterStreamLoader(BaseSQliteDB):
             record_type = row[3]
             parent = row[5]
 
-            # parent url without file extension
-            strip_url = parent_url.replace(".html", "").replace(".series-metadata.json", "")
-
             # why was this again important?
             if self.ub64:
                 content_default = aux.from_b64(content)
@@ -252,30 +454,108 @@ class BetterStreamLoader(BaseSQliteDB):
                 assert len(raw) == 1, f"Expected 1 result, got {len(raw)}"
                 parent_key = raw[0][0]
 
-            # verify existence of episodes key
-            if result.get("episodes") is not None:
-                episodes = result.get("episodes")
+            self.register_series(parent_url, parent_key)
+            self.download_list.extend(series_episodes(result, series_url=parent_url, parent_id=parent_key))
 
-                # iterate over episodes.
-                for ep in episodes:
-                    ep_id = ep.get("id")
+            # Can be used again later, needs update
+            # row = self.sq_cur.fetchone()
 
-                    # verify existence of episode id.
-                    if ep_id is None:
-                        self.logger.error(f"Failed to generate id with Content", ep)
-                        continue
+    def register_series(self, series_url: str, parent_id: int, content: str = None):
+        """
+        Remember the key of the metadata record the episodes of a series are linked to, used to match the results in
+        the sinks. Also usable as episode_sink of the metadata loader of a sink database (content is ignored).
 
-                    # episode url with file extension
-                    ep_url = f"{strip_url}/{ep_id}.series-metadata.json"
+        :param series_url: url of the series-metadata.json
+        :param parent_id: key of the metadata record the episodes are linked to
+        :param content: unused
+        :return:
+        """
+        self.series_urls[parent_id] = series_url
+        self.series_keys[series_url] = parent_id
 
-                    self.download_list.append(EpisodeEntry(parent_id=parent_key, series_url=parent_url,
-                                                           episode_url=ep_url))
+    def add_sink(self, sink: "BetterStreamLoader"):
+        """
+        Write the results to another database as well (e.g. the base64 and the plain database, each loader with its
+        own use_base64). The episodes are downloaded once, the parent series are matched by url in the sink.
 
-            else:
-                self.logger.warning(f"No episodes found {parent_url}")
+        Sequential mode: the series of the sink are read by initiator. Pipelined mode: register_series of the sink
+        needs to be the episode_sink of the metadata loader of the sink database (see download_pipelined).
 
-            # Can be used again later, needs update
-            # row = self.sq_cur.fetchone()
+        :param sink: stream loader of the other database
+        :return:
+        """
+        self.sinks.append(sink)
+        self.writer.add_sink(sink, functools.partial(self.__store_in_sink, sink))
+
+    def __store_in_sink(self, sink: "BetterStreamLoader", res: dict):
+        """
+        Write a result to a sink, with the key of the parent series in the sink.
+        """
+        if res is not None:
+            if res["url"] in sink.done_urls:
+                # written before the run was interrupted
+                return
+
+            parent_id = sink.series_keys.get(self.series_urls.get(res["parent_id"]))
+            if parent_id is None:
+                sink.logger.error(f"Series of {res['url']} not in {sink.db_path}, skipping")
+                return
+            res = dict(res, parent_id=parent_id)
+
+        sink.store_result(res)
+
+    def load_validators(self):
+        """
+        Load the validators of the previous run. With sinks only the urls with the same validators in all databases
+        get conditional requests, a sink that missed an update gets the full response.
+
+        :return:
+        """
+        if not self.use_validators:
+            return
+
+        self.validators = self.validator_store.load()
+        for sink in self.sinks:
+            other = sink.validator_store.load()
+            self.validators = {url: v for url, v in self.validators.items() if other.get(url) == v}
+        self.logger.info(f"Loaded validators for {len(self.validators)} urls")
+
+    def start_ledger(self, urls: Iterable[str] = ()):
+        """
+        Start the run in the job ledgers of the loader and its sinks, or resume it. The episodes done in all of them
+        are skipped.
+
+        :param urls: urls of the episodes known up front, the pipelined mode registers them as they're written
+        :return:
+        """
+        if self.ledger is None:
+            return
+
+        urls = list(urls)
+        done = self.ledger.start(self.start_dt, urls)
+        for sink in self.sinks:
+            sink.done_urls = sink.ledger.start(sink.start_dt, urls) if sink.ledger is not None else set()
+            done &= sink.done_urls
+        self.done_urls = done
+
+        if self.ledger.resumed:
+            self.logger.info(f"Resuming run {self.ledger.run}, {len(done)} episodes already done")
+
+    def mark_job(self, url: str, error: str = None):
+        """
+        Record the outcome of an url in the job ledger, does nothing without ledger. Deferred until the next flush.
+
+        :param url: url of the episode
+        :param error: description of the error, None if the result was written
+        :return:
+        """
+        if self.ledger is None or url is None:
+            return
+
+        if error is None:
+            self.ledger.done(url)
+        else:
+            self.ledger.failed(url, error)
 
     def verify_args_table(self):
         """
@@ -315,6 +595,13 @@ class BetterStreamLoader(BaseSQliteDB):
         # Create Indexes
         self.debug_execute("CREATE INDEX IF NOT EXISTS episodes_key_index ON episodes (key)")
         self.debug_execute("CREATE INDEX IF NOT EXISTS episodes_url_parent_index ON episodes (URL)")
+        # Covering index for the change detection, lookups by url don't need to read the json from the table
+        self.debug_execute("CREATE INDEX IF NOT EXISTS episodes_url_hash_index "
+                           "ON episodes (URL, record_type, json_hash, deprecated)")
+        # Timestamps are canonical text (YYYY-MM-DD HH:MM:SS), compared directly so the indexes can be used
+        self.debug_execute("CREATE INDEX IF NOT EXISTS episodes_last_seen_index ON episodes (last_seen)")
+        self.debug_execute("CREATE INDEX IF NOT EXISTS episodes_type_last_seen_index "
+                           "ON episodes (record_type, last_seen)")
 
         # Create the association table from episode to metadata (can be difficult)
         self.debug_execute("SELECT name FROM sqlite_master WHERE type='table' AND name='metadata_episode_assoz'")
@@ -353,6 +640,7 @@ class BetterStreamLoader(BaseSQliteDB):
 
         self.debug_execute("CREATE INDEX IF NOT EXISTS streams_key_index ON streams (key)")
         self.debug_execute("CREATE INDEX IF NOT EXISTS streams_resolution_url_index ON streams (resolution, URL)")
+        self.debug_execute("CREATE INDEX IF NOT EXISTS streams_last_seen_index ON streams (last_seen)")
 
         # Check if the assoz table exists
         self.debug_execute("SELECT name FROM sqlite_master WHERE type='table' AND name='episode_stream_assoz'")
@@ -378,41 +666,219 @@ class BetterStreamLoader(BaseSQliteDB):
         if not 1 < threads < 10000:
             raise ValueError("Thread number outside supported range [1:10'000]")
 
-        self.workers = []
-        for i in range(threads):
-            t = Thread(target=stream_download_handler, args=(i, self.command_queue, self.result_queue))
-            t.start()
-            self.workers.append(t)
+        self.session_pool = SessionPool(pool_size=threads)
+        self.pool = WorkerPool(job_fn=functools.partial(stream_download_handler, session=self.session_pool,
+                                                        retry=self.retry, concurrency=self.concurrency,
+                                                        rate_limit=self.rate_limit, cookie_cache=self.cookie_cache),
+                               workers=threads, cmd_size=2 * threads, result_size=2 * threads,
+                               logger_name="stream_loader")
+        self.pool.start()
 
-        self.logger.info("Workers Spawned")
+    def spawn_async(self, concurrency: int = 1000):
+        """
+        Starts the async engine with all jobs. The event loop thread takes the place of the worker threads.
 
-    def initiator(self, workers: int = 100):
+        :param concurrency: number of requests in flight
+        :return:
+        """
+        self.engine = AsyncEngine(fetch=functools.partial(async_get_stream, retry=self.retry,
+                                                          concurrency=self.concurrency, rate_limit=self.rate_limit,
+                                                          cookie_cache=self.cookie_cache),
+                                  concurrency=concurrency, logger_name="stream_loader")
+        self.engine.start(self.generate_jobs())
+        self.pool = self.engine
+
+    def initiator(self, workers: int = 100, engine: str = "thread"):
         """
         Runs the entire job basically. Starts all threads, retrieves all values, stores the database and does the
         clenaup.
 
-        :param workers: number of workers in parallel.
+        :param workers: number of workers in parallel (requests in flight for the async engine).
+        :param engine: "thread" for worker threads, "async" for a single asyncio event loop
         :return:
         """
+        if engine not in ("thread", "async"):
+            raise ValueError(f"Engine {engine} not recognized")
+
         self.get_episode_urls()
+
+        for sink in self.sinks:
+            # only the series keys of the sink are needed
+            sink.get_episode_urls()
+            sink.download_list = []
+
+        self.start_ledger(dl.episode_url for dl in self.download_list)
+        if len(self.done_urls) > 0:
+            self.download_list = [dl for dl in self.download_list if dl.episode_url not in self.done_urls]
+        if self.ledger is not None and len(self.ledger.previous_failed) > 0:
+            # episodes that failed in the previous run first
+            self.download_list.sort(key=lambda dl: dl.episode_url not in self.ledger.previous_failed)
         self.nod = len(self.download_list)
 
+        self.load_validators()
+
         self.logger.info(f"TODO: {self.nod}")
-        time.sleep(10)
 
-        self.spawn(workers)
-        self.enqueue_job()
+        self.failed_jobs = []
+        self.__download_pass(workers, engine)
+        self.__requeue_pass(workers, engine)
+        self.__finish_download(engine)
+
+    def __download_pass(self, workers: int, engine: str):
+        """
+        Download the download_list and write the results, returns once the last one is written.
+        """
+        if engine == "async":
+            self.spawn_async(workers)
+        else:
+            self.spawn(workers)
+            self.enqueue_job()
         self.dequeue_job()
 
-        while self.workers_alive():
-            time.sleep(30)
+    def __requeue_pass(self, workers: int, engine: str):
+        """
+        Download the episodes failed with a transient error once more, after the main pass is written.
+        """
+        if not self.requeue or len(self.failed_jobs) == 0:
+            return
+
+        self.logger.info(f"Requeue pass for {len(self.failed_jobs)} failed episodes")
+        self.cleanup_workers()
+        http = self.engine if engine == "async" else self.session_pool
+        self.logger.info(http.stats_str())
+        http.close()
+
+        self.download_list = self.failed_jobs
+        self.failed_jobs = []
+        for dl in self.download_list:
+            # unconditional, the 304 of an episode without entry is healed as well
+            self.validators.pop(dl.episode_url, None)
+        self.__download_pass(workers, engine)
+
+    def start_pipeline(self, workers: int = 100, engine: str = "thread", busy_timeout: float = 60):
+        """
+        Pipelined alternative to initiator. Starts the download of the episodes before the metadata download is done:
+        the metadata loader hands every series it wrote to episode_sink, its episodes are downloaded right away and
+        written by a background thread. Call finish_pipeline once the metadata download is done.
+
+        The episodes are linked to the same metadata records as with get_episode_urls, provided the metadata increment
+        is built after the pipeline (new states of a series become the latest differential record).
+
+        :param workers: number of workers in parallel (requests in flight for the async engine).
+        :param engine: "thread" for worker threads, "async" for a single asyncio event loop
+        :param busy_timeout: seconds a write waits for the transaction of the metadata loader (same database)
+        :return:
+        """
+        if engine not in ("thread", "async"):
+            raise ValueError(f"Engine {engine} not recognized")
+
+        if self.__series_queue is not None:
+            raise ValueError("Pipeline already started. Only one run per loader.")
+
+        self.load_validators()
+        self.start_ledger()
+
+        # the results are written by the background thread, the connections need to be usable from there
+        for db in [self] + self.sinks:
+            db.reconnect(check_same_thread=False)
+            db.set_busy_timeout(busy_timeout)
+
+        self.__series_queue = queue.Queue()
+        self.__engine_name = engine
+        self.__workers = workers
+        self.failed_jobs = []
+        jobs = self.generate_jobs(self.pipeline_entries())
+
+        if engine == "async":
+            self.engine = AsyncEngine(fetch=functools.partial(async_get_stream, retry=self.retry,
+                                                              concurrency=self.concurrency, rate_limit=self.rate_limit,
+                                                              cookie_cache=self.cookie_cache),
+                                      concurrency=workers, logger_name="stream_loader")
+            self.engine.start(jobs, lazy=True)
+            self.pool = self.engine
+        else:
+            self.spawn(workers)
+            self.pool.feed(jobs)
+
+        self.__writer_thread = threading.Thread(target=self.__pipeline_writer)
+        self.__writer_thread.start()
+        self.logger.info("Pipeline started")
+
+    def episode_sink(self, series_url: str, parent_id: int, content: str):
+        """
+        Hand a series to the pipelined download. Thread-safe, called by the metadata loader for every series whose
+        metadata it wrote.
+
+        :param series_url: url of the series-metadata.json
+        :param parent_id: key of the metadata record the episodes are linked to
+        :param content: series-metadata.json (plain, not base64)
+        :return:
+        """
+        self.register_series(series_url, parent_id)
+        self.__series_queue.put((series_url, parent_id, content))
+
+    def pipeline_entries(self):
+        """
+        Generator over the episodes of the series handed to episode_sink. Blocks while waiting for the next series,
+        returns once finish_pipeline was called.
+        """
+        while True:
+            item = self.__series_queue.get()
+            if item is None:
+                return
+
+            series_url, parent_id, content = item
+            try:
+                series = json.loads(content)
+            except json.JSONDecodeError as e:
+                self.logger.exception(f"Json Decode error with key: {parent_id}, url: {series_url}", exc_info=e)
+                continue
+
+            entries = [e for e in series_episodes(series, series_url=series_url, parent_id=parent_id)
+                       if e.episode_url not in self.done_urls]
+            self.nod += len(entries)
+            yield from entries
+
+    def finish_pipeline(self):
+        """
+        Signal that the metadata download is done. Returns once the last episode is written.
+
+        :return:
+        """
+        self.__series_queue.put(None)
+        self.__writer_thread.join()
+        self.logger.info(f"Pipeline downloaded {self.nod} episodes")
+        self.__requeue_pass(self.__workers, self.__engine_name)
+        self.__finish_download(self.__engine_name)
+
+    def __pipeline_writer(self):
+        """
+        Thread target of the pipelined mode, writes the results.
+        """
+        try:
             self.dequeue_job()
-            self.logger.info("Initiator Thread Sleeping Workers")
+        except Exception as e:
+            self.logger.exception("Pipeline writer failed", exc_info=e)
 
+    def __finish_download(self, engine: str):
+        """
+        Stop the workers, commit and report once all results are written.
+        """
         self.cleanup_workers()
         self.sq_con.commit()
+
+        http = self.engine if engine == "async" else self.session_pool
+        self.logger.info(http.stats_str())
+        http.close()
         self.logger.info(f"Processed episode {self.__processed_episodes}")
         self.logger.info(f"Processed streams {self.__processed_streams}")
+        self.logger.info(self.retry.stats_str())
+        if self.concurrency is not None:
+            self.logger.info(self.concurrency.stats_str())
+        if self.rate_limit is not None:
+            self.logger.info(self.rate_limit.stats_str())
+        if len(self.specific_urls) > 0:
+            self.logger.info(self.cookie_cache.stats_str())
 
         # self.deprecate_streams()
         self.sq_con.commit()
@@ -420,24 +886,17 @@ class BetterStreamLoader(BaseSQliteDB):
 
     def cleanup_workers(self):
         """
-        Waits for all worker processes to terminate and then joins them.
+        Waits for all workers to terminate and then joins them.
         :return:
         """
-        for worker in self.workers:
-            worker: Thread
-            worker.join(10)
+        self.pool.stop()
 
     def workers_alive(self):
         """
         Function to verify that at least one of the workers hasn't exited.
         :return:
         """
-        for worker in self.workers:
-            worker: Thread
-            if worker.is_alive():
-                return True
-
-        return False
+        return self.pool is not None and self.pool.is_alive()
 
     def login(self, usr: str = None, pw: str = None):
         """
@@ -451,10 +910,12 @@ class BetterStreamLoader(BaseSQliteDB):
             self.logger.error("No Credentials")
             return
 
-        login = rq.post(url="https://video.ethz.ch/j_security_check",
-                        headers={"user-agent": "lol herre"}, data={"_charset_": "utf-8", "j_username": usr,
-                                                                   "j_password": pw,
-                                                                   "j_validate": True})
+        url = "https://video.ethz.ch/j_security_check"
+        with slot(None, self.rate_limit, url):
+            login = rq.post(url=url,
+                            headers={"user-agent": "lol herre"}, data={"_charset_": "utf-8", "j_username": usr,
+                                                                       "j_password": pw,
+                                                                       "j_validate": True})
 
         if login.ok:
             self.general_cookie = login.cookies
@@ -474,16 +935,19 @@ class BetterStreamLoader(BaseSQliteDB):
         :param pw: password for the specific login
         :param usr: username for the specific login
         :param strip_url: url where to perform the specific login
-        :return:
+        :return: cookie jar of the login, None if the login failed
         """
         strip_url = strip_url.replace("www.", "")
-        login = rq.post(url=f"{strip_url}.series-login.json",
-                        headers={"user-agent": "lol herre"},
-                        data={"_charset_": "utf-8", "username": usr, "password": pw},
-                        cookies=self.general_cookie)
+        url = f"{strip_url}.series-login.json"
+        with slot(None, self.rate_limit, url):
+            login = rq.post(url=url,
+                            headers={"user-agent": "lol herre"},
+                            data={"_charset_": "utf-8", "username": usr, "password": pw},
+                            cookies=self.general_cookie)
         if login.ok:
             cj = login.cookies
-            cj.update(self.general_cookie)
+            if self.general_cookie is not None:
+                cj.update(self.general_cookie)
 
             if other_cookies is not None:
                 cj.update(other_cookies)
@@ -491,20 +955,33 @@ class BetterStreamLoader(BaseSQliteDB):
             return cj
         else:
             self.logger.error(f"Error while performing spec login: {login.status_code}", vars(login))
-            return self.general_cookie
+            return None
 
     def enqueue_job(self):
         """
-        Enqueues all episodes in the download_list.
+        Feeds all episodes in the download_list to the worker threads. Returns immediately, the jobs (including the
+        spec logins) are generated in the background while dequeue_job writes the results.
+
+        :return:
+        """
+        self.pool.feed(self.generate_jobs())
+
+    def generate_jobs(self, entries: Iterable[EpisodeEntry] = None):
+        """
+        Generates the commands for the downloaders from all episodes in the download_list (or the given entries).
 
         It verifies that url of the series or the episode itself is not in
         the spec_login list.
 
-        If it is, it performs the login for the specific episode or series and adds the cookie
-        authentication to the command for the downloaders.
+        If it is, it takes the login cookie of the specific episode or series from the cookie cache (logging in for
+        the first episode of the series) and adds it to the command for the downloaders. The cookie jar is shared by
+        all commands of the series, not copied. If the login failed, the command gets the cookies it would have without
+        the specific login (general login, login of the series).
+
+        :param entries: episodes to download, None for the download_list
         :return:
         """
-        for dl in self.download_list:
+        for dl in self.download_list if entries is None else entries:
             dl: EpisodeEntry
             cookie = self.general_cookie
 
@@ -516,93 +993,123 @@ class BetterStreamLoader(BaseSQliteDB):
                                    .replace(".html", "")
                                    .replace(".series-metadata.json", ""))
 
-            # if the stripped url is a specified url, get login of that url as well
-            if strip_url in self.specific_urls:
-                index = self.specific_urls.index(strip_url)
-
-                cookie = self.spec_login(strip_url, self.specific_auth[index].username,
-                                         self.specific_auth[index].password)
+            # if the stripped url is a specified url, get login of that url as well (once per series)
+            cookie_key = None
+            auth = self.specific_urls.get(strip_url)
+            if auth is not None:
+                cookie_key = strip_url
+                jar = self.cookie_cache.get(cookie_key, functools.partial(self.spec_login, strip_url,
+                                                                          auth.username, auth.password))
+                cookie = jar if jar is not None else cookie
 
             # get specific login for specific episode if necessary
-            if episode_striped_url in self.specific_urls:
-                index = self.specific_urls.index(strip_url)
-
-                cookie = self.spec_login(strip_url, self.specific_auth[index]["username"],
-                                         self.specific_auth[index]["password"], other_cookies=cookie)
-            cookie_jar = pickle.dumps(cookie)
+            auth = self.specific_urls.get(episode_striped_url)
+            if auth is not None:
+                cookie_key = episode_striped_url
+                jar = self.cookie_cache.get(cookie_key, functools.partial(self.spec_login, episode_striped_url,
+                                                                          auth.username, auth.password,
+                                                                          other_cookies=cookie))
+                cookie = jar if jar is not None else cookie
 
             self.logger.debug(f"Enqueueing: {dl.episode_url}")
-            self.command_queue.put({"url": dl.episode_url, "cookie-jar": cookie_jar, "parent_id": dl.parent_id})
-
-        for i in range(len(self.workers)):
-            self.command_queue.put(None)
+            yield {"url": dl.episode_url, "cookie-jar": cookie, "cookie-key": cookie_key, "parent_id": dl.parent_id,
+                   "validators": self.validators.get(dl.episode_url)}
 
     def dequeue_job(self):
         """
         Dequeues the results from the results queue. It then stores the results in the results table.
+        Returns once the result of the last episode is written. The results are written in batches, one transaction
+        per batch.
         :return:
         """
-        # counter to prevent infinite loop
-        ctr = 0
         self.__processed_streams = 0
         self.__processed_episodes = 0
-        e_url = []
-
-        while ctr < 20:
-            delta_streams = self.__processed_streams - self.__last_info_streams
-            delta_episodes = self.__processed_episodes - self.__last_info_episodes
-            print_queue_size = False
-
-            if delta_episodes > 1000:
-                self.logger.info(f"                    Processed Episodes: {self.__processed_episodes}")
-                self.__last_info_episodes += 1000
-                print_queue_size = True
-
-            if delta_streams > 1000:
-                self.logger.info(f"                    Processed Streams: {self.__processed_streams}")
-                self.__last_info_streams += 1000
-                print_queue_size = True
-
-            if print_queue_size:
-                self.logger.info(f"                    Queue Size: {self.command_queue.qsize()}")
-
-            # dequeue
-            if not self.result_queue.empty():
-                try:
-                    res = self.result_queue.get()
-
-                    # verify the correct download of the episode metadata
-                    if res["status"] == 200:
-                        if res['is_json']:
-                            try:
-                                json_obj = json.loads(res["content"])
-                            except json.JSONDecodeError:
-                                assert False, (f"Failed to decode json from {res['url']}, "
-                                               f"despite it being labeled as json from download worker")
-
-                            ep_id = self.insert_update_json_episodes(parent_id=res["parent_id"], url=res["url"],
-                                                                     json_str=res["content"])
-                            streams = self.retrieve_streams(json_obj=json_obj, parent_id=res["parent_id"])
-                            self.link_episode_streams(episode_id=ep_id, streams=streams)
-                        else:
-                            self.insert_update_other_episodes(parent_id=res["parent_id"], url=res["url"],
-                                                              json_str=res["content"])
-                    else:
-                        self.logger.error(f"url {res['url']} with status code {res['status']}")
-                        e_url.append(res["url"])
-                    ctr = 0
-                except Exception as e:
-                    self.logger.exception("Exception while dequeueing", exc_info=e)
-            else:
-                time.sleep(1)
-                ctr += 1
-        self.logger.info(f"Encountered {len(e_url)} errors.")
+        self.__e_url = []
+
+        self.writer.run(self.pool.results(idle_timeout=self.writer.batch_ms / 1000))
 
-        if len(e_url) > 0:
+        self.logger.info(f"Encountered {len(self.__e_url)} errors.")
+        if self.ledger is not None:
+            self.logger.info(self.ledger.stats_str())
+
+        if len(self.__e_url) > 0:
             self.logger.error(f"Urls with failures:")
-            for url in e_url:
+            for url in self.__e_url:
                 self.logger.error(url)
 
+    def store_result(self, res: dict):
+        """
+        Write a single result of the download workers to the database. Called by the batch writer, doesn't commit.
+
+        :param res: result of get_stream, None if the job failed
+        :return:
+        """
+        delta_streams = self.__processed_streams - self.__last_info_streams
+        delta_episodes = self.__processed_episodes - self.__last_info_episodes
+        print_queue_size = False
+
+        if delta_episodes > 1000:
+            self.logger.info(f"                    Processed Episodes: {self.__processed_episodes}")
+            self.__last_info_episodes += 1000
+            print_queue_size = True
+
+        if delta_streams > 1000:
+            self.logger.info(f"                    Processed Streams: {self.__processed_streams}")
+            self.__last_info_streams += 1000
+            print_queue_size = True
+
+        # sinks have no pool, their results come from the pool of another loader
+        if print_queue_size and self.pool is not None:
+            self.logger.info(f"                    Pending Jobs: {self.pool.pending}")
+
+        if res is None:
+            return
+
+        try:
+            # verify the correct download of the episode metadata
+            if res["status"] == 304:
+                if not self.touch_json_episodes(url=res["url"]):
+                    # Validators without matching entry, next run downloads unconditionally
+                    self.validator_store.remove(res["url"])
+                    self.__e_url.append(res["url"])
+                    self.failed_jobs.append(self.__failed_entry(res))
+                    self.mark_job(res["url"], error="not modified, but no entry in episodes")
+                else:
+                    self.mark_job(res["url"])
+            elif res["status"] == 200:
+                if res['is_json']:
+                    try:
+                        json_obj = json.loads(res["content"])
+                    except json.JSONDecodeError:
+                        assert False, (f"Failed to decode json from {res['url']}, "
+                                       f"despite it being labeled as json from download worker")
+
+                    ep_id = self.insert_update_json_episodes(parent_id=res["parent_id"], url=res["url"],
+                                                             json_str=res["content"])
+                    streams = self.retrieve_streams(json_obj=json_obj, parent_id=res["parent_id"])
+                    self.link_episode_streams(episode_id=ep_id, streams=streams)
+                    self.validator_store.store(res["url"], res.get("validators"), self.start_dt)
+                else:
+                    self.insert_update_other_episodes(parent_id=res["parent_id"], url=res["url"],
+                                                      json_str=res["content"])
+                self.mark_job(res["url"])
+            else:
+                self.logger.error(f"url {res['url']} with status code {res['status']}")
+                self.__e_url.append(res["url"])
+                if res.get("error") in RETRYABLE:
+                    self.failed_jobs.append(self.__failed_entry(res))
+                self.mark_job(res["url"], error=f"{res.get('error')} error, status {res['status']}")
+        except Exception as e:
+            self.logger.exception("Exception while dequeueing", exc_info=e)
+            self.mark_job(res.get("url"), error=f"{type(e).__name__}: {e}")
+
+    def __failed_entry(self, res: dict) -> EpisodeEntry:
+        """
+        Episode of a failed result for the requeue pass.
+        """
+        return EpisodeEntry(episode_url=res["url"], series_url=self.series_urls.get(res["parent_id"], res["url"]),
+                            parent_id=res["parent_id"])
+
     def insert_update_other_episodes(self, parent_id: int, url: str, json_str: str):
         """
         Insert anything else other than json episodes into the database.
@@ -617,56 +1124,45 @@ class BetterStreamLoader(BaseSQliteDB):
         # list of ids in streams table associated with current episode.
         now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
         key = None
-        json_hash = hash(json_str)
-        conv_json_arg = aux.to_b64(json_str) if self.ub64 else json_str.replace("'", "''")
+        json_hash = aux.json_digest(json_str)
+        conv_json_arg = aux.to_b64(json_str) if self.ub64 else json_str
 
-        # check existence of initial and final record:
-        self.debug_execute(f"SELECT key, json, deprecated, record_type FROM episodes "
-                           f"WHERE URL = '{url}' AND episodes.record_type = 3 "
-                           f"ORDER BY found DESC")
+        # check existence of initial and final record (json_hash is read from the covering index):
+        self.debug_execute("SELECT key, json_hash, deprecated FROM episodes "
+                           "WHERE URL = ? AND record_type = 3 "
+                           "ORDER BY found DESC", (url,))
 
         raw = self.sq_cur.fetchall()
-        results = [{"key": res[0], "json": res[1], "deprecated": res[2]} for res in raw]
+        results = [{"key": res[0], "json_hash": res[1], "deprecated": res[2]} for res in raw]
 
         for result in results:
-            json_db = aux.from_b64(result["json"]) if self.ub64 else result["json"]
+            if not self.json_matches(key=result["key"], db_hash=result["json_hash"], json_hash=json_hash,
+                                     json_str=json_str, is_json=False):
+                continue
 
-            # Check the json matches
-            if json_db == json_str:
-                if result["deprecated"] == 1:
-                    self.logger.info(f"Reactivating deprecated non-json entry in metadata: {url}")
-                else:
-                    self.logger.debug(f"Found active non-json entry in metadata: {url}")
-                key = result["key"]
-                break
+            if result["deprecated"] == 1:
+                self.logger.info(f"Reactivating deprecated non-json entry in episodes: {url}")
+            else:
+                self.logger.debug(f"Found active non-json entry in episodes: {url}")
+            key = result["key"]
+            break
 
-                # No match found, inserting
+        # Match found, updating last_seen
         if key is not None:
-            self.logger.debug(f"Updating existing entry to metadata: {url}")
-            self.debug_execute(f"UPDATE metadata SET last_seen = '{now}' WHERE key = {key}")
+            self.logger.debug(f"Updating existing entry to episodes: {url}")
+            self.defer_execute("UPDATE episodes SET last_seen = ? WHERE key = ?", (now, key))
             return
 
         self.logger.debug(f"Inserting new entry to episodes: {url}")
-        # Found a new url, is initial so record type 0
+        # Found a new url, is non-json so record type 3
         self.debug_execute(
-            f"INSERT INTO metadata (URL, json, found, last_seen, record_type, json_hash) VALUES "
-            f"('{url}', '{conv_json_arg}', '{now}', '{now}', 3, '{json_hash}')")
-
-        # Get the key of the new record and add it to the assoz table
-        self.debug_execute(f"SELECT key FROM main.episodes "
-                           f"WHERE URL = '{url}' "
-                           f"AND json = '{conv_json_arg}' "
-                           f"AND found = '{now}' "
-                           f"AND last_seen = '{now}' "
-                           f"AND record_type = 3 "
-                           f"AND json_hash = '{json_hash}'")
+            "INSERT INTO episodes (URL, json, found, last_seen, record_type, json_hash) VALUES "
+            "(?, ?, ?, ?, 3, ?)", (url, conv_json_arg, now, now, json_hash))
 
-        raw = self.sq_cur.fetchall()
-        assert len(raw) == 1, f"Expected 1 result, got {len(raw)}"
-
-        key = raw[0][0]
-        self.debug_execute(f"INSERT OR IGNORE INTO metadata_episode_assoz (metadata_key, episode_key) "
-                           f"VALUES ({parent_id}, {key})")
+        # Key of the new record for the assoz table
+        key = self.sq_cur.lastrowid
+        self.defer_execute("INSERT OR IGNORE INTO metadata_episode_assoz (metadata_key, episode_key) VALUES (?, ?)",
+                           (parent_id, key))
 
     def insert_update_json_episodes(self, parent_id: int, url: str, json_str: str) -> int:
         """
@@ -683,53 +1179,26 @@ class BetterStreamLoader(BaseSQliteDB):
 
         # list of ids in streams table associated with current episode.
         now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
-        key, json_db, deprecated, record_type = None, None, None, None
-        json_hash = hash(json_str)
-        conv_json_arg = aux.to_b64(json_str) if self.ub64 else json_str.replace("'", "''")
+        key, deprecated, record_type = None, None, None
+        json_hash = aux.json_digest(json_str)
+        conv_json_arg = aux.to_b64(json_str) if self.ub64 else json_str
 
-        # check existence of initial and final record:
-        self.debug_execute(f"SELECT key, json, deprecated, record_type FROM episodes "
-                           f"WHERE URL = '{url}' AND record_type IN (2, 0) "
-                           f"ORDER BY record_type DESC LIMIT 1")
+        # check existence of initial and final record (json_hash is read from the covering index):
+        self.debug_execute("SELECT key, json_hash, deprecated, record_type FROM episodes "
+                           "WHERE URL = ? AND record_type IN (2, 0) "
+                           "ORDER BY record_type DESC LIMIT 1", (url,))
 
         results = self.sq_cur.fetchall()
 
         # check the length is 1, so we can unpack
         if len(results) != 0:
             assert len(results) == 1, "Update of the sql statement violates the assert - only one result expected"
-            key, temp_json, deprecated, record_type = results[0]
-            diff_key = key
-            json_db = aux.from_b64(temp_json) if self.ub64 else temp_json
+            key, db_hash, deprecated, record_type = results[0]
 
             # Check the json matches
-            if json.loads(json_db) == json.loads(json_str):
-                # Differing logging messages depending on if the entry is deprecated or not
-                if deprecated == 1:
-                    self.logger.info(f"Reactivating deprecated entry in episodes: {url}")
-                else:
-                    self.logger.debug(f"Found active entry in episodes: {url}")
-
-                # Perform the update of the differential entry that belongs to the final entry.
-                if record_type == 2:
-                    self.debug_execute(f"SELECT key FROM episodes "
-                                       f"WHERE record_type = 1 AND URL = '{url}' "
-                                       f"ORDER BY found DESC LIMIT 1")
-                    row = self.sq_cur.fetchone()
-
-                    # Row mustn't be None, since we have a final record
-                    assert row is not None, f"Couldn't find differential entry for {url}."
-                    diff_key = row[0]
-                    self.debug_execute(f"UPDATE episodes SET last_seen = '{now}', deprecated = 0 WHERE key = {diff_key}")
-
-                # Else -> record_type == 0. The final or initial entry needs to be updated anyway, no else block needed
-                # else:
-                #     pass
-
-                # Update the latest entry (i.e. the final entry or the initial entry if the json
-                # has been the same all the time)
-                assert record_type in (0, 2), f"Record type is {record_type}, expected 0 or 2"
-                self.debug_execute(f"UPDATE episodes SET last_seen = '{now}', deprecated = 0 WHERE key = {key}")
-                return diff_key
+            if self.json_matches(key=key, db_hash=db_hash, json_hash=json_hash, json_str=json_str, is_json=True):
+                return self.update_unchanged_json_episodes(url=url, key=key, deprecated=deprecated,
+                                                           record_type=record_type)
 
             # Else -> json is different, need to add something to the database. Don't update but insert for later diff
             # else:
@@ -740,31 +1209,129 @@ class BetterStreamLoader(BaseSQliteDB):
             self.logger.debug(f"Inserting new episode: {url}")
             # Found a new url, is initial so record type 0
             self.debug_execute(
-                f"INSERT INTO episodes (URL, json, found, last_seen, record_type, json_hash) VALUES "
-                f"('{url}', '{conv_json_arg}', '{now}', '{now}', 0, '{json_hash}')")
+                "INSERT INTO episodes (URL, json, found, last_seen, record_type, json_hash) VALUES "
+                "(?, ?, ?, ?, 0, ?)", (url, conv_json_arg, now, now, json_hash))
         else:
             self.logger.debug(f"Adding new state of existing entry to metadata: {url}")
             # Does exist, but json is different, needs to be a new diff entry, so record_type is left empty
             # for diff building
             self.debug_execute(
-                f"INSERT INTO episodes (URL, json, found, last_seen, json_hash) VALUES "
-                f"('{url}', '{conv_json_arg}', '{now}', '{now}', '{json_hash}')")
+                "INSERT INTO episodes (URL, json, found, last_seen, json_hash) VALUES "
+                "(?, ?, ?, ?, ?)", (url, conv_json_arg, now, now, json_hash))
 
-        # Get the key of the newly inserted entry
-        self.debug_execute(f"SELECT key FROM episodes "
-                           f"WHERE URL = '{url}' "
-                           f"AND json = '{conv_json_arg}'"
-                           f"AND found = '{now}'"
-                           f"AND (record_type IS NULL OR record_type = 0)")
-
-        res = self.sq_cur.fetchall()
-        assert len(res) == 1, f"Just inserted the bloody thing found {len(res)}"
+        # Key of the newly inserted entry
+        key = self.sq_cur.lastrowid
 
         # Add entry into the assoz table
-        self.debug_execute(f"INSERT OR IGNORE INTO metadata_episode_assoz (metadata_key, episode_key) "
-                           f"VALUES ({parent_id}, {res[0][0]})")
+        self.defer_execute("INSERT OR IGNORE INTO metadata_episode_assoz (metadata_key, episode_key) VALUES (?, ?)",
+                           (parent_id, key))
+
+        return key
+
+    def json_matches(self, key: int, db_hash: str, json_hash: str, json_str: str, is_json: bool) -> bool:
+        """
+        Compare a downloaded episode with a stored record by its json_hash. Only records with a legacy hash (from
+        hash(), which is randomized per process) are compared by their content. If they match, the stored hash is
+        replaced with the digest, so the next run doesn't need the content anymore.
+
+        :param key: key of the stored record
+        :param db_hash: json_hash of the stored record
+        :param json_hash: digest of the downloaded episode
+        :param json_str: downloaded episode
+        :param is_json: compare the parsed json instead of the string
+        :return: True if the stored record has the same content
+        """
+        if aux.is_json_digest(db_hash):
+            return db_hash == json_hash
+
+        self.debug_execute("SELECT json FROM episodes WHERE key = ?", (key,))
+        json_db = self.sq_cur.fetchone()[0]
+        json_db = aux.from_b64(json_db) if self.ub64 else json_db
+
+        if is_json:
+            match = json.loads(json_db) == json.loads(json_str)
+        else:
+            match = json_db == json_str
+
+        if match:
+            self.defer_execute("UPDATE episodes SET json_hash = ? WHERE key = ?", (json_hash, key))
+        return match
+
+    def touch_json_episodes(self, url: str) -> bool:
+        """
+        Update the last_seen of an episode whose json wasn't modified since the last download (HTTP 304) and of the
+        streams linked to it. The json isn't needed for this.
 
-        return res[0][0]
+        :param url: url of the episode
+        :return: False if no initial or final record exists for the url
+        """
+        self.__processed_episodes += 1
+        now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
+
+        self.debug_execute("SELECT key, deprecated, record_type FROM episodes "
+                           "WHERE URL = ? AND record_type IN (2, 0) "
+                           "ORDER BY record_type DESC LIMIT 1", (url,))
+        row = self.sq_cur.fetchone()
+
+        if row is None:
+            self.logger.error(f"Not modified response, but no entry in episodes: {url}")
+            return False
+
+        key, deprecated, record_type = row
+        diff_key = self.update_unchanged_json_episodes(url=url, key=key, deprecated=deprecated,
+                                                       record_type=record_type)
+
+        # The streams are linked to the latest differential (or the initial) entry
+        self.defer_execute("UPDATE streams SET last_seen = ?, deprecated = 0 "
+                           "WHERE key IN (SELECT stream_key FROM episode_stream_assoz WHERE episode_key = ?)",
+                           (now, diff_key))
+
+        # Deferred statements have no rowcount, count the linked streams for the progress (links are unique)
+        self.debug_execute("SELECT COUNT(stream_key) FROM episode_stream_assoz WHERE episode_key = ?", (diff_key,))
+        self.__processed_streams += self.sq_cur.fetchone()[0]
+        return True
+
+    def update_unchanged_json_episodes(self, url: str, key: int, deprecated: int, record_type: int) -> int:
+        """
+        Update last_seen of the latest entry (final or initial) of an episode whose json is unchanged and of the
+        differential entry belonging to the final entry.
+
+        :param url: url of the episode
+        :param key: key of the final or initial record
+        :param deprecated: deprecated flag of the record
+        :param record_type: record type of the record (0 or 2)
+        :return: key of the entry the streams are linked to (latest differential or initial entry)
+        """
+        now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
+        diff_key = key
+
+        # Differing logging messages depending on if the entry is deprecated or not
+        if deprecated == 1:
+            self.logger.info(f"Reactivating deprecated entry in episodes: {url}")
+        else:
+            self.logger.debug(f"Found active entry in episodes: {url}")
+
+        # Perform the update of the differential entry that belongs to the final entry.
+        if record_type == 2:
+            self.debug_execute("SELECT key FROM episodes "
+                               "WHERE record_type = 1 AND URL = ? "
+                               "ORDER BY found DESC LIMIT 1", (url,))
+            row = self.sq_cur.fetchone()
+
+            # Row mustn't be None, since we have a final record
+            assert row is not None, f"Couldn't find differential entry for {url}."
+            diff_key = row[0]
+            self.defer_execute("UPDATE episodes SET last_seen = ?, deprecated = 0 WHERE key = ?", (now, diff_key))
+
+        # Else -> record_type == 0. The final or initial entry needs to be updated anyway, no else block needed
+        # else:
+        #     pass
+
+        # Update the latest entry (i.e. the final entry or the initial entry if the json
+        # has been the same all the time)
+        assert record_type in (0, 2), f"Record type is {record_type}, expected 0 or 2"
+        self.defer_execute("UPDATE episodes SET last_seen = ?, deprecated = 0 WHERE key = ?", (now, key))
+        return diff_key
 
     def link_episode_streams(self, episode_id: int, streams: List[int]):
         """
@@ -775,8 +1342,8 @@ class BetterStreamLoader(BaseSQliteDB):
         :return:
         """
         for stream in streams:
-            self.debug_execute(f"INSERT OR IGNORE INTO episode_stream_assoz (episode_key, stream_key) "
-                               f"VALUES ({episode_id}, {stream})")
+            self.defer_execute("INSERT OR IGNORE INTO episode_stream_assoz (episode_key, stream_key) VALUES (?, ?)",
+                               (episode_id, stream))
 
     def retrieve_streams(self, json_obj: dict, parent_id: int):
         """
@@ -844,7 +1411,7 @@ class BetterStreamLoader(BaseSQliteDB):
         now = self.start_dt.strftime("%Y-%m-%d %H:%M:%S")
 
         # exists:
-        self.debug_execute(f"SELECT key, deprecated FROM streams WHERE URL = '{url}' AND resolution = '{resolution}'")
+        self.debug_execute("SELECT key, deprecated FROM streams WHERE URL = ? AND resolution = ?", (url, resolution))
         results = self.sq_cur.fetchall()
 
         assert len(results) <= 1, "Multiple entries with same url and resolution"
@@ -853,16 +1420,11 @@ class BetterStreamLoader(BaseSQliteDB):
         if len(results) == 0:
             self.logger.debug(f"Inserting {url} with resolution {resolution}")
             self.debug_execute(
-                f"INSERT INTO streams (URL, resolution, found, last_seen) "
-                f"VALUES ('{url}', '{resolution}', '{now}', '{now}')")
-
-            self.debug_execute(
-                f"SELECT key FROM streams WHERE URL IS '{url}' AND  resolution IS '{resolution}' AND found IS '{now}'")
+                "INSERT INTO streams (URL, resolution, found, last_seen) VALUES (?, ?, ?, ?)",
+                (url, resolution, now, now))
 
             # return the key
-            val = self.sq_cur.fetchone()[0]
-            assert val is not None, "Just inserted the bloody thing"
-            return val
+            return self.sq_cur.lastrowid
 
         # results length is 1
         key, deprecated = results[0]
@@ -870,14 +1432,14 @@ class BetterStreamLoader(BaseSQliteDB):
         # it exists, abort
         if deprecated == 0:
             self.logger.debug(f"Found {url} with resolution {resolution} active in db")
-            self.debug_execute(f"UPDATE streams SET last_seen = '{now}' WHERE key = {key}")
+            self.defer_execute("UPDATE streams SET last_seen = ? WHERE key = ?", (now, key))
             return key
 
         else:
             self.logger.debug(f"Found {url} with resolution {resolution} inactive in db, reactivate")
 
             # update to not deprecated where the key matches.
-            self.debug_execute(f"UPDATE streams SET deprecated = 0, last_seen = '{now}' WHERE key = {key}")
+            self.defer_execute("UPDATE streams SET deprecated = 0, last_seen = ? WHERE key = ?", (now, key))
             return key
 
     def deprecate(self, dt: datetime.datetime):
@@ -908,21 +1470,21 @@ class BetterStreamLoader(BaseSQliteDB):
         self.debug_execute("DROP TABLE IF EXISTS temp")
 
         # create temporary table with all not deprecated episode entries
-        self.debug_execute(f"CREATE TABLE temp AS SELECT episodes.key AS key "
-                           f"FROM metadata JOIN metadata_episode_assoz ON metadata.key = metadata_episode_assoz.metadata_key "
-                           f"JOIN episodes ON metadata_episode_assoz.episode_key = episodes.key "
-                           f"WHERE metadata.deprecated = 0 "
-                           f"AND datetime(metadata.last_seen) >= datetime('{dts}') "
-                           f"AND datetime(episodes.last_seen) >= datetime('{dts}')")
+        self.debug_execute("CREATE TABLE temp AS SELECT episodes.key AS key "
+                           "FROM metadata JOIN metadata_episode_assoz ON metadata.key = metadata_episode_assoz.metadata_key "
+                           "JOIN episodes ON metadata_episode_assoz.episode_key = episodes.key "
+                           "WHERE metadata.deprecated = 0 "
+                           "AND metadata.last_seen >= ? "
+                           "AND episodes.last_seen >= ?", (dts, dts))
 
         # Add final records to temp table
-        self.debug_execute(f"INSERT INTO temp "
-                           f"SELECT episodes.key AS key FROM episodes "
-                           f"WHERE episodes.record_type = 2 AND datetime(episodes.last_seen) >= datetime('{dts}')")
+        self.debug_execute("INSERT INTO temp "
+                           "SELECT episodes.key AS key FROM episodes "
+                           "WHERE episodes.record_type = 2 AND episodes.last_seen >= ?", (dts,))
 
-        self.debug_execute(f"SELECT COUNT(episodes.key) AS key "
-                           f"FROM episodes "
-                           f"WHERE episodes.record_type = 2 AND datetime(episodes.last_seen) >= datetime('{dts}');")
+        self.debug_execute("SELECT COUNT(episodes.key) AS key "
+                           "FROM episodes "
+                           "WHERE episodes.record_type = 2 AND episodes.last_seen >= ?;", (dts,))
 
         count = self.sq_cur.fetchone()[0]
         self.logger.info(f"Added {count} final records to the temp table")
@@ -955,12 +1517,12 @@ class BetterStreamLoader(BaseSQliteDB):
 
         self.debug_execute("DROP TABLE IF EXISTS temp")
 
-        self.debug_execute(f"CREATE TABLE temp AS SELECT streams.key AS key "
-                           f"FROM episodes JOIN episode_stream_assoz ON episodes.key = episode_stream_assoz.episode_key "
-                           f"JOIN streams ON episode_stream_assoz.stream_key = streams.key "
-                           f"WHERE episodes.deprecated = 0 "
-                           f"AND datetime(episodes.last_seen) >= datetime('{dts}') "
-                           f"AND datetime(streams.last_seen) >= datetime('{dts}')")
+        self.debug_execute("CREATE TABLE temp AS SELECT streams.key AS key "
+                           "FROM episodes JOIN episode_stream_assoz ON episodes.key = episode_stream_assoz.episode_key "
+                           "JOIN streams ON episode_stream_assoz.stream_key = streams.key "
+                           "WHERE episodes.deprecated = 0 "
+                           "AND episodes.last_seen >= ? "
+                           "AND streams.last_seen >= ?", (dts, dts))
 
         self.debug_execute(f"SELECT COUNT(DISTINCT streams.key) FROM streams "
                            f"WHERE streams.key NOT IN (SELECT key FROM temp) AND deprecated = 0;")
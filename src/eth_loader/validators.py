@@ -0,0 +1,96 @@
+import datetime
+from typing import Dict, Union
+
+from eth_loader.base_sql import BaseSQliteDB
+
+
+def conditional_headers(headers: dict, validators: Union[dict, None]) -> dict:
+    """
+    Add the headers for a conditional GET to a copy of the given headers.
+
+    :param headers: headers of the request
+    :param validators: dict with etag and last_modified of the previous response, None for an unconditional request
+    :return: headers for the request
+    """
+    if validators is None:
+        return headers
+
+    headers = dict(headers)
+    if validators.get("etag") is not None:
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified") is not None:
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def response_validators(headers) -> dict:
+    """
+    Extract the validators from the headers of a response.
+
+    :param headers: headers of the response (case-insensitive mapping of requests or aiohttp)
+    :return: dict with etag and last_modified, values are None if the server didn't send them.
+    """
+    return {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+
+
+class ValidatorStore:
+    """
+    Side table storing the ETag and Last-Modified headers of every downloaded url. On the next run they are sent as
+    If-None-Match / If-Modified-Since so unchanged documents are answered with 304 instead of the full json.
+    """
+
+    def __init__(self, db: BaseSQliteDB):
+        """
+        :param db: database object (loader) to store the validators in. The connection of the loader is used.
+        """
+        self.db = db
+        self.check_table()
+
+    def check_table(self):
+        """
+        Create the validators table if it doesn't exist.
+        """
+        self.db.debug_execute("CREATE TABLE IF NOT EXISTS http_validators "
+                              "(key INTEGER PRIMARY KEY AUTOINCREMENT, "
+                              "URL TEXT UNIQUE, "
+                              "etag TEXT, "
+                              "last_modified TEXT, "
+                              "last_checked TEXT)")
+
+    def load(self) -> Dict[str, dict]:
+        """
+        Load all validators.
+
+        :return: dict url -> dict(etag, last_modified)
+        """
+        self.db.debug_execute("SELECT URL, etag, last_modified FROM http_validators")
+        return {r[0]: {"etag": r[1], "last_modified": r[2]} for r in self.db.sq_cur.fetchall()}
+
+    def store(self, url: str, validators: Union[dict, None], dt: datetime.datetime):
+        """
+        Store the validators of a response. If the response didn't contain any, the entry of the url is removed.
+        Deferred until the next flush of the database object.
+
+        :param url: url of the response
+        :param validators: dict with etag and last_modified
+        :param dt: datetime of the current run
+        """
+        if validators is None or (validators.get("etag") is None and validators.get("last_modified") is None):
+            self.remove(url)
+            return
+
+        self.db.defer_execute("INSERT INTO http_validators (URL, etag, last_modified, last_checked) "
+                              "VALUES (?, ?, ?, ?) "
+                              "ON CONFLICT (URL) DO UPDATE SET etag = excluded.etag, "
+                              "last_modified = excluded.last_modified, last_checked = excluded.last_checked",
+                              (url, validators.get("etag"), validators.get("last_modified"),
+                               dt.strftime("%Y-%m-%d %H:%M:%S")))
+
+    def remove(self, url: str):
+        """
+        Remove the validators of an url, the next request will be unconditional. Deferred until the next flush of the
+        database object.
+
+        :param url: url to remove
+        """
+        self.db.defer_execute("DELETE FROM http_validators WHERE URL = ?", (url,))
@@ -0,0 +1,275 @@
+import itertools
+import logging
+import math
+import multiprocessing as mp
+import queue
+import threading
+from typing import Any, Callable, Iterable, List, Union
+
+"""
+# Worker pool shared by all loaders
+
+Life cycle:
+- start: spawns the workers (threads, or processes for cpu bound work)
+- submit / feed: jobs are put into the (bounded) command queue. Submitting blocks while the queue is full, so the
+    producer can't run away from the workers (backpressure). Workers may submit further jobs themselves (recursion
+    of the site indexer), in that case the command queue must be unbounded.
+- close: no more jobs from the producer (feed closes automatically)
+- priority: with priority=True the command queue is a PriorityQueue, jobs with a lower priority value are handed to
+    the workers first (threads only).
+- results: generator over the results in the main thread (the single db writer). Every job produces exactly one
+    result (None if the job failed or has nothing to report), so the pool knows the stage is done the moment the
+    result of the last submitted job has been handed out. No idle timeouts needed.
+- after the last result the workers receive their stop signal (None) and are joined.
+"""
+
+# Marker put in the result queue once the producer is done. String so it survives pickling for processes.
+FEED_DONE = "__worker_pool_feed_done__"
+
+# Handed out by results if no result arrived within the idle timeout
+IDLE = "__worker_pool_idle__"
+
+
+def pool_worker(worker_nr: int, job_fn: Callable[[int, Any], Any], command_queue, result_queue,
+                logger_name: str, priority: bool = False):
+    """
+    Function executed in a worker thread or process. Blocks on the command queue until a job or the stop signal
+    (None) arrives. Puts exactly one result per job into the result queue.
+
+    :param worker_nr: Identifier for debugging
+    :param job_fn: function performing a single job, called as job_fn(worker_nr, job)
+    :param command_queue: Queue containing the jobs
+    :param result_queue: Queue to put the results in. Handled in main thread.
+    :param logger_name: logger to report failing jobs to
+    :param priority: the commands are (priority, sequence number, job) tuples of a PriorityQueue
+    :return:
+    """
+    local_logger = logging.getLogger("thread_handler")
+    local_logger.info(f"Worker {worker_nr:02} started")
+
+    while True:
+        job = command_queue.get()
+        if priority:
+            job = job[2]
+
+        if job is None:
+            break
+
+        try:
+            result = job_fn(worker_nr, job)
+        except Exception as e:
+            logging.getLogger(logger_name).exception(f"{worker_nr:02}: Job failed", exc_info=e)
+            result = None
+
+        result_queue.put(result)
+
+    local_logger.info(f"Worker {worker_nr:02} exiting")
+
+
+class WorkerPool:
+    """
+    Pool of workers with blocking, bounded hand-off between producer, workers and the single consumer.
+    """
+    def __init__(self, job_fn: Callable[[int, Any], Any], workers: int, cmd_size: int = 0, result_size: int = 0,
+                 processes: bool = False, logger_name: str = "thread_handler", liveness_interval: int = 60,
+                 priority: bool = False):
+        """
+        :param job_fn: function performing a single job, called as job_fn(worker_nr, job). Must be picklable for
+            processes.
+        :param workers: number of workers
+        :param cmd_size: maximum size of the command queue, 0 for unbounded
+        :param result_size: maximum size of the result queue, 0 for unbounded
+        :param processes: use processes instead of threads
+        :param logger_name: logger of the owning loader
+        :param liveness_interval: seconds after which a waiting consumer checks that workers are still alive
+        :param priority: hand out the jobs by priority (see submit) instead of first in first out
+        """
+        if workers < 1:
+            raise ValueError("Workers must be greater than 0")
+
+        if priority and processes:
+            raise ValueError("Priority is only supported for threads")
+
+        self.job_fn = job_fn
+        self.worker_count = workers
+        self.processes = processes
+        self.logger = logging.getLogger(logger_name)
+        self.logger_name = logger_name
+        self.liveness_interval = liveness_interval
+        self.priority = priority
+
+        if processes:
+            self.command_queue = mp.Queue(maxsize=cmd_size)
+            self.result_queue = mp.Queue(maxsize=result_size)
+        elif priority:
+            self.command_queue = queue.PriorityQueue(maxsize=cmd_size)
+            self.result_queue = queue.Queue(maxsize=result_size)
+        else:
+            self.command_queue = queue.Queue(maxsize=cmd_size)
+            self.result_queue = queue.Queue(maxsize=result_size)
+
+        self.workers: List[Union[threading.Thread, mp.Process]] = []
+        self.feeder: Union[threading.Thread, None] = None
+
+        self.__lock = threading.Lock()
+        # tie breaker of equal priorities, keeps them first in first out and the jobs themselves uncompared
+        self.__sequence = itertools.count()
+        self.__submitted = 0
+        self.__received = 0
+        self.__closed = False
+        self.__stopped = False
+
+    @property
+    def submitted(self) -> int:
+        """
+        Number of jobs submitted so far.
+        """
+        with self.__lock:
+            return self.__submitted
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of submitted jobs whose result hasn't been handed out yet.
+        """
+        with self.__lock:
+            return self.__submitted - self.__received
+
+    def start(self):
+        """
+        Spawn the workers.
+        """
+        if len(self.workers) > 0:
+            raise ValueError("Workers already started. Only one run per pool.")
+
+        for i in range(self.worker_count):
+            args = (i, self.job_fn, self.command_queue, self.result_queue, self.logger_name, self.priority)
+            if self.processes:
+                w = mp.Process(target=pool_worker, args=args)
+            else:
+                w = threading.Thread(target=pool_worker, args=args)
+            w.start()
+            self.workers.append(w)
+
+        self.logger.info("Workers Spawned")
+
+    def submit(self, job: Any, priority: float = 0):
+        """
+        Submit a job. Blocks while the command queue is full. Thread-safe, may be called from within a job.
+
+        :param job: job passed to job_fn, must not be None
+        :param priority: jobs with lower values are handed out first, ignored unless the pool was created with
+            priority=True.
+        """
+        if job is None:
+            raise ValueError("None is reserved for the stop signal")
+
+        with self.__lock:
+            self.__submitted += 1
+            seq = next(self.__sequence)
+
+        if self.priority:
+            self.command_queue.put((priority, seq, job))
+        else:
+            self.command_queue.put(job)
+
+    def close(self):
+        """
+        Signal that the producer won't submit any more jobs. Jobs may still submit further jobs.
+        """
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+        self.result_queue.put(FEED_DONE)
+
+    def feed(self, jobs: Iterable[Any]):
+        """
+        Submit all jobs from a separate thread and close the pool afterwards. Returns immediately, so the caller can
+        consume the results while the jobs are being produced.
+
+        :param jobs: iterable of jobs
+        """
+        def _feed():
+            try:
+                for job in jobs:
+                    self.submit(job)
+            except Exception as e:
+                self.logger.exception("Failed to produce jobs", exc_info=e)
+            finally:
+                self.close()
+
+        self.feeder = threading.Thread(target=_feed)
+        self.feeder.start()
+
+    def results(self, idle_timeout: float = None):
+        """
+        Generator over the results of all jobs. Returns once the producer closed the pool and the result of every
+        submitted job has been handed out. Stops the workers afterwards.
+
+        Results of failed jobs (None) are handed out as well.
+
+        :param idle_timeout: seconds without result after which IDLE is handed out, None to wait silently
+        """
+        timeout = self.liveness_interval if idle_timeout is None else min(idle_timeout, self.liveness_interval)
+        waited = 0
+        closed = False
+        while True:
+            with self.__lock:
+                if closed and self.__received == self.__submitted:
+                    break
+
+            try:
+                res = self.result_queue.get(timeout=timeout)
+                waited = 0
+            except queue.Empty:
+                waited += timeout
+                if waited >= self.liveness_interval:
+                    waited = 0
+                    if not self.is_alive():
+                        self.logger.error(f"All workers exited with {self.pending} jobs pending")
+                        break
+                if idle_timeout is not None:
+                    yield IDLE
+                continue
+
+            if isinstance(res, str) and res == FEED_DONE:
+                closed = True
+                continue
+
+            with self.__lock:
+                self.__received += 1
+            yield res
+
+        self.stop()
+
+    def is_alive(self) -> bool:
+        """
+        Check if at least one of the workers hasn't exited.
+        """
+        for w in self.workers:
+            if w.is_alive():
+                return True
+        return False
+
+    def stop(self):
+        """
+        Send the stop signal to all workers and join them. Does nothing if the workers are already stopped.
+        """
+        if self.__stopped:
+            return
+        self.__stopped = True
+
+        for _ in self.workers:
+            if self.priority:
+                self.command_queue.put((math.inf, next(self.__sequence), None))
+            else:
+                self.command_queue.put(None)
+
+        for w in self.workers:
+            w.join(10)
+            if w.is_alive():
+                self.logger.error("Worker didn't exit after stop signal")
+
+        if self.feeder is not None:
+            self.feeder.join()